@@ -10,6 +10,8 @@ django.setup()
 # Import Django settings and models
 from django.conf import settings
 from bot.models import Location, Service, UserRequestLog
+from emergency_bot.accounts.models import UserProfile
+from emergency_bot.agencies.distance import DistanceEngine
 from emergency_bot.utils.translations import get_text, get_user_language, update_user_language
 
 # Import Telegram libraries
@@ -56,6 +58,23 @@ async def get_user_lang(user_id):
     language = await sync_to_async(get_user_language)(user_id)
     return language
 
+def find_nearest_service(service_key, telegram_id):
+    """Return the service of the given type closest to the user's saved location."""
+    services = list(Service.objects.filter(service_type=service_key).select_related('location'))
+    if not services:
+        return None
+
+    profile = UserProfile.objects.filter(telegram_id=telegram_id).first()
+    if not profile or profile.latitude is None or profile.longitude is None:
+        return services[0]
+
+    engine = DistanceEngine([
+        (service.location.latitude, service.location.longitude, service.service_type)
+        for service in services
+    ])
+    positions, _ = engine.query(profile.latitude, profile.longitude, limit=1)
+    return services[positions[0]]
+
 # Start Command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = str(update.effective_user.id)
@@ -164,8 +183,8 @@ async def choose_service(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     # Log user request (skipping for now)
     logger.info(f"User chose: {service_key}, skipping UserRequestLog")
 
-    # Find service
-    service = await sync_to_async(Service.objects.filter(service_type=service_key).first)()
+    # Find the service closest to the user's last shared location
+    service = await sync_to_async(find_nearest_service)(service_key, user_id)
 
     if service:
         location_link = f"https://maps.google.com/?q={service.location.latitude},{service.location.longitude}"
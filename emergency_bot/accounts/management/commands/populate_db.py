@@ -13,7 +13,9 @@ from datetime import timedelta
 import random
 
 from emergency_bot.accounts.models import UserProfile
+from emergency_bot.agencies.loader import load_agencies
 from emergency_bot.agencies.models import Agency
+from emergency_bot.agencies.sync import base_slug
 from emergency_bot.reports.models import IncidentReport
 from emergency_bot.notifications.models import Notification, NotificationChannel
 
@@ -326,10 +328,9 @@ class Command(BaseCommand):
             },
         ]
 
-        agencies = []
-        for agency_data in agencies_data:
-            agency = Agency.objects.create(**agency_data)
-            agencies.append(agency)
+        # The loader picks unique slugs and fills in content_hash; rerunning keeps existing agencies
+        load_agencies(agencies_data, update_existing=False)
+        agencies = list(Agency.objects.filter(slug__in=[base_slug(data) for data in agencies_data]))
 
         return agencies
 
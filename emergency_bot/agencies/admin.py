@@ -4,7 +4,7 @@ Admin configuration for the agencies app.
 
 from django.contrib import admin
 from django.utils.html import format_html
-from .models import Agency
+from .models import Agency, AgencySyncState
 
 
 @admin.register(Agency)
@@ -32,7 +32,7 @@ class AgencyAdmin(admin.ModelAdmin):
             'fields': ('hours_of_operation', 'services')
         }),
         ('Status', {
-            'fields': ('verified', 'active')
+            'fields': ('verified', 'active', 'external_id')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -63,4 +63,10 @@ class AgencyAdmin(admin.ModelAdmin):
         if not obj.slug:
             from django.utils.text import slugify
             obj.slug = slugify(f"{obj.name}-{obj.region}")
-        super().save_model(request, obj, form, change) 
\ No newline at end of file
+        super().save_model(request, obj, form, change) 
+
+
+@admin.register(AgencySyncState)
+class AgencySyncStateAdmin(admin.ModelAdmin):
+    list_display = ('source', 'cursor', 'last_synced_at', 'last_changed')
+    readonly_fields = ('last_synced_at', 'last_changed')
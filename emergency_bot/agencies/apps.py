@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class AgenciesConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'emergency_bot.agencies'
+    label = 'agencies'
+    verbose_name = 'Agencies'
+
+    def ready(self):
+        """
+        Connect the signal handlers that keep the in-process agency
+        indexes in step with the database.
+        """
+        from . import signals  # noqa: F401
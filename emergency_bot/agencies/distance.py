@@ -0,0 +1,164 @@
+"""
+Batch distance engine for agency proximity queries.
+
+Coordinates are kept in contiguous float64 arrays so distances, the
+distance filter, the type mask and the sort run as one vectorized pass.
+NumPy is optional; without it the same queries run in pure Python.
+"""
+
+import math
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is not installed on every host
+    np = None
+
+EARTH_RADIUS_KM = 6371
+KM_PER_DEGREE = 111.32  # Length of one degree of latitude in kilometers
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Calculate the Haversine distance between two points in kilometers.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    )
+    return 2 * math.asin(math.sqrt(a)) * EARTH_RADIUS_KM
+
+
+class DistanceEngine:
+    """
+    Distances from one point to many agencies at once.
+
+    ``points`` is a sequence of ``(latitude, longitude, type)`` tuples; query
+    results refer to agencies by their position in that sequence.
+    """
+
+    def __init__(self, points):
+        points = list(points)
+        lats = [float(lat) for lat, _, _ in points]
+        lngs = [float(lng) for _, lng, _ in points]
+        self.type_codes = {}
+        codes = [
+            self.type_codes.setdefault(kind, len(self.type_codes))
+            for _, _, kind in points
+        ]
+        self.size = len(lats)
+
+        if np is not None:
+            self.lat = np.radians(np.asarray(lats, dtype=np.float64))
+            self.lng = np.radians(np.asarray(lngs, dtype=np.float64))
+            self.cos_lat = np.cos(self.lat)
+            self.types = np.asarray(codes, dtype=np.int32)
+        else:
+            self.lat = [math.radians(lat) for lat in lats]
+            self.lng = [math.radians(lng) for lng in lngs]
+            self.cos_lat = [math.cos(lat) for lat in self.lat]
+            self.types = codes
+
+    def __len__(self):
+        return self.size
+
+    def query(
+        self,
+        latitude,
+        longitude,
+        max_distance=None,
+        agency_type=None,
+        limit=None,
+        candidates=None,
+    ):
+        """
+        Return ``(positions, distances)`` for matching agencies, closest first.
+
+        ``candidates`` optionally restricts the pass to the given positions,
+        e.g. the agencies in the grid cells a spatial index selected.
+        """
+        if limit is not None and limit <= 0:
+            return [], []
+        if agency_type:
+            type_code = self.type_codes.get(agency_type)
+            if type_code is None:
+                return [], []
+        else:
+            type_code = None
+
+        if np is not None:
+            return self._query_numpy(
+                latitude, longitude, max_distance, type_code, limit, candidates
+            )
+        return self._query_python(
+            latitude, longitude, max_distance, type_code, limit, candidates
+        )
+
+    def _query_numpy(
+        self, latitude, longitude, max_distance, type_code, limit, candidates
+    ):
+        if candidates is None:
+            positions = np.arange(self.size)
+        else:
+            positions = np.asarray(candidates, dtype=np.intp)
+        if positions.size == 0:
+            return [], []
+
+        lat1 = math.radians(latitude)
+        lng1 = math.radians(longitude)
+        lat2 = self.lat[positions]
+        dlat = lat2 - lat1
+        dlng = self.lng[positions] - lng1
+        a = (
+            np.sin(dlat / 2) ** 2
+            + math.cos(lat1) * self.cos_lat[positions] * np.sin(dlng / 2) ** 2
+        )
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+        mask = np.ones(positions.size, dtype=bool)
+        if type_code is not None:
+            mask &= self.types[positions] == type_code
+        if max_distance is not None:
+            mask &= distances <= max_distance
+        positions = positions[mask]
+        distances = distances[mask]
+
+        if limit is not None and limit < distances.size:
+            # Partition first so only the kept prefix gets fully sorted
+            keep = np.argpartition(distances, limit - 1)[:limit]
+            positions = positions[keep]
+            distances = distances[keep]
+        order = np.argsort(distances, kind='stable')
+        return positions[order].tolist(), distances[order].tolist()
+
+    def _query_python(
+        self, latitude, longitude, max_distance, type_code, limit, candidates
+    ):
+        positions = range(self.size) if candidates is None else candidates
+
+        lat1 = math.radians(latitude)
+        lng1 = math.radians(longitude)
+        cos_lat1 = math.cos(lat1)
+        matches = []
+        for position in positions:
+            if type_code is not None and self.types[position] != type_code:
+                continue
+            dlat = self.lat[position] - lat1
+            dlng = self.lng[position] - lng1
+            a = (
+                math.sin(dlat / 2) ** 2
+                + cos_lat1 * self.cos_lat[position] * math.sin(dlng / 2) ** 2
+            )
+            distance = 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+            if max_distance is not None and distance > max_distance:
+                continue
+            matches.append((distance, position))
+
+        matches.sort()
+        if limit is not None:
+            matches = matches[:limit]
+        return [position for _, position in matches], [
+            distance for distance, _ in matches
+        ]
@@ -0,0 +1,180 @@
+"""
+Stale-while-revalidate cache for the external agency directory.
+
+Requests never wait on the upstream API: they get the last good copy (from
+the Django cache, or from a copy persisted on disk after a restart) and a
+single background thread per cluster refreshes it once it goes stale.
+After a failed fetch the refresh lock is kept for a backoff period, which
+doubles with every consecutive failure up to the TTL, so an unreachable
+upstream is not asked again on every request.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'external_agencies'
+REFRESH_LOCK_KEY = 'external_agencies_refresh_lock'
+REFRESH_BACKOFF_KEY = 'external_agencies_refresh_backoff'
+
+# Seconds before retrying after the first failed fetch
+RETRY_DELAY = 60
+
+_refresh_lock = threading.Lock()
+
+
+def _fresh_seconds():
+    return getattr(settings, 'EXTERNAL_AGENCIES_TTL', 3600)
+
+
+def _disk_copy_path():
+    default = os.path.join(settings.BASE_DIR, 'tmp', 'external_agencies.json')
+    return getattr(settings, 'EXTERNAL_AGENCIES_CACHE_FILE', default)
+
+
+def _read_disk_copy():
+    """Return the persisted ``{'agencies', 'fetched_at'}`` entry, or None."""
+    path = _disk_copy_path()
+    try:
+        with open(path, encoding='utf-8') as f:
+            entry = json.load(f)
+        if isinstance(entry, dict) and isinstance(entry.get('agencies'), list):
+            return entry
+        logger.warning(f"Ignoring malformed external agencies copy at {path}")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read external agencies copy at {path}: {e}")
+    return None
+
+
+def _write_disk_copy(entry):
+    """Persist ``entry`` atomically so readers never see a partial file."""
+    path = _disk_copy_path()
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.external_agencies.')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not persist external agencies copy to {path}: {e}")
+
+
+def _load_entry():
+    entry = cache.get(CACHE_KEY)
+    if isinstance(entry, list):
+        # Value written before entries carried a fetch time; treat it as stale
+        entry = {'agencies': entry, 'fetched_at': 0}
+    if entry is None:
+        entry = _read_disk_copy()
+        if entry is not None:
+            cache.set(CACHE_KEY, entry, None)
+    return entry
+
+
+def refresh_external_agencies(url):
+    """
+    Fetch the external directory and store it in the cache and on disk.
+    Blocks on the network; call it from a background thread or a worker.
+    Returns the agencies list, or None if the fetch failed.
+    """
+    try:
+        response = requests.get(url, timeout=10)
+        if response.status_code != 200:
+            logger.warning(f"External API returned status {response.status_code}")
+            return None
+        agencies = response.json()
+        if not isinstance(agencies, list):
+            logger.warning("External API returned an unexpected payload")
+            return None
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Internet request failed: {e}")
+        return None
+
+    entry = {'agencies': agencies, 'fetched_at': time.time()}
+    cache.set(CACHE_KEY, entry, None)
+    _write_disk_copy(entry)
+    logger.info(f"Refreshed {len(agencies)} agencies from external API")
+    return agencies
+
+
+def _failure_backoff():
+    """Return the seconds to wait after one more failed fetch, and remember it."""
+    previous = cache.get(REFRESH_BACKOFF_KEY)
+    backoff = min(previous * 2 if previous else RETRY_DELAY, _fresh_seconds())
+    cache.set(REFRESH_BACKOFF_KEY, backoff, None)
+    return backoff
+
+
+def _refresh_in_background(url):
+    agencies = None
+    try:
+        agencies = refresh_external_agencies(url)
+    finally:
+        if agencies is None:
+            # Keep other workers from retrying until the backoff has passed
+            backoff = _failure_backoff()
+            cache.set(REFRESH_LOCK_KEY, True, backoff)
+            logger.info(f"Next external agencies refresh in {backoff}s at the earliest")
+        else:
+            cache.delete(REFRESH_BACKOFF_KEY)
+            cache.delete(REFRESH_LOCK_KEY)
+        _refresh_lock.release()
+
+
+def schedule_refresh(url):
+    """
+    Start a background refresh unless one is already running.
+
+    A process-local lock stops threads in this worker from piling up, and a
+    short-lived cache key does the same across workers sharing the cache.
+    After a failed fetch that key stays set for the backoff period.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return False
+    if not cache.add(REFRESH_LOCK_KEY, True, 60):
+        _refresh_lock.release()
+        return False
+    try:
+        threading.Thread(
+            target=_refresh_in_background,
+            args=(url,),
+            name='external-agencies-refresh',
+            daemon=True,
+        ).start()
+    except Exception:
+        cache.delete(REFRESH_LOCK_KEY)
+        _refresh_lock.release()
+        raise
+    return True
+
+
+def get_external_agencies(url):
+    """
+    Return the external agencies without blocking on the network.
+    Returns tuple: (agencies_list, source)
+    """
+    entry = _load_entry()
+    if entry is None:
+        schedule_refresh(url)
+        return [], 'internet_unavailable'
+
+    agencies = entry['agencies']
+    if time.time() - entry.get('fetched_at', 0) < _fresh_seconds():
+        return agencies, 'internet_cached'
+
+    schedule_refresh(url)
+    return agencies, 'internet_stale'
@@ -0,0 +1,490 @@
+"""
+Precomputed nearest-agency grid over Ethiopia.
+
+Ethiopia's bounding box is cut into fixed cells (``AGENCY_GRID_CELL_SIZE``
+degrees). For every cell and agency type the ``AGENCY_GRID_DEPTH`` agencies
+nearest to the cell centre are stored in memory-mapped ``.npy`` arrays, so a
+"nearest X" query is one array read plus an exact re-rank of a handful of
+candidates. Results are only returned when they are provably the true
+nearest agencies (or every agency within a radius); otherwise callers fall
+back to the spatial index.
+
+A build lives in its own directory under ``AGENCY_GRID_DIR``, and the
+``CURRENT`` file names the live one, so readers never see a half-written
+grid. Rebuilds are incremental: only cells that listed a removed or moved
+agency, or that a new agency is closer to than their current candidates,
+are recomputed.
+"""
+
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .distance import EARTH_RADIUS_KM, haversine_km
+from .models import Agency
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy is not installed on every host
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# (south, west, north, east) in degrees
+ETHIOPIA_BOUNDS = (3.4, 33.0, 14.9, 48.0)
+
+EMPTY = 0xFFFFFFFF
+REBUILD_LOCK_KEY = 'agency_grid_rebuild_lock'
+
+# Rebuild from scratch once this share of the agency table is tombstones
+MAX_TOMBSTONE_RATIO = 0.5
+
+# Distance matrix elements computed at once when filling cells
+FILL_CHUNK_ELEMENTS = 1 << 22
+
+
+def grid_dir():
+    default = os.path.join(settings.BASE_DIR, 'tmp', 'agency_grid')
+    return getattr(settings, 'AGENCY_GRID_DIR', default)
+
+
+def _types():
+    return [agency_type for agency_type, _ in Agency.AGENCY_TYPES]
+
+
+class NearestGrid:
+    """
+    One build of the grid.
+
+    ``ids`` and ``distances`` have shape ``(rows, cols, types, depth)``:
+    ``ids`` holds indexes into ``agencies`` (``EMPTY`` for unused slots)
+    and ``distances`` the km from the cell centre, closest first.
+    ``agencies`` is the grid's own table of ``[id, lat, lng, type]``
+    entries; removed agencies leave ``None`` so indexes stay stable
+    across incremental rebuilds.
+    """
+
+    def __init__(self, meta, ids, distances):
+        self.version = meta['version']
+        self.cell_size = meta['cell_size']
+        self.bounds = tuple(meta['bounds'])
+        self.depth = meta['depth']
+        self.types = meta['types']
+        self.type_index = {agency_type: i for i, agency_type in enumerate(self.types)}
+        self.agencies = meta['agencies']
+        self.ids = ids
+        self.distances = distances
+        self.rows, self.cols = ids.shape[:2]
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        distances = np.load(os.path.join(path, 'distances.npy'), mmap_mode='r')
+        return cls(meta, ids, distances)
+
+    def cell(self, latitude, longitude):
+        """Return the ``(row, col)`` containing the point, or None outside the grid."""
+        south, west, _, _ = self.bounds
+        row = math.floor((latitude - south) / self.cell_size)
+        col = math.floor((longitude - west) / self.cell_size)
+        if 0 <= row < self.rows and 0 <= col < self.cols:
+            return row, col
+        return None
+
+    def center(self, row, col):
+        south, west, _, _ = self.bounds
+        return south + (row + 0.5) * self.cell_size, west + (col + 0.5) * self.cell_size
+
+    def _half_diagonal_km(self, row, col):
+        latitude, longitude = self.center(row, col)
+        half = self.cell_size / 2
+        return max(
+            haversine_km(latitude, longitude, latitude + half, longitude + half),
+            haversine_km(latitude, longitude, latitude - half, longitude + half),
+        )
+
+    def nearest(self, latitude, longitude, agency_type, k):
+        """
+        Return up to ``k`` ``(distance_km, agency_id)`` pairs closest to the
+        point, or None when the grid cannot guarantee the answer (outside the
+        grid, unknown type, or ``k`` too close to the stored depth).
+        """
+        cell = self.cell(latitude, longitude)
+        type_index = self.type_index.get(agency_type)
+        if cell is None or type_index is None or k > self.depth:
+            return None
+
+        row, col = cell
+        slots = self.ids[row, col, type_index]
+        matches = []
+        for slot in slots:
+            if slot == EMPTY:
+                break
+            agency_id, agency_lat, agency_lng, _ = self.agencies[slot]
+            matches.append(
+                (haversine_km(latitude, longitude, agency_lat, agency_lng), agency_id)
+            )
+        matches.sort()
+        matches = matches[:k]
+
+        if len(slots) and slots[-1] != EMPTY and len(matches) == k:
+            # Anything not stored is at least ``worst`` from the centre, so at
+            # least ``worst - h`` from the point; the k-th match must beat that
+            worst = float(self.distances[row, col, type_index, -1])
+            if matches[-1][0] + self._half_diagonal_km(row, col) > worst:
+                return None
+        return matches
+
+    def within_radius(self, latitude, longitude, radius_km, agency_type):
+        """
+        Return the ``(distance_km, agency_id)`` pairs of ``agency_type``
+        within ``radius_km`` of the point, closest first, or None when the
+        grid cannot guarantee that no other agency is inside the radius.
+        """
+        cell = self.cell(latitude, longitude)
+        type_index = self.type_index.get(agency_type)
+        if cell is None or type_index is None:
+            return None
+
+        row, col = cell
+        slots = self.ids[row, col, type_index]
+        if len(slots) and slots[-1] != EMPTY:
+            # Agencies not stored are at least ``worst - h`` from the point
+            worst = float(self.distances[row, col, type_index, -1])
+            if radius_km >= worst - self._half_diagonal_km(row, col):
+                return None
+
+        matches = []
+        for slot in slots:
+            if slot == EMPTY:
+                break
+            agency_id, agency_lat, agency_lng, _ = self.agencies[slot]
+            distance = haversine_km(latitude, longitude, agency_lat, agency_lng)
+            if distance <= radius_km:
+                matches.append((distance, agency_id))
+        matches.sort()
+        return matches
+
+
+def _cell_centers(rows, cols, bounds, cell_size):
+    south, west, _, _ = bounds
+    lats = south + (np.arange(rows) + 0.5) * cell_size
+    lngs = west + (np.arange(cols) + 0.5) * cell_size
+    return np.meshgrid(lats, lngs, indexing='ij')
+
+
+def _haversine_grid(lat_grid, lng_grid, latitude, longitude):
+    lat1 = np.radians(lat_grid)
+    lat2 = math.radians(latitude)
+    dlat = lat2 - lat1
+    dlng = math.radians(longitude) - np.radians(lng_grid)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * math.cos(lat2) * np.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _agency_entry(agency):
+    try:
+        return [
+            str(agency['id']),
+            float(agency['latitude']),
+            float(agency['longitude']),
+            agency.get('type'),
+        ]
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _fill_cells(grid, cells):
+    """
+    Recompute the ``(row, col, type_index)`` cells in ``cells``.
+
+    Distances from each cell centre to every agency of the cell's type are
+    computed as one matrix per chunk of cells, and ``argpartition`` picks
+    the nearest ``depth`` of each row.
+    """
+    if not len(cells):
+        return
+    cells = np.asarray(cells, dtype=np.int64)
+    table = [(i, entry) for i, entry in enumerate(grid.agencies) if entry]
+    south, west, _, _ = grid.bounds
+
+    for type_index, agency_type in enumerate(grid.types):
+        selected = cells[cells[:, 2] == type_index]
+        if not len(selected):
+            continue
+        candidates = [
+            (i, entry[1], entry[2]) for i, entry in table if entry[3] == agency_type
+        ]
+        grid.ids[selected[:, 0], selected[:, 1], type_index] = EMPTY
+        grid.distances[selected[:, 0], selected[:, 1], type_index] = np.inf
+        if not candidates:
+            continue
+
+        indexes = np.array([c[0] for c in candidates], dtype=np.uint32)
+        lat2 = np.radians(np.array([c[1] for c in candidates]))[None, :]
+        lng2 = np.radians(np.array([c[2] for c in candidates]))[None, :]
+        take = min(grid.depth, len(candidates))
+        chunk = max(1, FILL_CHUNK_ELEMENTS // len(candidates))
+
+        for start in range(0, len(selected), chunk):
+            rows = selected[start : start + chunk, 0]
+            cols = selected[start : start + chunk, 1]
+            lat1 = np.radians(south + (rows + 0.5) * grid.cell_size)[:, None]
+            lng1 = np.radians(west + (cols + 0.5) * grid.cell_size)[:, None]
+            a = (
+                np.sin((lat2 - lat1) / 2) ** 2
+                + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+            )
+            distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+            nearest = np.argpartition(distances, take - 1, axis=1)[:, :take]
+            nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+            grid.ids[rows, cols, type_index, :take] = indexes[
+                np.take_along_axis(nearest, order, axis=1)
+            ]
+            grid.distances[rows, cols, type_index, :take] = np.take_along_axis(
+                nearest_distances, order, axis=1
+            )
+
+
+def _full_build(snapshot, cell_size, depth):
+    south, west, north, east = ETHIOPIA_BOUNDS
+    rows = math.ceil((north - south) / cell_size)
+    cols = math.ceil((east - west) / cell_size)
+    types = _types()
+    entries = [entry for entry in map(_agency_entry, snapshot.agencies) if entry]
+    meta = {
+        'version': snapshot.version,
+        'cell_size': cell_size,
+        'bounds': ETHIOPIA_BOUNDS,
+        'depth': depth,
+        'types': types,
+        'agencies': entries,
+    }
+    shape = (rows, cols, len(types), depth)
+    grid = NearestGrid(
+        meta,
+        np.full(shape, EMPTY, dtype=np.uint32),
+        np.full(shape, np.inf, dtype=np.float32),
+    )
+    cells = np.argwhere(np.ones((rows, cols, len(types)), dtype=bool))
+    _fill_cells(grid, cells)
+    return grid, len(cells)
+
+
+def _incremental_build(snapshot, previous):
+    """
+    Update a copy of ``previous`` for the agencies in ``snapshot``.
+    Returns ``(grid, recomputed_cells)``, or None if a full build is better.
+    """
+    entries = [list(entry) if entry else None for entry in previous.agencies]
+    index_of = {entry[0]: i for i, entry in enumerate(entries) if entry}
+    current = {
+        entry[0]: entry for entry in map(_agency_entry, snapshot.agencies) if entry
+    }
+
+    removed = []
+    added = []
+    for agency_id, i in index_of.items():
+        if current.get(agency_id) != entries[i]:
+            removed.append(i)
+    for i in removed:
+        del index_of[entries[i][0]]
+    for agency_id, entry in current.items():
+        if agency_id not in index_of:
+            added.append(len(entries))
+            index_of[agency_id] = len(entries)
+            entries.append(entry)
+
+    for i in removed:
+        entries[i] = None
+    if entries and entries.count(None) > MAX_TOMBSTONE_RATIO * len(entries):
+        return None
+
+    meta = {
+        'version': snapshot.version,
+        'cell_size': previous.cell_size,
+        'bounds': previous.bounds,
+        'depth': previous.depth,
+        'types': previous.types,
+        'agencies': entries,
+    }
+    grid = NearestGrid(meta, np.array(previous.ids), np.array(previous.distances))
+
+    affected = np.zeros(grid.ids.shape[:3], dtype=bool)
+    if removed:
+        affected |= np.isin(grid.ids, np.array(removed, dtype=np.uint32)).any(axis=-1)
+    if added:
+        lat_grid, lng_grid = _cell_centers(
+            grid.rows, grid.cols, grid.bounds, grid.cell_size
+        )
+        for i in added:
+            _, latitude, longitude, agency_type = entries[i]
+            type_index = grid.type_index.get(agency_type)
+            if type_index is None:
+                continue
+            distances = _haversine_grid(lat_grid, lng_grid, latitude, longitude)
+            affected[:, :, type_index] |= (
+                distances < grid.distances[:, :, type_index, -1]
+            )
+
+    cells = np.argwhere(affected)
+    _fill_cells(grid, cells)
+    logger.debug(f"Agency grid: {len(removed)} removed/moved, {len(added)} added")
+    return grid, len(cells)
+
+
+def _save(grid):
+    """Write ``grid`` to a new build directory and make it the current one."""
+    base = grid_dir()
+    os.makedirs(base, exist_ok=True)
+    path = tempfile.mkdtemp(dir=base, prefix=f'build-{grid.version}-')
+    np.save(os.path.join(path, 'ids.npy'), grid.ids)
+    np.save(os.path.join(path, 'distances.npy'), grid.distances)
+    meta = {
+        'version': grid.version,
+        'cell_size': grid.cell_size,
+        'bounds': list(grid.bounds),
+        'depth': grid.depth,
+        'types': grid.types,
+        'agencies': grid.agencies,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+    fd, pointer = tempfile.mkstemp(dir=base, prefix='.CURRENT.')
+    with os.fdopen(fd, 'w') as f:
+        f.write(os.path.basename(path))
+    os.replace(pointer, os.path.join(base, 'CURRENT'))
+
+    # Open readers keep their memory maps of older builds; drop the directories
+    for name in os.listdir(base):
+        if name.startswith('build-') and name != os.path.basename(path):
+            shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+    return path
+
+
+def _current_path():
+    base = grid_dir()
+    try:
+        with open(os.path.join(base, 'CURRENT')) as f:
+            return os.path.join(base, f.read().strip())
+    except OSError:
+        return None
+
+
+def build_nearest_grid(snapshot, full=False, cell_size=None, depth=None):
+    """
+    Build the grid for ``snapshot``, incrementally from the current build
+    unless ``full`` is set or the cell size/depth change.
+    Returns ``(path, recomputed_cells, incremental)``.
+    """
+    if np is None:
+        raise RuntimeError("NumPy is required to build the agency grid")
+    cell_size = cell_size or getattr(settings, 'AGENCY_GRID_CELL_SIZE', 0.05)
+    depth = depth or getattr(settings, 'AGENCY_GRID_DEPTH', 8)
+
+    result = None
+    previous_path = _current_path()
+    if not full and previous_path:
+        try:
+            previous = NearestGrid.load(previous_path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable agency grid at {previous_path}: {e}")
+            previous = None
+        if (
+            previous is not None
+            and previous.cell_size == cell_size
+            and previous.depth == depth
+            and previous.types == _types()
+            and tuple(previous.bounds) == ETHIOPIA_BOUNDS
+        ):
+            result = _incremental_build(snapshot, previous)
+
+    incremental = result is not None
+    grid, recomputed = (
+        result if incremental else _full_build(snapshot, cell_size, depth)
+    )
+    path = _save(grid)
+    logger.info(
+        f"Built agency grid {grid.version} "
+        f"({'incremental' if incremental else 'full'}, "
+        f"{recomputed} cells recomputed) at {path}"
+    )
+    return path, recomputed, incremental
+
+
+_grid = None
+_grid_path = None
+_checked_at = 0.0
+_rebuild_lock = threading.Lock()
+
+
+def _rebuild_in_background(snapshot):
+    try:
+        build_nearest_grid(snapshot)
+    except Exception as e:
+        logger.error(f"Agency grid rebuild failed: {e}")
+    finally:
+        cache.delete(REBUILD_LOCK_KEY)
+        _rebuild_lock.release()
+
+
+def _schedule_rebuild(snapshot):
+    if not _rebuild_lock.acquire(blocking=False):
+        return
+    if not cache.add(REBUILD_LOCK_KEY, True, 600):
+        _rebuild_lock.release()
+        return
+    threading.Thread(
+        target=_rebuild_in_background,
+        args=(snapshot,),
+        name='agency-grid-rebuild',
+        daemon=True,
+    ).start()
+
+
+def get_nearest_grid(snapshot):
+    """
+    Return the grid built for ``snapshot``'s dataset version, or None.
+
+    The ``CURRENT`` build is re-read at most every
+    ``AGENCY_SNAPSHOT_CHECK_INTERVAL`` seconds. Once a grid has been built
+    with ``manage.py build_nearest_grid``, a grid for an older version
+    triggers one incremental rebuild in the background.
+    """
+    global _grid, _grid_path, _checked_at
+    if np is None:
+        return None
+
+    interval = getattr(settings, 'AGENCY_SNAPSHOT_CHECK_INTERVAL', 5)
+    if time.monotonic() - _checked_at >= interval:
+        _checked_at = time.monotonic()
+        path = _current_path()
+        if path != _grid_path:
+            try:
+                _grid = NearestGrid.load(path) if path else None
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not load agency grid at {path}: {e}")
+                _grid = None
+            _grid_path = path
+
+    grid = _grid
+    if grid is None:
+        return None
+    if grid.version != snapshot.version:
+        if getattr(settings, 'AGENCY_GRID_AUTO_REBUILD', True):
+            _schedule_rebuild(snapshot)
+        return None
+    return grid
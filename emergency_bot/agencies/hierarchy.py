@@ -0,0 +1,143 @@
+"""
+Administrative hierarchy index (region > zone > woreda > kebele) over agencies.
+"""
+
+LEVELS = ('region', 'zone', 'woreda', 'kebele')
+
+
+def fold(value):
+    """Normalize a location name for case-insensitive lookups."""
+    return str(value).strip().casefold()
+
+
+def matches(agency, **filters):
+    """
+    Return True when ``agency`` lies in the location given by the ``LEVELS``
+    keyword filters.
+    """
+    for level in LEVELS:
+        value = filters.get(level)
+        if not value:
+            continue
+        # Agencies without a region are listed under 'Unknown', as in the index
+        actual = agency.get(level) or ('Unknown' if level == 'region' else None)
+        if actual is None or fold(actual) != fold(value):
+            return False
+    return True
+
+
+class HierarchyNode:
+    """
+    One region, zone, woreda or kebele.
+
+    ``positions`` lists the snapshot positions of every agency located in
+    this node or below it and ``child_names`` holds the display names of the
+    children, pre-sorted.
+    """
+
+    __slots__ = ('name', 'children', 'positions', 'child_names')
+
+    def __init__(self, name):
+        self.name = name
+        self.children = {}
+        self.positions = []
+        self.child_names = []
+
+
+class HierarchyIndex:
+    """
+    Nested dictionary index keyed by case-folded location names.
+
+    Cascading dropdowns walk the tree, and filtered search intersects the
+    per-level position sets, so neither needs to scan the agency list.
+    Agencies are referred to by their position in the snapshot: those from
+    the internet or fallback sources may have no id, or share one.
+    """
+
+    def __init__(self, agencies):
+        self.agencies = agencies
+        self.root = HierarchyNode(None)
+        # level -> folded name -> set of positions, for filters that skip a level
+        self.by_level = {level: {} for level in LEVELS}
+
+        for position, agency in enumerate(agencies):
+            node = self.root
+            node.positions.append(position)
+            for level in LEVELS:
+                value = agency.get(level)
+                if not value:
+                    if level != 'region':
+                        # Deeper levels still go into by_level, but not the tree
+                        node = None
+                        continue
+                    value = 'Unknown'
+                key = fold(value)
+                self.by_level[level].setdefault(key, set()).add(position)
+                if node is not None:
+                    child = node.children.get(key)
+                    if child is None:
+                        child = node.children[key] = HierarchyNode(value)
+                    child.positions.append(position)
+                    node = child
+
+        self._sort(self.root)
+
+    def _sort(self, node):
+        node.child_names = sorted(child.name for child in node.children.values())
+        for child in node.children.values():
+            self._sort(child)
+
+    def find(self, *path):
+        """Return the node at ``path`` (region, zone, ...) or None."""
+        node = self.root
+        for name in path:
+            node = node.children.get(fold(name))
+            if node is None:
+                return None
+        return node
+
+    def children(self, *path):
+        """Return the sorted child names of the node at ``path``."""
+        node = self.find(*path)
+        return list(node.child_names) if node else []
+
+    def regions(self):
+        """Return ``(name, agency_count)`` pairs for every region, sorted by name."""
+        return sorted(
+            ((node.name, len(node.positions)) for node in self.root.children.values()),
+            key=lambda item: item[0],
+        )
+
+    def filter_positions(self, **filters):
+        """
+        Return the snapshot positions of the agencies matching every given
+        location filter, in snapshot order.
+
+        Filters are keyword arguments named after ``LEVELS``; empty values are
+        ignored. The list may be shared with the index and must not be modified.
+        """
+        active = [(level, filters.get(level)) for level in LEVELS if filters.get(level)]
+        if not active:
+            return self.root.positions
+
+        # A contiguous prefix of levels is answered straight from the tree
+        prefix = []
+        for level, value in active:
+            if level != LEVELS[len(prefix)]:
+                break
+            prefix.append(value)
+        if len(prefix) == len(active):
+            node = self.find(*prefix)
+            return node.positions if node else []
+
+        position_sets = sorted(
+            (self.by_level[level].get(fold(value), set()) for level, value in active),
+            key=len,
+        )
+        return sorted(set(position_sets[0]).intersection(*position_sets[1:]))
+
+    def filter(self, **filters):
+        """Return the agencies matching every location filter, in snapshot order."""
+        return [
+            self.agencies[position] for position in self.filter_positions(**filters)
+        ]
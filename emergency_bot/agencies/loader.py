@@ -0,0 +1,243 @@
+"""
+Streaming bulk loader for agency fixtures and CSV files.
+
+Files are read record by record, so memory use does not grow with the file,
+and validated rows are written with ``bulk_create``/``bulk_update`` one
+transaction per batch instead of one ``save()`` per agency.
+"""
+
+import csv
+import json
+import logging
+import re
+import time
+import uuid
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Agency
+from .sync import SYNC_FIELDS, agency_values, base_slug, dataset_changed, unique_slugs
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+CHUNK_SIZE = 1 << 16
+
+# Validation errors kept for the report; the rest are only counted
+MAX_REPORTED_ERRORS = 20
+
+_WHITESPACE = re.compile(r'[\s,]*')
+
+
+def iter_json_records(fileobj, chunk_size=CHUNK_SIZE):
+    """
+    Yield the objects of a JSON array (or newline-delimited JSON) one at a
+    time, reading ``fileobj`` in chunks of ``chunk_size`` characters.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    in_array = None
+    eof = False
+    while True:
+        pos = _WHITESPACE.match(buffer, pos).end()
+        if pos < len(buffer):
+            if in_array is None:
+                in_array = buffer[pos] == '['
+                if in_array:
+                    pos += 1
+                continue
+            if in_array and buffer[pos] == ']':
+                return
+            try:
+                record, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise ValueError(f"Invalid JSON: {e}")
+            else:
+                yield record
+                continue
+        elif eof:
+            return
+
+        chunk = fileobj.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def iter_csv_records(fileobj):
+    """Yield each CSV row as a dict keyed by the header row."""
+    yield from csv.DictReader(fileobj)
+
+
+def open_records(path, file_format=None):
+    """
+    Open ``path`` and return ``(file, records_iterator)``.
+    The format is taken from the extension unless ``file_format`` is given.
+    """
+    file_format = file_format or ('csv' if path.lower().endswith('.csv') else 'json')
+    if file_format == 'csv':
+        fileobj = open(path, newline='', encoding='utf-8-sig')
+        return fileobj, iter_csv_records(fileobj)
+    fileobj = open(path, encoding='utf-8-sig')
+    return fileobj, iter_json_records(fileobj)
+
+
+def prepare_row(record):
+    """
+    Validate one record and return the ``Agency`` field values to store.
+
+    Accepts plain agency dicts and Django fixture entries
+    (``{"model": ..., "pk": ..., "fields": {...}}``). Rows are keyed by
+    their id when they carry one and by their slug otherwise.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("record is not an object")
+    pk = record.get('pk')
+    if isinstance(record.get('fields'), dict):
+        record = record['fields']
+    pk = pk or record.get('id')
+
+    values = agency_values(record)
+    values['slug'] = record.get('slug') or base_slug(values)
+    if record.get('external_id'):
+        values['external_id'] = str(record['external_id'])
+    if pk:
+        try:
+            values['id'] = uuid.UUID(str(pk))
+        except ValueError:
+            raise ValueError(f"invalid id {pk!r}")
+    values['key'] = str(values['id']) if pk else values['slug']
+    return values
+
+
+class LoadStats:
+    """Counters and timing for one load."""
+
+    def __init__(self):
+        self.read = 0
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.invalid = 0
+        self.batches = 0
+        self.errors = []
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        return self.read / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"{self.read} rows in {self.elapsed:.2f}s ({self.rate:.0f} rows/s): "
+            f"{self.created} created, {self.updated} updated, "
+            f"{self.unchanged} unchanged, {self.invalid} invalid"
+        )
+
+
+def write_batch(rows, update_existing=True):
+    """
+    Insert or update one batch of prepared rows in a single transaction.
+    Returns ``(created, updated, unchanged)`` counts.
+    """
+    # Later rows for the same key win, as they would with row-by-row saves
+    rows = list({row['key']: row for row in rows}.values())
+    ids = [row['id'] for row in rows if 'id' in row]
+    slugs = [row['slug'] for row in rows if 'id' not in row]
+
+    existing = {}
+    if ids:
+        for agency in Agency.objects.filter(pk__in=ids).only('id', 'content_hash'):
+            existing[str(agency.pk)] = agency
+    if slugs:
+        for agency in Agency.objects.filter(slug__in=slugs).only(
+            'id', 'slug', 'content_hash'
+        ):
+            existing[agency.slug] = agency
+
+    now = timezone.now()
+    to_create = []
+    to_update = []
+    update_fields = set(SYNC_FIELDS) | {'content_hash', 'updated_at'}
+    for row in rows:
+        agency = existing.get(row['key'])
+        if agency is None:
+            to_create.append(row)
+        elif update_existing and agency.content_hash != row['content_hash']:
+            for field in SYNC_FIELDS + ('content_hash',):
+                setattr(agency, field, row[field])
+            if 'external_id' in row:
+                agency.external_id = row['external_id']
+                update_fields.add('external_id')
+            agency.updated_at = now
+            to_update.append(agency)
+
+    if not to_create and not to_update:
+        return 0, 0, len(rows)
+
+    with transaction.atomic():
+        if to_create:
+            slugs = unique_slugs(to_create, 'key')
+            new_agencies = []
+            for row in to_create:
+                values = {
+                    field: value for field, value in row.items() if field != 'key'
+                }
+                values['slug'] = slugs[row['key']]
+                agency = Agency(**values)
+                agency.created_at = agency.updated_at = now
+                new_agencies.append(agency)
+            Agency.objects.bulk_create(new_agencies)
+        if to_update:
+            Agency.objects.bulk_update(to_update, sorted(update_fields))
+        transaction.on_commit(dataset_changed)
+
+    return len(to_create), len(to_update), len(rows) - len(to_create) - len(to_update)
+
+
+def load_agencies(
+    records, batch_size=DEFAULT_BATCH_SIZE, update_existing=True, progress=None
+):
+    """
+    Validate and bulk-write ``records`` in batches of ``batch_size``.
+
+    Invalid rows are counted and skipped. ``update_existing=False`` leaves
+    agencies that already exist untouched. ``progress`` is called with the
+    ``LoadStats`` after every batch. Returns the ``LoadStats``.
+    """
+    stats = LoadStats()
+    batch = []
+
+    def flush():
+        created, updated, unchanged = write_batch(batch, update_existing)
+        stats.created += created
+        stats.updated += updated
+        stats.unchanged += unchanged
+        stats.batches += 1
+        batch.clear()
+        if progress:
+            progress(stats)
+
+    for number, record in enumerate(records, 1):
+        stats.read += 1
+        try:
+            batch.append(prepare_row(record))
+        except ValueError as e:
+            stats.invalid += 1
+            if len(stats.errors) < MAX_REPORTED_ERRORS:
+                stats.errors.append(f"record {number}: {e}")
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    logger.info(f"Loaded agencies: {stats.summary()}")
+    return stats
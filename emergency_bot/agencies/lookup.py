@@ -0,0 +1,78 @@
+"""
+Keyed agency lookups by id and slug.
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.text import slugify
+
+
+def agency_keys(agency):
+    """Return the keys an agency dict can be looked up by: its id and slug."""
+    keys = [str(agency.get('id'))]
+    slug = agency.get('slug') or slugify(
+        f"{agency.get('name', '')}-{agency.get('region', '')}"
+    )
+    if slug and slug not in keys:
+        keys.append(slug)
+    return keys
+
+
+def build_key_map(agencies):
+    """Map every id and slug in ``agencies`` to its agency dict."""
+    key_map = {}
+    for agency in agencies:
+        for key in agency_keys(agency):
+            key_map.setdefault(key, agency)
+    return key_map
+
+
+class LRUCache:
+    """
+    Small thread-safe least-recently-used cache.
+
+    Entries are tied to an agency dataset version; ``bind_version`` drops
+    them all when the version moves on, so other processes' changes are
+    picked up as soon as this process sees a new snapshot.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def bind_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+
+# (agency, source) pairs resolved by find_agency outside the snapshot, keyed by id
+# and slug
+agency_cache = LRUCache(getattr(settings, 'AGENCY_DETAIL_CACHE_SIZE', 1024))
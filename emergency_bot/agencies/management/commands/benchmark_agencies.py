@@ -0,0 +1,342 @@
+"""
+Management command to benchmark the agencies API hot paths.
+Usage: python manage.py benchmark_agencies [--sizes 1000,10000,100000]
+                                           [--iterations 200] [--output FILE]
+
+Runs against a throwaway test database filled with synthetic agencies
+scattered around real Ethiopian towns, so the configured database is
+never touched. Each case reports p50/p95/p99 latency, queries per call
+and traced allocations, and the results are written to a JSON file that
+can be diffed between runs.
+"""
+
+import json
+import math
+import platform
+import random
+import time
+import tracemalloc
+import uuid
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext,
+    override_settings,
+    setup_test_environment,
+    teardown_test_environment,
+)
+from django.utils import timezone
+
+from emergency_bot.agencies import views
+from emergency_bot.agencies.models import Agency
+from emergency_bot.agencies.sync import dataset_changed
+
+# (town, region, zone, latitude, longitude)
+TOWNS = [
+    ('Addis Ababa', 'Addis Ababa', 'Bole', 9.0054, 38.7636),
+    ('Adama', 'Oromia', 'East Shewa', 8.5400, 39.2700),
+    ('Bishoftu', 'Oromia', 'East Shewa', 8.7500, 38.9833),
+    ('Jimma', 'Oromia', 'Jimma', 7.6667, 36.8333),
+    ('Nekemte', 'Oromia', 'East Wollega', 9.0833, 36.5500),
+    ('Shashemene', 'Oromia', 'West Arsi', 7.2000, 38.6000),
+    ('Bahir Dar', 'Amhara', 'West Gojjam', 11.5936, 37.3908),
+    ('Gondar', 'Amhara', 'Central Gondar', 12.6000, 37.4667),
+    ('Dessie', 'Amhara', 'South Wollo', 11.1333, 39.6333),
+    ('Debre Markos', 'Amhara', 'East Gojjam', 10.3333, 37.7167),
+    ('Mekelle', 'Tigray', 'Mekelle', 13.4969, 39.4769),
+    ('Hawassa', 'Sidama', 'Hawassa', 7.0500, 38.4667),
+    ('Arba Minch', 'South Ethiopia', 'Gamo', 6.0333, 37.5500),
+    ('Hosaena', 'Central Ethiopia', 'Hadiya', 7.5500, 37.8500),
+    ('Dire Dawa', 'Dire Dawa', 'Dire Dawa', 9.6000, 41.8500),
+    ('Harar', 'Harari', 'Harar', 9.3100, 42.1200),
+    ('Jijiga', 'Somali', 'Fafan', 9.3500, 42.8000),
+    ('Semera', 'Afar', 'Awsi Rasu', 11.7922, 41.0086),
+    ('Gambela', 'Gambela', 'Anuak', 8.2500, 34.5833),
+    ('Assosa', 'Benishangul-Gumuz', 'Asosa', 10.0667, 34.5333),
+]
+
+SERVICE_WORDS = [
+    'Emergency response',
+    'Crime reporting',
+    'Maternity care',
+    'Counseling',
+    'Legal aid',
+    'Temporary shelter',
+    'Ambulance',
+    'Child protection',
+    'Trauma care',
+    'Family support',
+]
+
+# Cases that load or rebuild the whole dataset run this many times at most
+HEAVY_ITERATIONS = 5
+ALLOCATION_SAMPLES = 10
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def synthetic_agencies(count, seed):
+    """Yield ``count`` unsaved agencies scattered around real Ethiopian towns."""
+    rng = random.Random(seed)
+    types = [agency_type for agency_type, _ in Agency.AGENCY_TYPES]
+    now = timezone.now()
+    for i in range(count):
+        town, region, zone, latitude, longitude = rng.choice(TOWNS)
+        agency_type = rng.choice(types)
+        name = f'{town} {agency_type.title()} {i}'
+        agency = Agency(
+            id=uuid.UUID(int=rng.getrandbits(128), version=4),
+            name=name,
+            slug=f'benchmark-{i}',
+            type=agency_type,
+            description=(
+                f'{agency_type.title()} serving {town} and the surrounding kebeles'
+            ),
+            region=region,
+            zone=zone,
+            woreda=f'{rng.randint(1, 12):02d}',
+            kebele=f'{rng.randint(1, 20):02d}',
+            phone=f'+2511{rng.randint(10000000, 99999999)}',
+            address=f'{town}, {zone}, {region}',
+            latitude=latitude + rng.gauss(0, 0.08),
+            longitude=longitude + rng.gauss(0, 0.08),
+            hours_of_operation='24/7',
+            services=', '.join(rng.sample(SERVICE_WORDS, 3)),
+            verified=rng.random() < 0.7,
+        )
+        agency.created_at = agency.updated_at = now
+        yield agency
+
+
+class Command(BaseCommand):
+    help = 'Benchmark agency endpoints and functions on synthetic 1k/10k/100k datasets'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default='1000,10000,100000', help='Comma separated dataset sizes'
+        )
+        parser.add_argument(
+            '--iterations', type=int, default=200, help='Timed calls per case'
+        )
+        parser.add_argument(
+            '--warmup', type=int, default=10, help='Untimed calls per case'
+        )
+        parser.add_argument('--seed', type=int, default=2024)
+        parser.add_argument(
+            '--output', default='agencies-benchmark.json', help='JSON results file'
+        )
+        parser.add_argument(
+            '--noinput', '--no-input', action='store_false', dest='interactive'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',') if size.strip()]
+        except ValueError:
+            raise CommandError('--sizes must be a comma separated list of integers')
+        if not sizes or min(sizes) < 1 or options['iterations'] < 1:
+            raise CommandError('Sizes and --iterations must be positive')
+
+        self.iterations = options['iterations']
+        self.warmup = options['warmup']
+        self.rng = random.Random(options['seed'])
+
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(
+            verbosity=0,
+            autoclobber=not options['interactive'],
+            serialize=False,
+        )
+        try:
+            with override_settings(
+                AGENCY_GRID_AUTO_REBUILD=False, AGENCY_SNAPSHOT_CHECK_INTERVAL=3600
+            ):
+                results = {}
+                for size in sizes:
+                    self.stdout.write(f'Loading {size} synthetic agencies...')
+                    self.load_dataset(size, options['seed'])
+                    results[str(size)] = self.run_cases()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'generated_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'iterations': self.iterations,
+            'seed': options['seed'],
+            'results': results,
+        }
+        with open(options['output'], 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+    def load_dataset(self, size, seed):
+        Agency.objects.all().delete()
+        Agency.objects.bulk_create(synthetic_agencies(size, seed), batch_size=1000)
+        dataset_changed()
+        # Build the snapshot now so the cases measure the warm path
+        views.get_agencies_snapshot()
+
+    def random_point(self):
+        _, _, _, latitude, longitude = self.rng.choice(TOWNS)
+        return latitude + self.rng.gauss(0, 0.05), longitude + self.rng.gauss(0, 0.05)
+
+    def cases(self):
+        """Return ``(name, callable, heavy)`` for every benchmarked case."""
+        client = Client()
+        snapshot = views.get_agencies_snapshot()
+        town = self.rng.choice(TOWNS)
+
+        def get(path):
+            def call():
+                response = client.get(path() if callable(path) else path)
+                if response.status_code != 200:
+                    raise CommandError(
+                        f'{response.status_code} from {response.request["PATH_INFO"]}'
+                    )
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                return response
+
+            return call
+
+        def nearby_path():
+            latitude, longitude = self.random_point()
+            return (
+                f'/api/v1/agencies/nearby/?lat={latitude}&lng={longitude}'
+                '&max_distance=10&user_id=1'
+            )
+
+        def nearest_path():
+            latitude, longitude = self.random_point()
+            return (
+                f'/api/v1/agencies/nearest/?lat={latitude}&lng={longitude}'
+                '&k=3&user_id=1'
+            )
+
+        def nearest_function():
+            latitude, longitude = self.random_point()
+            return views.find_nearest_by_type(latitude, longitude, k=3)
+
+        def within_radius_function():
+            latitude, longitude = self.random_point()
+            return snapshot.spatial_index.within_radius(latitude, longitude, 10)
+
+        def rebuild_snapshot():
+            dataset_changed()
+            return views.get_agencies_snapshot()
+
+        return [
+            ('http.nearby', get(nearby_path), False),
+            ('http.nearest', get(nearest_path), False),
+            (
+                'http.search.region',
+                get(f'/api/v1/agencies/search/?region={town[1]}&user_id=1'),
+                False,
+            ),
+            (
+                'http.search.text',
+                get('/api/v1/agencies/search/?q=matern%20hosp&user_id=1'),
+                False,
+            ),
+            (
+                'http.regions',
+                get('/api/v1/agencies/locations/regions/?user_id=1'),
+                False,
+            ),
+            (
+                'http.zones',
+                get(f'/api/v1/agencies/locations/zones/?region={town[1]}&user_id=1'),
+                False,
+            ),
+            (
+                'http.woredas',
+                get(
+                    f'/api/v1/agencies/locations/woredas/?region={town[1]}'
+                    f'&zone={town[2]}&user_id=1'
+                ),
+                False,
+            ),
+            ('http.all', get('/api/v1/agencies/all/?user_id=1'), False),
+            ('http.all.page', get('/api/v1/agencies/all/?limit=100&user_id=1'), False),
+            (
+                'http.all.ndjson',
+                get('/api/v1/agencies/all/?format=ndjson&user_id=1'),
+                True,
+            ),
+            ('fn.find_nearest_by_type', nearest_function, False),
+            ('fn.spatial_within_radius', within_radius_function, False),
+            (
+                'fn.hierarchy_filter',
+                lambda: snapshot.hierarchy.filter(region=town[1], zone=town[2]),
+                False,
+            ),
+            (
+                'fn.search_index',
+                lambda: snapshot.search_index.search('police', limit=20),
+                False,
+            ),
+            ('fn.get_agencies_with_fallback', views.get_agencies_with_fallback, True),
+            ('fn.snapshot_rebuild', rebuild_snapshot, True),
+        ]
+
+    def run_cases(self):
+        results = {}
+        for name, call, heavy in self.cases():
+            iterations = (
+                min(self.iterations, HEAVY_ITERATIONS) if heavy else self.iterations
+            )
+            for _ in range(0 if heavy else self.warmup):
+                call()
+
+            timings = []
+            queries = 0
+            for _ in range(iterations):
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    call()
+                    timings.append((time.perf_counter() - started) * 1000)
+                queries += len(captured)
+
+            peaks = []
+            retained = []
+            for _ in range(min(iterations, ALLOCATION_SAMPLES)):
+                tracemalloc.start()
+                before = tracemalloc.get_traced_memory()[0]
+                call()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                peaks.append(peak - before)
+                retained.append(current - before)
+
+            timings.sort()
+            results[name] = {
+                'iterations': iterations,
+                'p50_ms': round(percentile(timings, 0.50), 3),
+                'p95_ms': round(percentile(timings, 0.95), 3),
+                'p99_ms': round(percentile(timings, 0.99), 3),
+                'mean_ms': round(sum(timings) / len(timings), 3),
+                'queries_per_call': round(queries / iterations, 2),
+                'peak_alloc_kb': round(max(peaks) / 1024, 1),
+                'retained_alloc_kb': round(sum(retained) / len(retained) / 1024, 1),
+            }
+            result = results[name]
+            self.stdout.write(
+                f"  {name:<30} p50 {result['p50_ms']:>9.3f}ms  "
+                f"p95 {result['p95_ms']:>9.3f}ms  p99 {result['p99_ms']:>9.3f}ms  "
+                f"{result['queries_per_call']:>5} q  "
+                f"{result['peak_alloc_kb']:>9.1f} KB peak"
+            )
+        return results
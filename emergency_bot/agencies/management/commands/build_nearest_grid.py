@@ -0,0 +1,60 @@
+"""
+Management command to build the precomputed nearest-agency grid.
+Usage: python manage.py build_nearest_grid [--full] [--cell-size DEG] [--depth N]
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.agencies.grid import build_nearest_grid
+from emergency_bot.agencies.views import get_agencies_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Build (or incrementally update) the nearest-agency grid over Ethiopia'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rebuild every cell instead of only changed ones',
+        )
+        parser.add_argument(
+            '--cell-size',
+            type=float,
+            help='Cell size in degrees (default AGENCY_GRID_CELL_SIZE)',
+        )
+        parser.add_argument(
+            '--depth',
+            type=int,
+            help='Agencies stored per cell and type (default AGENCY_GRID_DEPTH)',
+        )
+
+    def handle(self, *args, **options):
+        if options['cell_size'] is not None and options['cell_size'] <= 0:
+            raise CommandError('--cell-size must be positive')
+        if options['depth'] is not None and options['depth'] < 1:
+            raise CommandError('--depth must be at least 1')
+
+        snapshot = get_agencies_snapshot()
+        started = time.monotonic()
+        try:
+            path, recomputed, incremental = build_nearest_grid(
+                snapshot,
+                full=options['full'],
+                cell_size=options['cell_size'],
+                depth=options['depth'],
+            )
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{'Updated' if incremental else 'Built'} grid for "
+                f"{len(snapshot)} agencies "
+                f"({snapshot.source}, version {snapshot.version}): "
+                f"{recomputed} cells recomputed "
+                f"in {time.monotonic() - started:.1f}s -> {path}"
+            )
+        )
@@ -0,0 +1,64 @@
+"""
+Management command to bulk load agencies from a JSON or CSV file.
+Usage: python manage.py load_agencies agencies_addis_ababa.json
+                                      [--batch-size N] [--no-update]
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.agencies.loader import (
+    DEFAULT_BATCH_SIZE,
+    load_agencies,
+    open_records,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Stream agencies from a JSON array, NDJSON or CSV file into the database '
+        'in batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='JSON (array or fixture), NDJSON or CSV file')
+        parser.add_argument(
+            '--format',
+            choices=('json', 'csv'),
+            help='File format (default: from extension)',
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            '--no-update',
+            action='store_true',
+            help='Leave agencies that already exist untouched',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        try:
+            fileobj, records = open_records(options['path'], options['format'])
+        except OSError as e:
+            raise CommandError(f"Cannot open {options['path']}: {e}")
+
+        verbosity = options['verbosity']
+
+        def progress(stats):
+            if verbosity > 1:
+                self.stdout.write(f"Batch {stats.batches}: {stats.summary()}")
+
+        try:
+            with fileobj:
+                stats = load_agencies(
+                    records,
+                    batch_size=options['batch_size'],
+                    update_existing=not options['no_update'],
+                    progress=progress,
+                )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for error in stats.errors:
+            self.stdout.write(self.style.WARNING(f'Skipped {error}'))
+        self.stdout.write(self.style.SUCCESS(f'Loaded {stats.summary()}'))
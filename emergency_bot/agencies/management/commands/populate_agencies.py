@@ -4,6 +4,7 @@ Usage: python manage.py populate_agencies
 """
 
 from django.core.management.base import BaseCommand
+from emergency_bot.agencies.loader import load_agencies
 from emergency_bot.agencies.models import Agency
 
 
@@ -385,25 +386,14 @@ class Command(BaseCommand):
             }
         ]
 
-        created_count = 0
-        for agency_data in agencies_data:
-            agency, created = Agency.objects.get_or_create(
-                name=agency_data['name'],
-                defaults=agency_data
-            )
-            if created:
-                created_count += 1
-                self.stdout.write(
-                    self.style.SUCCESS(f'Created: {agency.name}')
-                )
-            else:
-                self.stdout.write(
-                    self.style.WARNING(f'Already exists: {agency.name}')
-                )
+        stats = load_agencies(agencies_data, update_existing=False)
+        for error in stats.errors:
+            self.stdout.write(self.style.WARNING(f'Skipped {error}'))
 
         self.stdout.write(
             self.style.SUCCESS(
-                f'\nSuccessfully created {created_count} new agencies. '
+                f'\nSuccessfully created {stats.created} new agencies '
+                f'({stats.unchanged} already existed) in {stats.elapsed:.2f}s. '
                 f'Total agencies in database: {Agency.objects.count()}'
             )
-        )
\ No newline at end of file
+        )
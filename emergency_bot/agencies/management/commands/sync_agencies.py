@@ -0,0 +1,48 @@
+"""
+Management command to incrementally sync agencies from the external directory.
+Usage: python manage.py sync_agencies [--url URL] [--batch-size N] [--full]
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.agencies.sync import DEFAULT_BATCH_SIZE, sync_agencies
+
+
+class Command(BaseCommand):
+    help = 'Pull agencies changed since the last sync from the external directory'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', help='Directory URL (defaults to EXTERNAL_AGENCIES_API_URL)'
+        )
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Ignore the stored cursor and compare everything',
+        )
+
+    def handle(self, *args, **options):
+        url = options['url'] or getattr(settings, 'EXTERNAL_AGENCIES_API_URL', None)
+        if not url:
+            raise CommandError(
+                'No directory URL given and EXTERNAL_AGENCIES_API_URL is not set'
+            )
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        try:
+            totals = sync_agencies(
+                url, batch_size=options['batch_size'], full=options['full']
+            )
+        except Exception as e:
+            raise CommandError(f'Sync failed: {e}')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Fetched {totals['fetched']} records in {totals['batches']} batches: "
+                f"{totals['created']} created, {totals['updated']} updated, "
+                f"{totals['unchanged']} unchanged, {totals['skipped']} skipped"
+            )
+        )
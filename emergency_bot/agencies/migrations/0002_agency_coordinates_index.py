@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-17 00:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agencies', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agency',
+            index=models.Index(fields=['latitude', 'longitude'], name='agencies_ag_latitud_5bba1c_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2 on 2026-10-17 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agencies', '0002_agency_coordinates_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AgencySyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=255, unique=True)),
+                ('cursor', models.CharField(blank=True, max_length=64)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_changed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Agency Sync State',
+                'verbose_name_plural': 'Agency Sync States',
+            },
+        ),
+        migrations.AddField(
+            model_name='agency',
+            name='content_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='agency',
+            name='external_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
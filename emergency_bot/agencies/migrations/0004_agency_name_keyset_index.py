@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-17 00:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agencies', '0003_agency_sync'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agency',
+            index=models.Index(fields=['name', 'id'], name='agencies_ag_name_43a24f_idx'),
+        ),
+    ]
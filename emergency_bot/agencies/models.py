@@ -1,7 +1,49 @@
 from django.db import models
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from django.db.models.functions import ASin, Cos, Power, Radians, Sin, Sqrt
 from django.utils.text import slugify
+import math
 import uuid
 
+from .distance import EARTH_RADIUS_KM, KM_PER_DEGREE, haversine_km
+
+
+class AgencyQuerySet(models.QuerySet):
+    def within_bounding_box(self, latitude, longitude, radius_km):
+        """
+        Narrow to agencies inside the lat/lng box enclosing the given radius.
+        This is answered from the (latitude, longitude) index.
+        """
+        dlat = radius_km / KM_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(min(abs(latitude) + dlat, 89.0))), 0.01)
+        dlng = radius_km / (KM_PER_DEGREE * cos_lat)
+        return self.filter(
+            latitude__range=(latitude - dlat, latitude + dlat),
+            longitude__range=(longitude - dlng, longitude + dlng),
+        )
+    
+    def within_radius(self, latitude, longitude, radius_km):
+        """
+        Agencies within ``radius_km`` of the point, closest first.
+        
+        Candidates are first narrowed with the indexed bounding box, and the
+        exact Haversine distance (annotated as ``distance``) is only computed
+        for the rows that survive it.
+        """
+        lat1 = math.radians(latitude)
+        dlat = Radians(F('latitude') - Value(latitude)) / 2
+        dlng = Radians(F('longitude') - Value(longitude)) / 2
+        a = Power(Sin(dlat), 2) + Value(math.cos(lat1)) * Cos(Radians(F('latitude'))) * Power(Sin(dlng), 2)
+        distance = ExpressionWrapper(
+            Value(2 * EARTH_RADIUS_KM) * ASin(Sqrt(a)), output_field=FloatField()
+        )
+        return (
+            self.within_bounding_box(latitude, longitude, radius_km)
+            .annotate(distance=distance)
+            .filter(distance__lte=radius_km)
+            .order_by('distance')
+        )
+
 
 class Agency(models.Model):
     AGENCY_TYPES = (
@@ -42,9 +84,16 @@ class Agency(models.Model):
     # Metadata
     verified = models.BooleanField(default=False)
     active = models.BooleanField(default=True)
+    
+    # External directory sync
+    external_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
+    
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = AgencyQuerySet.as_manager()
+    
     class Meta:
         verbose_name = "Agency"
         verbose_name_plural = "Agencies"
@@ -53,6 +102,8 @@ class Agency(models.Model):
             models.Index(fields=['region']),
             models.Index(fields=['zone']),
             models.Index(fields=['active']),
+            models.Index(fields=['latitude', 'longitude']),
+            models.Index(fields=['name', 'id']),
         ]
         ordering = ['name']
     
@@ -70,18 +121,20 @@ class Agency(models.Model):
         
     def calculate_distance(self, latitude, longitude):
         """Calculate distance between agency and given coordinates"""
-        import math
-        
-        # Convert latitude and longitude from degrees to radians
-        lat1, lon1 = math.radians(self.latitude), math.radians(self.longitude)
-        lat2, lon2 = math.radians(latitude), math.radians(longitude)
-        
-        # Haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-        c = 2 * math.asin(math.sqrt(a))
-        r = 6371  # Radius of earth in kilometers
-        
         # Return distance in kilometers
-        return c * r 
\ No newline at end of file
+        return haversine_km(self.latitude, self.longitude, latitude, longitude)
+
+
+class AgencySyncState(models.Model):
+    """Cursor of the last incremental sync from an external agency directory"""
+    source = models.CharField(max_length=255, unique=True)
+    cursor = models.CharField(max_length=64, blank=True)
+    last_synced_at = models.DateTimeField(blank=True, null=True)
+    last_changed = models.PositiveIntegerField(default=0)
+    
+    class Meta:
+        verbose_name = "Agency Sync State"
+        verbose_name_plural = "Agency Sync States"
+    
+    def __str__(self):
+        return f"{self.source} @ {self.cursor or 'start'}"
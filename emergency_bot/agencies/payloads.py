@@ -0,0 +1,138 @@
+"""
+Pre-encoded, pre-compressed agency payloads.
+
+Payloads are built once per agency snapshot (and language) and served
+straight from memory with the best ``Content-Encoding`` the client accepts,
+so requests do no JSON encoding or compression of their own.
+"""
+
+import gzip
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from .lookup import LRUCache
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# Payloads smaller than this are not worth a compressed variant
+MIN_COMPRESS_SIZE = 512
+
+# Encoded payloads kept per snapshot; each holds up to three bodies
+DEFAULT_CACHE_SIZE = 256
+
+_build_lock = threading.Lock()
+
+
+def parse_accept_encoding(header):
+    """Return the set of encodings the client accepts with a non-zero q value."""
+    accepted = set()
+    for item in header.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        coding = parts[0].lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+class EncodedPayload:
+    """
+    Encoded response body plus lazily built gzip and brotli variants.
+
+    Each variant is compressed at most once, the first time a client asks
+    for it, and reused for every later request.
+    """
+
+    def __init__(self, content, content_type='application/json'):
+        self.content = content
+        self.content_type = content_type
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.content)
+
+    def variant(self, encoding):
+        """Return the body compressed with ``encoding`` ('gzip' or 'br')."""
+        try:
+            return self._variants[encoding]
+        except KeyError:
+            pass
+        with self._lock:
+            if encoding not in self._variants:
+                if encoding == 'br':
+                    body = brotli.compress(self.content, quality=BROTLI_QUALITY)
+                else:
+                    body = gzip.compress(
+                        self.content, compresslevel=GZIP_LEVEL, mtime=0
+                    )
+                self._variants[encoding] = body
+            return self._variants[encoding]
+
+    def choose_encoding(self, request):
+        if len(self.content) < MIN_COMPRESS_SIZE:
+            return None
+        accepted = parse_accept_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def response(self, request, status=200):
+        """Build an ``HttpResponse`` using the best encoding the client accepts."""
+        encoding = self.choose_encoding(request)
+        body = self.variant(encoding) if encoding else self.content
+        response = HttpResponse(body, content_type=self.content_type, status=status)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+def _payload_cache(snapshot):
+    return snapshot.derived(
+        'payloads',
+        lambda current: LRUCache(
+            getattr(settings, 'AGENCY_PAYLOAD_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+        ),
+    )
+
+
+def get_payload(snapshot, name, build, language=None):
+    """
+    Return the ``EncodedPayload`` called ``name`` for ``snapshot`` and ``language``.
+
+    ``build`` is called with the snapshot on first use and must return the
+    encoded body as bytes. Because payloads hang off the snapshot, they are
+    dropped automatically when the agency dataset version changes. Names
+    such as tile coordinates come from the request, so only the
+    ``AGENCY_PAYLOAD_CACHE_SIZE`` most recently used payloads are kept.
+    """
+    payloads = _payload_cache(snapshot)
+    key = f'{name}:{language or ""}'
+    payload = payloads.get(key)
+    if payload is None:
+        with _build_lock:
+            payload = payloads.get(key)
+            if payload is None:
+                payload = EncodedPayload(build(snapshot))
+                payloads.set(key, payload)
+    return payload
@@ -0,0 +1,352 @@
+"""
+In-memory full-text search over agency names, services, addresses and
+descriptions.
+
+Text is case-folded, stripped of accents and transliterated from Ge'ez
+script to Latin, so "ቦሌ", "Bole" and "bolee" meet on the same tokens.
+Queries are answered from an inverted index: exact tokens first, then
+prefixes (for partially typed words), then trigram-similar tokens (for
+misspellings and transliteration variants).
+"""
+
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+
+from .lookup import LRUCache
+
+# Field -> weight of a match in that field
+SEARCH_FIELDS = (
+    ('name', 3.0),
+    ('services', 1.5),
+    ('address', 1.0),
+    ('description', 0.5),
+)
+
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.8
+FUZZY_SCORE = 0.6
+
+MIN_PREFIX_LENGTH = 2
+MIN_FUZZY_LENGTH = 3
+FUZZY_THRESHOLD = 0.45
+MAX_EXPANSIONS = 50
+
+# Ranked results kept per index for repeated (query, limit) lookups
+QUERY_CACHE_SIZE = 256
+
+_WORD = re.compile(r'\w+')
+
+# Ge'ez syllables come in rows of eight: one consonant in seven vowel orders,
+# then a labialized form. Keys are the first code point of each row.
+_ETHIOPIC_CONSONANTS = {
+    0x1200: 'h',
+    0x1208: 'l',
+    0x1210: 'h',
+    0x1218: 'm',
+    0x1220: 's',
+    0x1228: 'r',
+    0x1230: 's',
+    0x1238: 'sh',
+    0x1240: 'q',
+    0x1248: 'qw',
+    0x1250: 'q',
+    0x1258: 'qw',
+    0x1260: 'b',
+    0x1268: 'v',
+    0x1270: 't',
+    0x1278: 'ch',
+    0x1280: 'h',
+    0x1288: 'hw',
+    0x1290: 'n',
+    0x1298: 'ny',
+    0x12A0: '',
+    0x12A8: 'k',
+    0x12B0: 'kw',
+    0x12B8: 'h',
+    0x12C0: 'hw',
+    0x12C8: 'w',
+    0x12D0: '',
+    0x12D8: 'z',
+    0x12E0: 'zh',
+    0x12E8: 'y',
+    0x12F0: 'd',
+    0x12F8: 'd',
+    0x1300: 'j',
+    0x1308: 'g',
+    0x1310: 'gw',
+    0x1318: 'g',
+    0x1320: 't',
+    0x1328: 'ch',
+    0x1330: 'p',
+    0x1338: 'ts',
+    0x1340: 'ts',
+    0x1348: 'f',
+    0x1350: 'p',
+}
+_ETHIOPIC_VOWELS = ('e', 'u', 'i', 'a', 'e', '', 'o', 'wa')
+# Rows that start with a bare vowel carrier use 'a' for the first order (አዲስ -> adis)
+_GLOTTAL_ROWS = (0x12A0, 0x12D0)
+
+
+def _build_transliteration():
+    table = {}
+    for row, consonant in _ETHIOPIC_CONSONANTS.items():
+        for order, vowel in enumerate(_ETHIOPIC_VOWELS):
+            if row in _GLOTTAL_ROWS and order == 0:
+                vowel = 'a'
+            table[row + order] = consonant + vowel
+    # Ethiopic word space and punctuation
+    for code in range(0x1360, 0x1369):
+        table[code] = ' '
+    return table
+
+
+_TRANSLITERATION = _build_transliteration()
+
+
+def fold_text(text):
+    """Case-fold ``text`` and strip accents, keeping the original script."""
+    text = unicodedata.normalize('NFKD', str(text).casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def transliterate(text):
+    """Transliterate Ge'ez script in ``text`` to Latin; other text passes through."""
+    return text.translate(_TRANSLITERATION)
+
+
+def _squeeze(token):
+    # "finfinnee" -> "finfine", "addis" -> "adis": doubled letters are spelled
+    # inconsistently
+    return re.sub(r'(.)\1+', r'\1', token)
+
+
+def tokenize(text):
+    """
+    Return the search tokens for ``text``: each folded word, plus its Latin
+    transliteration and squeezed spelling when those differ.
+    """
+    if not text:
+        return []
+    folded = fold_text(text)
+    tokens = []
+    for word in _WORD.findall(folded):
+        tokens.append(word)
+        latin = transliterate(word)
+        if latin != word:
+            tokens.extend(_WORD.findall(latin))
+            word = latin
+        squeezed = _squeeze(word)
+        if squeezed != word:
+            tokens.append(squeezed)
+    return tokens
+
+
+def query_terms(query):
+    """
+    Split a query into terms, each a list of alternative spellings.
+    A document matches a term when it matches any of its spellings.
+    """
+    terms = []
+    for word in _WORD.findall(fold_text(query)):
+        latin = transliterate(word)
+        spellings = {word, _squeeze(word)}
+        if latin != word:
+            spellings.update(_WORD.findall(latin))
+            spellings.update(_squeeze(part) for part in _WORD.findall(latin))
+        terms.append(sorted(spellings))
+    return terms
+
+
+def trigrams(token):
+    padded = f'  {token} '
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+    """
+    Inverted index from tokens to agency positions in a snapshot.
+
+    ``postings`` maps each token to ``{position: weight}`` where the weight
+    is the best field weight the token appears in. A sorted vocabulary
+    answers prefix queries with a binary search, and a trigram index over
+    the vocabulary (not the documents) answers fuzzy ones.
+
+    Tokenizing is the expensive part of a build, so an index can be built
+    from ``previous``: agencies whose searchable text is unchanged reuse
+    their tokens, and only new or edited agencies are re-tokenized.
+    Unfiltered results are cached per index, so repeated queries are
+    answered without ranking again.
+    """
+
+    def __init__(self, agencies, previous=None):
+        self.agencies = agencies
+        self.postings = {}
+        self._doc_tokens = {}
+        reused = previous._doc_tokens if previous is not None else {}
+
+        for position, agency in enumerate(agencies):
+            signature = tuple(agency.get(field) for field, _ in SEARCH_FIELDS)
+            key = str(agency.get('id', position))
+            cached = reused.get(key)
+            if cached is not None and cached[0] == signature:
+                weights = cached[1]
+            else:
+                weights = {}
+                for (field, weight), text in zip(SEARCH_FIELDS, signature):
+                    for token in tokenize(text):
+                        if weights.get(token, 0) < weight:
+                            weights[token] = weight
+            self._doc_tokens[key] = (signature, weights)
+            for token, weight in weights.items():
+                self.postings.setdefault(token, {})[position] = weight
+
+        self.vocabulary = sorted(self.postings)
+        self._results = LRUCache(QUERY_CACHE_SIZE)
+        self.trigram_index = {}
+        for token_id, token in enumerate(self.vocabulary):
+            for gram in trigrams(token):
+                self.trigram_index.setdefault(gram, []).append(token_id)
+
+    def __len__(self):
+        return len(self.agencies)
+
+    def _prefix_matches(self, term):
+        start = bisect_left(self.vocabulary, term)
+        matches = []
+        for token in self.vocabulary[start : start + MAX_EXPANSIONS + 1]:
+            if not token.startswith(term):
+                break
+            if token != term:
+                matches.append(token)
+        return matches
+
+    def _fuzzy_matches(self, term):
+        """Return ``(token, similarity)`` for tokens sharing enough trigrams."""
+        grams = trigrams(term)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.trigram_index.get(gram, ()))
+        matches = []
+        for token_id, count in shared.most_common(MAX_EXPANSIONS * 4):
+            token = self.vocabulary[token_id]
+            # Dice coefficient of the two trigram sets
+            similarity = 2.0 * count / (len(grams) + len(trigrams(token)))
+            if similarity < FUZZY_THRESHOLD:
+                continue
+            matches.append((token, similarity))
+        matches.sort(key=lambda item: -item[1])
+        return matches[:MAX_EXPANSIONS]
+
+    def _expand(self, spelling):
+        """Return ``{token: match_quality}`` for one spelling of a query term."""
+        expanded = {}
+        if spelling in self.postings:
+            expanded[spelling] = EXACT_SCORE
+        if len(spelling) >= MIN_PREFIX_LENGTH:
+            for token in self._prefix_matches(spelling):
+                # Closer completions rank higher than long ones
+                expanded.setdefault(
+                    token, PREFIX_SCORE * (0.5 + 0.5 * len(spelling) / len(token))
+                )
+        if len(spelling) >= MIN_FUZZY_LENGTH:
+            for token, similarity in self._fuzzy_matches(spelling):
+                if token not in expanded:
+                    expanded[token] = FUZZY_SCORE * similarity
+        return expanded
+
+    def search(self, query, limit=None, positions=None):
+        """
+        Return agency dicts matching ``query``, best first.
+
+        Every query term is matched exactly, as a prefix or fuzzily; agencies
+        matching more terms rank above those matching fewer. ``positions``
+        restricts the results to those snapshot positions (e.g. a location
+        filter).
+        """
+        terms = query_terms(query)
+        if not terms:
+            return []
+        if positions is None:
+            cache_key = (tuple(map(tuple, terms)), limit)
+            cached = self._results.get(cache_key)
+            if cached is None:
+                cached = self._rank(terms, limit, None)
+                self._results.set(cache_key, cached)
+            return [self.agencies[position] for position in cached]
+        return [
+            self.agencies[position] for position in self._rank(terms, limit, positions)
+        ]
+
+    def _rank(self, terms, limit, positions):
+        """Return the matching snapshot positions, best first."""
+        scores = {}
+        matched_terms = Counter()
+        for spellings in terms:
+            expanded = {}
+            for spelling in spellings:
+                for token, quality in self._expand(spelling).items():
+                    if quality > expanded.get(token, 0):
+                        expanded[token] = quality
+
+            term_scores = {}
+            for token, quality in expanded.items():
+                for position, weight in self.postings[token].items():
+                    score = quality * weight
+                    if score > term_scores.get(position, 0):
+                        term_scores[position] = score
+            for position, score in term_scores.items():
+                scores[position] = scores.get(position, 0) + score
+                matched_terms[position] += 1
+
+        if positions is not None:
+            scores = {
+                position: score
+                for position, score in scores.items()
+                if position in positions
+            }
+
+        def rank(position):
+            return -matched_terms[position], -scores[position], position
+
+        if limit is not None:
+            return heapq.nsmallest(limit, scores, key=rank)
+        return sorted(scores, key=rank)
+
+
+def linear_search(agencies, query, limit=None):
+    """
+    Rank ``agencies`` against ``query`` without an index, for use while the
+    index of a new snapshot is still being built.
+
+    Each query spelling is looked for as a substring of the case-folded
+    fields, which is far cheaper than tokenizing every agency but does not
+    strip accents or transliterate the agencies' text, and has no fuzzy
+    matching. Ranking otherwise follows ``SearchIndex.search``.
+    """
+    terms = query_terms(query)
+    if not terms:
+        return []
+    ranked = []
+    for position, agency in enumerate(agencies):
+        texts = [
+            (str(agency.get(field) or '').casefold(), weight)
+            for field, weight in SEARCH_FIELDS
+        ]
+        matched = 0
+        score = 0.0
+        for spellings in terms:
+            best = 0.0
+            for text, weight in texts:
+                if weight > best and any(spelling in text for spelling in spellings):
+                    best = weight
+            if best:
+                matched += 1
+                score += best
+        if matched:
+            ranked.append((-matched, -score, position))
+    ranked = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+    return [agencies[position] for _, _, position in ranked]
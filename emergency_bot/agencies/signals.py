@@ -0,0 +1,23 @@
+"""
+Signal handlers for the agencies app.
+"""
+
+import logging
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .lookup import agency_cache
+from .models import Agency
+from .snapshot import invalidate_agency_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Agency)
+@receiver(post_delete, sender=Agency)
+def agency_changed(sender, instance, **kwargs):
+    """Rebuild the in-process agency snapshot after any agency change."""
+    invalidate_agency_snapshot()
+    agency_cache.clear()
+    logger.debug(f"Agency {instance.pk} changed, agency snapshot invalidated")
@@ -0,0 +1,262 @@
+"""
+Process-wide, versioned snapshot of the agency dataset.
+
+Every agency endpoint reads the same snapshot instead of querying and
+re-serializing the agencies table per request. A snapshot is replaced when
+an ``Agency`` signal marks it stale in this process, or when a cheap
+``Max(updated_at)``/``Count`` check shows another process changed the table.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .hierarchy import HierarchyIndex
+from .lookup import build_key_map
+from .models import Agency
+from .search import SearchIndex
+from .spatial import SpatialIndex
+
+logger = logging.getLogger(__name__)
+
+
+class AgencySnapshot:
+    """
+    Immutable agency list plus the structures derived from it.
+
+    The agency dictionaries are shared by all requests and must not be
+    mutated; copy one before adding request-specific fields.
+    """
+
+    def __init__(self, agencies, source, version, last_modified, fingerprint=None):
+        self.agencies = agencies
+        self.source = source
+        self.version = version
+        self.last_modified = last_modified
+        self.fingerprint = fingerprint
+        self.agencies_json = json.dumps(agencies).encode()
+        self._derived = {}
+        self._derived_lock = threading.Lock()
+        # One lock per derived structure, so a slow build does not hold up the others
+        self._build_locks = {}
+        # Search index of the snapshot this one replaced, reused for unchanged agencies
+        self._previous_search_index = None
+
+    def __len__(self):
+        return len(self.agencies)
+
+    def derived(self, name, builder):
+        """
+        Return a structure built once per snapshot, e.g. an index.
+
+        ``builder`` is called with the snapshot the first time ``name`` is
+        requested; later calls return the cached result.
+        """
+        try:
+            return self._derived[name]
+        except KeyError:
+            pass
+        with self._build_lock(name):
+            if name not in self._derived:
+                self._derived[name] = builder(self)
+            return self._derived[name]
+
+    def _build_lock(self, name):
+        with self._derived_lock:
+            return self._build_locks.setdefault(name, threading.Lock())
+
+    def build_in_background(self, name, builder):
+        """Build ``name`` in a thread unless it is already built or being built."""
+        if name in self._derived or self._build_lock(name).locked():
+            return
+        threading.Thread(
+            target=self.derived,
+            args=(name, builder),
+            name=f'agency-snapshot-{name}',
+            daemon=True,
+        ).start()
+
+    @property
+    def spatial_index(self):
+        return self.derived(
+            'spatial_index',
+            lambda snapshot: SpatialIndex(
+                snapshot.agencies, getattr(settings, 'AGENCY_INDEX_CELL_SIZE', 0.1)
+            ),
+        )
+
+    @property
+    def key_map(self):
+        return self.derived(
+            'key_map', lambda snapshot: build_key_map(snapshot.agencies)
+        )
+
+    @property
+    def hierarchy(self):
+        return self.derived(
+            'hierarchy', lambda snapshot: HierarchyIndex(snapshot.agencies)
+        )
+
+    @property
+    def search_index(self):
+        return self.derived('search_index', _build_search_index)
+
+    def ready_search_index(self):
+        """
+        Return the search index if it has been built, without building it.
+        Otherwise the build is started in the background and None returned.
+        """
+        index = self._derived.get('search_index')
+        if index is None:
+            self.build_in_background('search_index', _build_search_index)
+        return index
+
+    @property
+    def previous_search_index(self):
+        """The search index of the snapshot this one replaced, until its own exists."""
+        return self._previous_search_index
+
+
+def _build_search_index(snapshot):
+    index = SearchIndex(snapshot.agencies, previous=snapshot._previous_search_index)
+    snapshot._previous_search_index = None
+    return index
+
+
+_snapshot = None
+_checked_at = 0.0
+_stale = False
+_snapshot_lock = threading.Lock()
+
+
+def _database_fingerprint():
+    """
+    Return a cheap ``(count, max_updated_at)`` summary of the agencies table.
+
+    Any save bumps ``updated_at`` and any delete changes the count, so the
+    pair changes whenever the table does. Returns None if the database is
+    unavailable.
+    """
+    try:
+        summary = Agency.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+        return summary['count'], summary['updated']
+    except Exception as e:
+        logger.error(f"Database error while checking agency fingerprint: {e}")
+        return None
+
+
+def _compute_version(source, fingerprint, agencies_json):
+    if source == 'database' and fingerprint is not None:
+        count, updated = fingerprint
+        payload = f"{source}:{count}:{updated.isoformat() if updated else ''}".encode()
+    else:
+        payload = source.encode() + b':' + agencies_json
+    return hashlib.sha1(payload).hexdigest()[:16]
+
+
+def get_agency_snapshot(load_agencies):
+    """
+    Return the current ``AgencySnapshot``, rebuilding it when needed.
+
+    ``load_agencies`` is called with no arguments and must return the usual
+    ``(agencies_list, source)`` tuple. Within ``AGENCY_SNAPSHOT_CHECK_INTERVAL``
+    seconds of the last check the cached snapshot is returned without touching
+    the database at all.
+    """
+    global _snapshot, _checked_at, _stale
+
+    interval = getattr(settings, 'AGENCY_SNAPSHOT_CHECK_INTERVAL', 5)
+    snapshot = _snapshot
+    if (
+        snapshot is not None
+        and not _stale
+        and time.monotonic() - _checked_at < interval
+    ):
+        return snapshot
+
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if (
+            snapshot is not None
+            and not _stale
+            and time.monotonic() - _checked_at < interval
+        ):
+            return snapshot
+
+        fingerprint = _database_fingerprint()
+        if (
+            snapshot is not None
+            and not _stale
+            and snapshot.source == 'database'
+            and fingerprint is not None
+            and fingerprint == snapshot.fingerprint
+        ):
+            _checked_at = time.monotonic()
+            return snapshot
+
+        _stale = False
+        agencies, source = load_agencies()
+        candidate = AgencySnapshot(agencies, source, None, None, fingerprint)
+        version = _compute_version(source, fingerprint, candidate.agencies_json)
+
+        if snapshot is not None and snapshot.version == version:
+            # Same data as before; keep the old snapshot and its built indexes
+            _checked_at = time.monotonic()
+            return snapshot
+
+        candidate.version = version
+        if snapshot is not None:
+            candidate._previous_search_index = (
+                snapshot._derived.get('search_index') or snapshot._previous_search_index
+            )
+        if source == 'database' and fingerprint is not None and fingerprint[1]:
+            candidate.last_modified = fingerprint[1]
+        else:
+            candidate.last_modified = timezone.now()
+
+        _snapshot = candidate
+        _checked_at = time.monotonic()
+        logger.info(
+            f"Built agency snapshot {version} with {len(candidate)} agencies "
+            f"from {source}"
+        )
+        # Tokenizing every agency takes seconds on a large directory; keep it off the
+        # request path
+        candidate.build_in_background('search_index', _build_search_index)
+        return candidate
+
+
+def invalidate_agency_snapshot():
+    """Mark the snapshot stale so the next request reloads the agencies."""
+    global _stale
+    _stale = True
+
+
+def peek_agency_snapshot():
+    """
+    Return the loaded snapshot unless it is missing or marked stale.
+
+    Never touches the database, so callers can pick a cheaper path while a
+    cold or invalidated snapshot is being rebuilt.
+    """
+    if _stale:
+        return None
+    return _snapshot
+
+
+def refresh_agency_snapshot_async(load_agencies):
+    """Rebuild the snapshot in a background thread unless a rebuild is running."""
+    if _snapshot_lock.locked():
+        return
+    threading.Thread(
+        target=get_agency_snapshot,
+        args=(load_agencies,),
+        name='agency-snapshot-refresh',
+        daemon=True,
+    ).start()
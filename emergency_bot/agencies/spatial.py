@@ -0,0 +1,241 @@
+"""
+In-process spatial index for agency proximity queries.
+"""
+
+import heapq
+import logging
+import math
+from collections import Counter
+
+from .distance import KM_PER_DEGREE, DistanceEngine
+
+logger = logging.getLogger(__name__)
+
+
+class SpatialIndex:
+    """
+    Uniform latitude/longitude grid over agency dictionaries.
+
+    Every agency is bucketed into a square cell of ``cell_size`` degrees, so
+    radius and k-nearest queries only compute distances for the agencies in
+    the cells that can possibly hold a match instead of the whole directory.
+    The distances themselves are computed in batches by a ``DistanceEngine``.
+    """
+
+    def __init__(self, agencies, cell_size=0.1):
+        self.cell_size = cell_size
+        self.agencies = []
+        self.cells = {}
+        points = []
+
+        for agency in agencies:
+            try:
+                lat = float(agency['latitude'])
+                lng = float(agency['longitude'])
+            except (TypeError, ValueError, KeyError) as e:
+                logger.warning(f"Skipping agency due to invalid coordinates: {e}")
+                continue
+            self.cells.setdefault(self._cell(lat, lng), []).append(len(self.agencies))
+            self.agencies.append(agency)
+            points.append((lat, lng, agency.get('type')))
+        self.engine = DistanceEngine(points)
+        self.type_counts = Counter(kind for _, _, kind in points)
+
+        if self.cells:
+            rows = [row for row, _ in self.cells]
+            cols = [col for _, col in self.cells]
+            self.bounds = (min(rows), max(rows), min(cols), max(cols))
+        else:
+            self.bounds = None
+
+    def __len__(self):
+        return len(self.agencies)
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_size), math.floor(lng / self.cell_size))
+
+    def _km_per_cell(self, lat):
+        """Smallest east-west or north-south extent of a cell near ``lat``, in km."""
+        cos_lat = max(math.cos(math.radians(min(abs(lat), 89.0))), 0.01)
+        return self.cell_size * KM_PER_DEGREE * cos_lat
+
+    def _ring(self, center, radius):
+        """Yield the occupied cells at Chebyshev distance ``radius`` from ``center``."""
+        row, col = center
+        if radius == 0:
+            candidates = [center]
+        else:
+            candidates = []
+            for dc in range(-radius, radius + 1):
+                candidates.append((row - radius, col + dc))
+                candidates.append((row + radius, col + dc))
+            for dr in range(-radius + 1, radius):
+                candidates.append((row + dr, col - radius))
+                candidates.append((row + dr, col + radius))
+        for cell in candidates:
+            if cell in self.cells:
+                yield cell
+
+    def _positions(self, cells):
+        return [position for cell in cells for position in self.cells[cell]]
+
+    def within_radius(self, latitude, longitude, radius_km, agency_type=None):
+        """
+        Return ``(distance, agency)`` pairs within ``radius_km``, closest first.
+        """
+        if not self.cells:
+            return []
+
+        # Degrees spanned by the radius; longitude degrees shrink towards the poles
+        dlat = radius_km / KM_PER_DEGREE
+        cos_lat = max(math.cos(math.radians(min(abs(latitude) + dlat, 89.0))), 0.01)
+        dlng = radius_km / (KM_PER_DEGREE * cos_lat)
+
+        min_row, max_row, min_col, max_col = self.bounds
+        row_lo = max(math.floor((latitude - dlat) / self.cell_size), min_row)
+        row_hi = min(math.floor((latitude + dlat) / self.cell_size), max_row)
+        col_lo = max(math.floor((longitude - dlng) / self.cell_size), min_col)
+        col_hi = min(math.floor((longitude + dlng) / self.cell_size), max_col)
+
+        cells = [
+            (row, col)
+            for row in range(row_lo, row_hi + 1)
+            for col in range(col_lo, col_hi + 1)
+            if (row, col) in self.cells
+        ]
+
+        positions, distances = self.engine.query(
+            latitude,
+            longitude,
+            max_distance=radius_km,
+            agency_type=agency_type,
+            candidates=self._positions(cells),
+        )
+        return [
+            (distance, self.agencies[position])
+            for position, distance in zip(positions, distances)
+        ]
+
+    def nearest(self, latitude, longitude, k, agency_type=None, max_distance=None):
+        """
+        Return up to ``k`` ``(distance, agency)`` pairs closest to the point.
+
+        Cells are visited in rings around the query cell and the search stops
+        as soon as no unvisited ring can hold anything closer than the current
+        k-th result.
+        """
+        if not self.cells or k <= 0:
+            return []
+
+        center = self._cell(latitude, longitude)
+        min_row, max_row, min_col, max_col = self.bounds
+        max_radius = max(
+            abs(center[0] - min_row),
+            abs(center[0] - max_row),
+            abs(center[1] - min_col),
+            abs(center[1] - max_col),
+        )
+
+        heap = []  # max-heap of the best k, stored as (-distance, position)
+        for radius in range(max_radius + 1):
+            # Anything in this ring is at least (radius - 1) whole cells away
+            lower_bound = max(radius - 1, 0) * self._km_per_cell(
+                abs(latitude) + radius * self.cell_size
+            )
+            if max_distance is not None and lower_bound > max_distance:
+                break
+            if len(heap) == k and lower_bound > -heap[0][0]:
+                break
+
+            ring = self._positions(self._ring(center, radius))
+            if not ring:
+                continue
+            positions, distances = self.engine.query(
+                latitude,
+                longitude,
+                max_distance=max_distance,
+                agency_type=agency_type,
+                limit=k,
+                candidates=ring,
+            )
+            for position, distance in zip(positions, distances):
+                if len(heap) < k:
+                    heapq.heappush(heap, (-distance, position))
+                elif distance < -heap[0][0]:
+                    heapq.heapreplace(heap, (-distance, position))
+                else:
+                    break
+
+        return [
+            (-neg, self.agencies[position])
+            for neg, position in sorted(heap, reverse=True)
+        ]
+
+    def _heap_settled(self, heap, k, agency_type, lower_bound):
+        """Whether no unvisited agency can still enter this type's heap."""
+        wanted = min(k, self.type_counts.get(agency_type, 0))
+        if len(heap) < wanted:
+            return False
+        if wanted < k:
+            # Every agency of this type has already been found
+            return True
+        return lower_bound > -heap[0][0]
+
+    def nearest_by_type(self, latitude, longitude, types, k, max_distance=None):
+        """
+        Return ``{type: [(distance, agency), ...]}`` with the ``k`` closest
+        agencies of each requested type, found in a single ring traversal.
+
+        Each type keeps its own bounded heap; the search stops once every
+        heap is full and no unvisited ring can improve any of them.
+        """
+        heaps = {agency_type: [] for agency_type in types}
+        if not self.cells or k <= 0 or not heaps:
+            return {agency_type: [] for agency_type in heaps}
+
+        center = self._cell(latitude, longitude)
+        min_row, max_row, min_col, max_col = self.bounds
+        max_radius = max(
+            abs(center[0] - min_row),
+            abs(center[0] - max_row),
+            abs(center[1] - min_col),
+            abs(center[1] - max_col),
+        )
+
+        for radius in range(max_radius + 1):
+            lower_bound = max(radius - 1, 0) * self._km_per_cell(
+                abs(latitude) + radius * self.cell_size
+            )
+            if max_distance is not None and lower_bound > max_distance:
+                break
+            if all(
+                self._heap_settled(heap, k, agency_type, lower_bound)
+                for agency_type, heap in heaps.items()
+            ):
+                break
+
+            ring = self._positions(self._ring(center, radius))
+            if not ring:
+                continue
+            positions, distances = self.engine.query(
+                latitude,
+                longitude,
+                max_distance=max_distance,
+                candidates=ring,
+            )
+            for position, distance in zip(positions, distances):
+                heap = heaps.get(self.agencies[position].get('type'))
+                if heap is None:
+                    continue
+                if len(heap) < k:
+                    heapq.heappush(heap, (-distance, position))
+                elif distance < -heap[0][0]:
+                    heapq.heapreplace(heap, (-distance, position))
+
+        return {
+            agency_type: [
+                (-neg, self.agencies[position])
+                for neg, position in sorted(heap, reverse=True)
+            ]
+            for agency_type, heap in heaps.items()
+        }
@@ -0,0 +1,346 @@
+"""
+Incremental sync of agencies from the external agency directory.
+
+Only records changed since the stored cursor are requested, a page at a
+time, and records whose content hash matches the stored row are skipped,
+so a sync costs in proportion to what changed rather than to the size of
+the directory.
+Changes are written with bulk inserts/updates, one transaction per batch,
+and every row in a batch shares one ``updated_at`` so each batch moves the
+agency dataset version exactly once.
+"""
+
+import hashlib
+import json
+import logging
+
+import requests
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from .lookup import agency_cache
+from .models import Agency, AgencySyncState
+from .snapshot import invalidate_agency_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Agency fields taken from the external records
+SYNC_FIELDS = (
+    'name',
+    'type',
+    'description',
+    'region',
+    'zone',
+    'woreda',
+    'kebele',
+    'phone',
+    'alt_phone',
+    'email',
+    'address',
+    'latitude',
+    'longitude',
+    'hours_of_operation',
+    'services',
+    'verified',
+    'active',
+)
+
+REQUIRED_FIELDS = ('name', 'region', 'latitude', 'longitude')
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def content_hash(record):
+    """Return a stable hash of the synced fields of ``record``."""
+    values = {field: record.get(field) for field in SYNC_FIELDS}
+    return hashlib.sha1(
+        json.dumps(values, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def agency_values(record):
+    """
+    Map an external record onto the synced ``Agency`` field values.
+    Raises ValueError describing the first problem with the record.
+    """
+    for field in REQUIRED_FIELDS:
+        if record.get(field) in (None, ''):
+            raise ValueError(f"missing {field}")
+    try:
+        latitude = float(record['latitude'])
+        longitude = float(record['longitude'])
+    except (TypeError, ValueError):
+        raise ValueError("latitude/longitude are not numbers")
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError("latitude/longitude out of range")
+
+    email = _clip(record.get('email'), 'email')
+    if email:
+        try:
+            validate_email(email)
+        except ValidationError:
+            raise ValueError("invalid email")
+
+    values = {
+        'name': _clip(record['name'], 'name'),
+        'type': (
+            record.get('type')
+            if record.get('type') in dict(Agency.AGENCY_TYPES)
+            else 'other'
+        ),
+        'description': record.get('description') or None,
+        'region': _clip(record['region'], 'region'),
+        'zone': _clip(record.get('zone'), 'zone'),
+        'woreda': _clip(record.get('woreda'), 'woreda'),
+        'kebele': _clip(record.get('kebele'), 'kebele'),
+        'phone': _clip(record.get('phone'), 'phone') or '',
+        'alt_phone': _clip(record.get('alt_phone'), 'alt_phone'),
+        'email': email,
+        'address': record.get('address') or '',
+        'latitude': latitude,
+        'longitude': longitude,
+        'hours_of_operation': record.get('hours_of_operation') or None,
+        'services': record.get('services') or None,
+        'verified': _as_bool(record.get('verified', False)),
+        'active': _as_bool(record.get('active', True))
+        and not _as_bool(record.get('deleted', False)),
+    }
+    values['content_hash'] = content_hash(values)
+    return values
+
+
+def _clip(value, field):
+    """
+    ``value`` as text cut to the ``max_length`` of the Agency ``field``, or None
+    when empty.
+    """
+    if value in (None, ''):
+        return None
+    return str(value)[: Agency._meta.get_field(field).max_length]
+
+
+def _as_bool(value):
+    # CSV files carry booleans as text
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y', 't')
+    return bool(value)
+
+
+def normalize_record(record):
+    """
+    Map an external record onto ``Agency`` field values.
+    Returns None for records that cannot be stored.
+    """
+    external_id = record.get('external_id') or record.get('id')
+    if (
+        external_id in (None, '')
+        or len(str(external_id)) > Agency._meta.get_field('external_id').max_length
+    ):
+        return None
+    try:
+        values = agency_values(record)
+    except ValueError:
+        return None
+    values['external_id'] = str(external_id)
+    return values
+
+
+def base_slug(values):
+    """Return the slug ``Agency.save`` would give these values."""
+    return slugify(f"{values['name']}-{values['region']}")[:100] or 'agency'
+
+
+def unique_slugs(rows, key):
+    """
+    Pick a unique slug for each new row, keyed by ``row[key]``.
+    Only the candidate slugs are checked against the database.
+    """
+    candidates = {row[key]: row.get('slug') or base_slug(row) for row in rows}
+    taken = set(
+        Agency.objects.filter(slug__in=set(candidates.values())).values_list(
+            'slug', flat=True
+        )
+    )
+    slugs = {}
+    for row_key, slug in candidates.items():
+        if slug in taken:
+            slug = f"{slug}-{slugify(str(row_key))}"[:120]
+        taken.add(slug)
+        slugs[row_key] = slug
+    return slugs
+
+
+def apply_batch(records):
+    """
+    Upsert one batch of external records.
+
+    Returns ``(created, updated, unchanged, skipped)`` counts. The agency
+    snapshot is invalidated once, after the batch commits, and only if it
+    changed anything.
+    """
+    rows = {}
+    skipped = 0
+    for record in records:
+        row = normalize_record(record)
+        if row is None:
+            skipped += 1
+            continue
+        rows[row['external_id']] = row
+
+    existing = {
+        agency.external_id: agency
+        for agency in Agency.objects.filter(external_id__in=list(rows)).only(
+            'id', 'external_id', 'content_hash'
+        )
+    }
+
+    now = timezone.now()
+    to_create = []
+    to_update = []
+    for external_id, row in rows.items():
+        agency = existing.get(external_id)
+        if agency is None:
+            to_create.append(row)
+        elif agency.content_hash != row['content_hash']:
+            for field, value in row.items():
+                setattr(agency, field, value)
+            agency.updated_at = now
+            to_update.append(agency)
+
+    unchanged = len(rows) - len(to_create) - len(to_update)
+    if not to_create and not to_update:
+        return 0, 0, unchanged, skipped
+
+    with transaction.atomic():
+        if to_create:
+            slugs = unique_slugs(to_create, 'external_id')
+            new_agencies = [
+                Agency(slug=slugs[row['external_id']], **row) for row in to_create
+            ]
+            for agency in new_agencies:
+                agency.created_at = agency.updated_at = now
+            Agency.objects.bulk_create(new_agencies)
+        if to_update:
+            Agency.objects.bulk_update(
+                to_update, SYNC_FIELDS + ('content_hash', 'updated_at')
+            )
+        transaction.on_commit(dataset_changed)
+
+    return len(to_create), len(to_update), unchanged, skipped
+
+
+def dataset_changed():
+    """
+    Invalidate the agency snapshot and lookup cache after bulk writes, which
+    skip the model signals that normally do it.
+    """
+    invalidate_agency_snapshot()
+    agency_cache.clear()
+
+
+def _record_cursor(record):
+    value = record.get('updated_at')
+    return str(value) if value else ''
+
+
+def fetch_page(url, cursor=None, limit=DEFAULT_BATCH_SIZE, timeout=30, next_url=None):
+    """
+    Fetch one page of records changed since ``cursor`` from the external
+    directory. Returns ``(records, next_url)``, where ``next_url`` is the
+    link to the following page when the directory paginates its results
+    (``{"results": [...], "next": ...}``). Directories that ignore
+    ``updated_since`` and ``limit`` return everything in one page.
+    """
+    if next_url:
+        response = requests.get(next_url, timeout=timeout)
+    else:
+        params = {'limit': limit}
+        if cursor:
+            params['updated_since'] = cursor
+        response = requests.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    next_url = None
+    if isinstance(data, dict):
+        next_url = data.get('next') or None
+        data = data.get('results', [])
+    if not isinstance(data, list):
+        raise ValueError("External directory returned an unexpected payload")
+    return data, next_url
+
+
+def sync_agencies(url, batch_size=DEFAULT_BATCH_SIZE, full=False):
+    """
+    Pull agencies changed since the last sync from ``url`` and upsert them.
+
+    The feed is read one page of ``batch_size`` records at a time, starting
+    at the stored cursor (the largest ``updated_at`` seen so far). Each
+    page is committed and the cursor saved before the next one is fetched,
+    so only one page is held in memory and an interrupted sync resumes
+    where it stopped. ``full`` ignores the cursor. Returns a dict of counts.
+    """
+    state, _ = AgencySyncState.objects.get_or_create(source=url)
+    cursor = '' if full else state.cursor
+    totals = {
+        'fetched': 0,
+        'created': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'skipped': 0,
+        'batches': 0,
+    }
+    next_url = None
+    while True:
+        page, next_url = fetch_page(url, cursor or None, batch_size, next_url=next_url)
+        if not page:
+            break
+        totals['fetched'] += len(page)
+
+        # Apply oldest changes first so the cursor only ever moves forward
+        page.sort(key=_record_cursor)
+        for start in range(0, len(page), batch_size):
+            batch = page[start : start + batch_size]
+            created, updated, unchanged, skipped = apply_batch(batch)
+            totals['created'] += created
+            totals['updated'] += updated
+            totals['unchanged'] += unchanged
+            totals['skipped'] += skipped
+            totals['batches'] += 1
+
+            batch_cursor = _record_cursor(batch[-1])[:64]
+            if batch_cursor > state.cursor:
+                state.cursor = batch_cursor
+                state.save(update_fields=['cursor'])
+
+        if next_url:
+            continue
+        # A short page is the last one; a longer one means the directory ignores
+        # ``limit``
+        if len(page) != batch_size:
+            break
+        page_cursor = _record_cursor(page[-1])[:64]
+        if page_cursor <= (cursor or ''):
+            # A full page of records sharing one updated_at; the next request would
+            # return it again
+            logger.warning(
+                f"Agency feed at {url} did not advance past {cursor}; "
+                "stopping this sync"
+            )
+            break
+        # updated_since is inclusive, so records sharing the boundary updated_at are
+        # sent
+        # again and skipped as unchanged rather than lost
+        cursor = page_cursor
+
+    state.last_synced_at = timezone.now()
+    state.last_changed = totals['created'] + totals['updated']
+    state.save(update_fields=['last_synced_at', 'last_changed'])
+    logger.info(
+        f"Synced agencies from {url}: {totals['created']} created, "
+        f"{totals['updated']} updated, "
+        f"{totals['unchanged']} unchanged, {totals['skipped']} skipped"
+    )
+    return totals
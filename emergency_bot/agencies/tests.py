@@ -0,0 +1,623 @@
+import base64
+import gzip
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import uuid
+from io import StringIO
+from unittest import mock, skipIf
+
+import requests
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import feed
+from .grid import EMPTY, ETHIOPIA_BOUNDS, NearestGrid, build_nearest_grid, np
+from .management.commands.benchmark_agencies import Command as BenchmarkCommand
+from .management.commands.benchmark_agencies import percentile, synthetic_agencies
+from .models import Agency, AgencySyncState
+from .payloads import EncodedPayload, get_payload, parse_accept_encoding
+from .search import SearchIndex
+from .snapshot import (
+    AgencySnapshot,
+    invalidate_agency_snapshot,
+    peek_agency_snapshot,
+)
+from .spatial import SpatialIndex
+from .sync import agency_values, apply_batch, dataset_changed, sync_agencies
+from .views import get_agencies_snapshot
+
+
+def create_agency(name, **fields):
+    values = {
+        'type': 'police',
+        'region': 'Addis Ababa',
+        'phone': '+251111000000',
+        'latitude': 9.0,
+        'longitude': 38.75,
+    }
+    values.update(fields)
+    return Agency.objects.create(name=name, **values)
+
+
+def external_record(number, **fields):
+    record = {
+        'id': f'ext-{number}',
+        'name': f'Agency {number}',
+        'region': 'Oromia',
+        'latitude': 8.5,
+        'longitude': 39.2,
+        'updated_at': f'2026-01-{number:02d}T00:00:00Z',
+    }
+    record.update(fields)
+    return record
+
+
+class BenchmarkCommandTests(TestCase):
+    def test_percentile_uses_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_synthetic_agencies_are_reproducible_and_in_ethiopia(self):
+        first = list(synthetic_agencies(200, seed=1))
+        second = list(synthetic_agencies(200, seed=1))
+        self.assertEqual([a.id for a in first], [a.id for a in second])
+        self.assertEqual(len({a.slug for a in first}), 200)
+        south, west, north, east = ETHIOPIA_BOUNDS
+        for agency in first:
+            self.assertTrue(south < agency.latitude < north)
+            self.assertTrue(west < agency.longitude < east)
+
+    def test_invalid_sizes_are_rejected(self):
+        for sizes in ('ten', '0', ''):
+            with self.assertRaises(CommandError):
+                call_command('benchmark_agencies', sizes=sizes, stdout=StringIO())
+
+    @override_settings(
+        AGENCY_GRID_AUTO_REBUILD=False, AGENCY_SNAPSHOT_CHECK_INTERVAL=3600
+    )
+    def test_every_case_reports_latency_and_queries(self):
+        invalidate_agency_snapshot()
+        command = BenchmarkCommand(stdout=StringIO())
+        command.iterations = 3
+        command.warmup = 1
+        command.rng = random.Random(5)
+        command.load_dataset(60, seed=5)
+
+        results = command.run_cases()
+        self.assertIn('http.nearby', results)
+        self.assertIn('fn.snapshot_rebuild', results)
+        for name, result in results.items():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'], name)
+            self.assertGreaterEqual(result['queries_per_call'], 0, name)
+        self.assertEqual(results['fn.snapshot_rebuild']['iterations'], 3)
+
+
+@override_settings(AGENCY_SNAPSHOT_CHECK_INTERVAL=600)
+class AgencySnapshotTests(TestCase):
+    def setUp(self):
+        invalidate_agency_snapshot()
+
+    def test_snapshot_is_reused_while_data_is_unchanged(self):
+        create_agency('Bole Police Station')
+        snapshot = get_agencies_snapshot()
+        self.assertEqual(snapshot.source, 'database')
+        self.assertIs(get_agencies_snapshot(), snapshot)
+        self.assertIs(peek_agency_snapshot(), snapshot)
+
+    def test_agency_save_invalidates_snapshot(self):
+        create_agency('Bole Police Station')
+        snapshot = get_agencies_snapshot()
+
+        create_agency('Arada Police Station')
+        self.assertIsNone(peek_agency_snapshot())
+        refreshed = get_agencies_snapshot()
+        self.assertNotEqual(refreshed.version, snapshot.version)
+        self.assertEqual(
+            sorted(agency['name'] for agency in refreshed.agencies),
+            ['Arada Police Station', 'Bole Police Station'],
+        )
+
+    def test_agency_delete_invalidates_snapshot(self):
+        agency = create_agency('Bole Police Station')
+        create_agency('Arada Police Station')
+        self.assertEqual(len(get_agencies_snapshot()), 2)
+
+        agency.delete()
+        self.assertEqual(len(get_agencies_snapshot()), 1)
+
+    def test_bulk_writes_invalidate_through_dataset_changed(self):
+        create_agency('Bole Police Station')
+        snapshot = get_agencies_snapshot()
+        Agency.objects.filter(name='Bole Police Station').update(
+            phone='+251999', updated_at=timezone.now()
+        )
+        # Queryset updates skip the signals, so the snapshot stays until the
+        # check interval passes or dataset_changed() is called
+        self.assertIs(get_agencies_snapshot(), snapshot)
+
+        dataset_changed()
+        self.assertEqual(get_agencies_snapshot().agencies[0]['phone'], '+251999')
+
+
+@override_settings(AGENCY_SNAPSHOT_CHECK_INTERVAL=600)
+class AgencyConditionalTests(TestCase):
+    def setUp(self):
+        invalidate_agency_snapshot()
+        create_agency('Bole Police Station')
+        self.url = reverse('api_all_agencies')
+
+    def test_gzip_response_has_weak_etag_and_vary(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        data = json.loads(gzip.decompress(response.content))
+        self.assertEqual(
+            [agency['name'] for agency in data['agencies']], ['Bole Police Station']
+        )
+
+    def test_identity_response_shares_the_etag(self):
+        gzipped = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        plain = self.client.get(self.url, HTTP_ACCEPT_ENCODING='identity')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertEqual(plain['ETag'], gzipped['ETag'])
+
+    def test_matching_etag_is_not_modified(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT_ENCODING='gzip'
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        # The strong form of the tag matches too: If-None-Match uses weak comparison
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag[2:])
+        self.assertEqual(response.status_code, 304)
+
+    def test_unchanged_last_modified_is_not_modified(self):
+        last_modified = self.client.get(self.url)['Last-Modified']
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_changed_data_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        create_agency('Arada Police Station')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class AgencyPayloadTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.snapshot = AgencySnapshot([], 'database', 'v1', None)
+
+    def test_accept_encoding_ignores_zero_quality(self):
+        self.assertEqual(
+            parse_accept_encoding('gzip;q=0.5, br;q=0, identity'), {'gzip', 'identity'}
+        )
+        self.assertEqual(parse_accept_encoding(''), set())
+
+    def test_variant_is_compressed_once(self):
+        payload = EncodedPayload(json.dumps(['x' * 40] * 40).encode())
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        first = payload.response(request)
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+        self.assertIs(payload.variant('gzip'), payload.variant('gzip'))
+        self.assertEqual(gzip.decompress(first.content), payload.content)
+
+    def test_small_payload_is_sent_uncompressed(self):
+        payload = EncodedPayload(b'[]')
+        response = payload.response(self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertNotIn('Content-Encoding', response)
+        self.assertEqual(response.content, b'[]')
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    def test_payload_is_built_once_per_snapshot_and_language(self):
+        builds = []
+
+        def build(snapshot):
+            builds.append(snapshot.version)
+            return b'{}'
+
+        first = get_payload(self.snapshot, 'all', build)
+        self.assertIs(get_payload(self.snapshot, 'all', build), first)
+        get_payload(self.snapshot, 'all', build, language='am')
+        self.assertEqual(builds, ['v1', 'v1'])
+
+        replaced = AgencySnapshot([], 'database', 'v2', None)
+        self.assertIsNot(get_payload(replaced, 'all', build), first)
+        self.assertEqual(builds, ['v1', 'v1', 'v2'])
+
+    @override_settings(AGENCY_PAYLOAD_CACHE_SIZE=2)
+    def test_payload_cache_keeps_only_recent_entries(self):
+        builds = []
+
+        def build(snapshot):
+            builds.append(len(builds))
+            return b'{}'
+
+        for name in ('tile-1', 'tile-2', 'tile-1', 'tile-3'):
+            get_payload(self.snapshot, name, build)
+        self.assertEqual(len(builds), 3)
+        # tile-2 was the least recently used and has been evicted
+        get_payload(self.snapshot, 'tile-1', build)
+        self.assertEqual(len(builds), 3)
+        get_payload(self.snapshot, 'tile-2', build)
+        self.assertEqual(len(builds), 4)
+
+
+class AgencySyncTests(TestCase):
+    def test_apply_batch_creates_updates_and_skips(self):
+        records = [
+            external_record(1),
+            external_record(2),
+            external_record(3, latitude=None),
+        ]
+        self.assertEqual(apply_batch(records), (2, 0, 0, 1))
+
+        records[1] = external_record(2, phone='+251222000000')
+        self.assertEqual(apply_batch(records[:2]), (0, 1, 1, 0))
+        self.assertEqual(Agency.objects.get(external_id='ext-2').phone, '+251222000000')
+
+    def test_new_agencies_get_unique_slugs(self):
+        apply_batch(
+            [external_record(1, name='Clinic'), external_record(2, name='Clinic')]
+        )
+        slugs = list(Agency.objects.values_list('slug', flat=True))
+        self.assertEqual(len(set(slugs)), 2)
+
+    def test_values_are_clipped_to_the_columns(self):
+        values = agency_values(
+            external_record(1, name='n' * 300, zone='z' * 300, alt_phone='9' * 40)
+        )
+        self.assertEqual(len(values['name']), 100)
+        self.assertEqual(len(values['zone']), 100)
+        self.assertEqual(len(values['alt_phone']), 20)
+
+    def test_invalid_email_is_rejected(self):
+        with self.assertRaises(ValueError):
+            agency_values(external_record(1, email='not-an-email'))
+        self.assertEqual(
+            apply_batch([external_record(1, email='not-an-email')]), (0, 0, 0, 1)
+        )
+
+    def test_sync_pages_from_the_stored_cursor(self):
+        source = 'https://directory.example/agencies'
+        feed = [external_record(number) for number in range(1, 8)]
+        requests_made = []
+
+        def fake_get(url, params=None, timeout=None):
+            requests_made.append(dict(params))
+            since = params.get('updated_since', '')
+            page = [record for record in feed if record['updated_at'] >= since]
+            return mock.Mock(
+                json=mock.Mock(return_value=page[: params['limit']]),
+                raise_for_status=mock.Mock(),
+            )
+
+        with mock.patch(
+            'emergency_bot.agencies.sync.requests.get', side_effect=fake_get
+        ):
+            totals = sync_agencies(source, batch_size=3)
+            self.assertEqual(totals['created'], 7)
+            self.assertTrue(all(params['limit'] == 3 for params in requests_made))
+            state = AgencySyncState.objects.get(source=source)
+            self.assertEqual(state.cursor, feed[-1]['updated_at'])
+
+            # Nothing new: one request from the cursor, nothing written
+            requests_made.clear()
+            totals = sync_agencies(source, batch_size=3)
+            self.assertEqual(
+                requests_made, [{'limit': 3, 'updated_since': feed[-1]['updated_at']}]
+            )
+            self.assertEqual((totals['created'], totals['updated']), (0, 0))
+        self.assertEqual(Agency.objects.count(), 7)
+
+
+@override_settings(AGENCY_SNAPSHOT_CHECK_INTERVAL=600)
+class AgencyKeysetPagingTests(TestCase):
+    def setUp(self):
+        invalidate_agency_snapshot()
+        for name in ('Delta', 'Alpha', 'Charlie', 'Bravo', 'Echo'):
+            create_agency(name)
+        # Same name: the id breaks the tie
+        create_agency('Bravo', region='Amhara')
+        self.url = reverse('api_all_agencies')
+
+    def test_pages_cover_every_agency_once_in_order(self):
+        names = []
+        ids = []
+        cursor = None
+        for _ in range(10):
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            data = self.client.get(self.url, params).json()
+            names += [agency['name'] for agency in data['agencies']]
+            ids += [agency['id'] for agency in data['agencies']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(names, ['Alpha', 'Bravo', 'Bravo', 'Charlie', 'Delta', 'Echo'])
+        self.assertEqual(len(set(ids)), 6)
+
+    def test_stream_resumes_after_cursor(self):
+        first = self.client.get(self.url, {'limit': 3}).json()
+        response = self.client.get(
+            self.url, {'format': 'ndjson', 'cursor': first['next_cursor']}
+        )
+        lines = b''.join(response.streaming_content).splitlines()
+        self.assertEqual(
+            [json.loads(line)['name'] for line in lines], ['Charlie', 'Delta', 'Echo']
+        )
+
+    def test_malformed_cursor_is_rejected(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_without_database_id_is_rejected(self):
+        cursor = base64.urlsafe_b64encode(json.dumps(['Bravo', 'ext-1']).encode())
+        cursor = cursor.decode().rstrip('=')
+        for params in ({'cursor': cursor}, {'cursor': cursor, 'format': 'ndjson'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+
+
+def random_agencies(count, seed, types=('police', 'hospital', 'shelter')):
+    rng = random.Random(seed)
+    south, west, north, east = ETHIOPIA_BOUNDS
+    return [
+        {
+            'id': str(uuid.UUID(int=rng.getrandbits(128))),
+            'type': rng.choice(types),
+            'latitude': rng.uniform(south, north),
+            'longitude': rng.uniform(west, east),
+        }
+        for _ in range(count)
+    ]
+
+
+@skipIf(np is None, 'NumPy is not installed')
+class NearestGridTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.grid_dir = directory
+
+    def build(self, snapshot, full=False, directory=None, cell_size=0.5, depth=4):
+        with override_settings(AGENCY_GRID_DIR=directory or self.grid_dir):
+            path, _, incremental = build_nearest_grid(
+                snapshot, full=full, cell_size=cell_size, depth=depth
+            )
+        return NearestGrid.load(path), incremental
+
+    def assert_same_matches(self, grid_matches, index_matches):
+        self.assertEqual(
+            [agency_id for _, agency_id in grid_matches],
+            [str(agency['id']) for _, agency in index_matches],
+        )
+        for (grid_distance, _), (index_distance, _) in zip(grid_matches, index_matches):
+            self.assertAlmostEqual(grid_distance, index_distance, places=6)
+
+    def test_answers_match_the_spatial_index_on_random_points(self):
+        agencies = random_agencies(400, seed=3)
+        grid, _ = self.build(AgencySnapshot(agencies, 'database', 'v1', None))
+        index = SpatialIndex(agencies, 0.5)
+        rng = random.Random(4)
+        south, west, north, east = ETHIOPIA_BOUNDS
+        answered = 0
+        for _ in range(300):
+            lat, lng = rng.uniform(south, north), rng.uniform(west, east)
+            agency_type = rng.choice(['police', 'hospital', 'shelter'])
+            k = rng.randint(1, 3)
+            radius = rng.uniform(10, 150)
+
+            matches = grid.nearest(lat, lng, agency_type, k)
+            if matches is not None:
+                answered += 1
+                expected = index.nearest_by_type(lat, lng, [agency_type], k)
+                self.assert_same_matches(matches, expected[agency_type])
+
+            matches = grid.within_radius(lat, lng, radius, agency_type)
+            if matches is not None:
+                answered += 1
+                expected = index.within_radius(lat, lng, radius, agency_type)
+                self.assert_same_matches(matches, expected)
+        # The grid is only useful if it can answer most queries on its own
+        self.assertGreater(answered, 300)
+
+    def test_full_cell_cannot_answer_beyond_its_slots(self):
+        # Six police stations on a ring ~200 km around one cell: its two slots
+        # are full and every station is about as far as the stored ones
+        center_lat, center_lng = 9.25, 38.75
+        agencies = [
+            {
+                'id': f'ring-{i}',
+                'type': 'police',
+                'latitude': center_lat + 1.8 * math.sin(i * math.pi / 3),
+                'longitude': center_lng + 1.8 * math.cos(i * math.pi / 3),
+            }
+            for i in range(6)
+        ]
+        grid, _ = self.build(AgencySnapshot(agencies, 'database', 'v1', None), depth=2)
+        row, col = grid.cell(center_lat, center_lng)
+        self.assertNotIn(EMPTY, list(grid.ids[row, col, grid.type_index['police']]))
+
+        point = (center_lat + 0.2, center_lng - 0.2)
+        self.assertIsNone(grid.nearest(*point, 'police', 2))
+        self.assertIsNone(grid.nearest(*point, 'police', 3))
+        self.assertIsNone(grid.within_radius(*point, 250, 'police'))
+        # The spatial index still has answers, so None means "ask it", not "none"
+        index = SpatialIndex(agencies, 0.5)
+        self.assertEqual(len(index.within_radius(*point, 250, 'police')), 6)
+        # A radius short of every unstored agency can be answered
+        self.assertEqual(grid.within_radius(*point, 50, 'police'), [])
+
+    @override_settings(AGENCY_SNAPSHOT_CHECK_INTERVAL=600)
+    def test_incremental_rebuild_after_an_edit_matches_a_full_build(self):
+        invalidate_agency_snapshot()
+        for number, agency in enumerate(random_agencies(150, seed=8)):
+            create_agency(
+                f'Agency {number}',
+                type=agency['type'],
+                latitude=agency['latitude'],
+                longitude=agency['longitude'],
+            )
+        self.build(get_agencies_snapshot())
+
+        agencies = list(Agency.objects.order_by('name'))
+        agencies[0].latitude, agencies[0].longitude = 9.03, 38.74
+        agencies[0].save()
+        agencies[1].type = 'shelter' if agencies[1].type != 'shelter' else 'police'
+        agencies[1].save()
+        agencies[2].delete()
+        create_agency('New Police Station', latitude=9.02, longitude=38.76)
+        snapshot = get_agencies_snapshot()
+
+        incremental, was_incremental = self.build(snapshot)
+        self.assertTrue(was_incremental)
+        full_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, full_dir, ignore_errors=True)
+        full, _ = self.build(snapshot, full=True, directory=full_dir)
+
+        def agency_ids(grid):
+            ids = np.array(
+                [entry[0] if entry else '' for entry in grid.agencies] + ['']
+            )
+            slots = np.where(grid.ids == EMPTY, len(grid.agencies), grid.ids)
+            return ids[slots]
+
+        self.assertTrue(np.array_equal(agency_ids(incremental), agency_ids(full)))
+        self.assertTrue(np.allclose(incremental.distances, full.distances))
+
+
+def search_agency(number, name, **fields):
+    agency = {
+        'id': f'agency-{number}',
+        'name': name,
+        'services': '',
+        'address': '',
+        'description': '',
+    }
+    agency.update(fields)
+    return agency
+
+
+SEARCH_AGENCIES = [
+    search_agency(1, 'Bole Hospital', address='Bole, Addis Ababa'),
+    search_agency(2, 'Bole Police Station', address='Bole, Addis Ababa'),
+    search_agency(3, 'ጎንደር ፖሊስ ጣቢያ', address='ጎንደር'),
+    search_agency(4, 'Gondar University Hospital', address='Gondar'),
+    search_agency(5, 'ቅዱስ ጳውሎስ ሆስፒታል', services='ድንገተኛ ህክምና'),
+    search_agency(6, 'Women Shelter', services='counselling, legal aid'),
+]
+
+
+class AgencySearchTests(TestCase):
+    def setUp(self):
+        self.index = SearchIndex(SEARCH_AGENCIES)
+
+    def names(self, query, index=None):
+        return [agency['name'] for agency in (index or self.index).search(query)]
+
+    def test_geez_query_matches_latin_name(self):
+        self.assertEqual(self.names('ቦሌ ሆስፒታል')[0], 'Bole Hospital')
+
+    def test_latin_query_matches_geez_name(self):
+        self.assertEqual(self.names('gonder polis')[0], 'ጎንደር ፖሊስ ጣቢያ')
+        self.assertIn('ቅዱስ ጳውሎስ ሆስፒታል', self.names('hospital'))
+
+    def test_misspelled_query_ranks_the_right_agency_first(self):
+        self.assertEqual(self.names('Bolle Hospitl')[0], 'Bole Hospital')
+        self.assertEqual(self.names('Gondr Univrsity')[0], 'Gondar University Hospital')
+        self.assertEqual(self.names('shelterr')[0], 'Women Shelter')
+
+    def test_partial_word_matches_as_prefix(self):
+        self.assertEqual(self.names('couns')[0], 'Women Shelter')
+        self.assertEqual(self.names('police stat')[0], 'Bole Police Station')
+
+    def test_incremental_rebuild_matches_a_fresh_build(self):
+        agencies = [dict(agency) for agency in SEARCH_AGENCIES]
+        agencies[0]['name'] = 'Bole Referral Hospital'
+        agencies[5]['services'] = 'ምክር አገልግሎት'
+        del agencies[2]
+        agencies.append(search_agency(7, 'Mekelle Police Station', address='መቀሌ'))
+
+        incremental = SearchIndex(agencies, previous=self.index)
+        fresh = SearchIndex(agencies)
+        self.assertEqual(incremental.postings, fresh.postings)
+        for query in ('ቦሌ ሆስፒታል', 'referral', 'meqele polis', 'gonder', 'ምክር'):
+            self.assertEqual(
+                self.names(query, incremental), self.names(query, fresh), query
+            )
+        # Edits and removals are not served from the reused tokens
+        self.assertEqual(
+            self.names('referral', incremental), ['Bole Referral Hospital']
+        )
+        self.assertNotIn('ጎንደር ፖሊስ ጣቢያ', self.names('gonder', incremental))
+
+
+@override_settings(EXTERNAL_AGENCIES_TTL=600)
+class ExternalFeedRefreshTests(TestCase):
+    url = 'https://directory.example/agencies.json'
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        copy_settings = override_settings(
+            EXTERNAL_AGENCIES_CACHE_FILE=os.path.join(directory, 'agencies.json')
+        )
+        copy_settings.enable()
+        self.addCleanup(copy_settings.disable)
+
+    def refresh(self, **get_kwargs):
+        # What schedule_refresh() runs in its thread, run here synchronously
+        self.assertTrue(feed._refresh_lock.acquire(blocking=False))
+        cache.add(feed.REFRESH_LOCK_KEY, True, 60)
+        with mock.patch('emergency_bot.agencies.feed.requests.get', **get_kwargs):
+            feed._refresh_in_background(self.url)
+        self.assertFalse(feed._refresh_lock.locked())
+
+    def test_failed_refresh_keeps_the_lock_with_doubling_backoff(self):
+        error = requests.ConnectionError('unreachable')
+        self.refresh(side_effect=error)
+        self.assertTrue(cache.get(feed.REFRESH_LOCK_KEY))
+        self.assertEqual(cache.get(feed.REFRESH_BACKOFF_KEY), feed.RETRY_DELAY)
+        with mock.patch.object(feed.threading, 'Thread') as thread:
+            self.assertFalse(feed.schedule_refresh(self.url))
+        thread.assert_not_called()
+
+        backoffs = []
+        for _ in range(5):
+            cache.delete(feed.REFRESH_LOCK_KEY)
+            self.refresh(side_effect=error)
+            backoffs.append(cache.get(feed.REFRESH_BACKOFF_KEY))
+        self.assertEqual(backoffs, [120, 240, 480, 600, 600])
+
+    def test_successful_refresh_resets_the_backoff(self):
+        self.refresh(side_effect=requests.ConnectionError('unreachable'))
+        cache.delete(feed.REFRESH_LOCK_KEY)
+        response = mock.Mock(status_code=200)
+        response.json.return_value = [{'name': 'Bole Police Station'}]
+        self.refresh(return_value=response)
+
+        self.assertIsNone(cache.get(feed.REFRESH_LOCK_KEY))
+        self.assertIsNone(cache.get(feed.REFRESH_BACKOFF_KEY))
+        agencies, source = feed.get_external_agencies(self.url)
+        self.assertEqual(agencies, response.json.return_value)
+        self.assertEqual(source, 'internet_cached')
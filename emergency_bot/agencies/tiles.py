@@ -0,0 +1,122 @@
+"""
+Server-side agency clustering on Web Mercator (z/x/y) map tiles.
+
+Each tile is split into a ``CLUSTER_GRID`` x ``CLUSTER_GRID`` grid and the
+agencies in every grid cell are aggregated into one cluster with a count,
+a centroid and per-type counts. A whole zoom level is clustered in one
+pass over the agencies the first time any of its tiles is requested, and
+the result is kept on the agency snapshot, so it is rebuilt only when the
+dataset version changes.
+"""
+
+import math
+
+MAX_ZOOM = 20
+CLUSTER_GRID = 8
+
+# Web Mercator cannot represent the poles
+MAX_LATITUDE = 85.05112878
+
+
+def project(latitude, longitude):
+    """Return the Web Mercator position of a point in world units of [0, 1)."""
+    latitude = max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE)
+    x = (longitude + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1 - 1e-12), min(max(y, 0.0), 1 - 1e-12)
+
+
+def tile_bounds(z, x, y):
+    """Return ``(south, west, north, east)`` of a tile in degrees."""
+    n = 2**z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    return (
+        latitude(y + 1),
+        x / n * 360.0 - 180.0,
+        latitude(y),
+        (x + 1) / n * 360.0 - 180.0,
+    )
+
+
+class _Cluster:
+    __slots__ = ('count', 'lat_sum', 'lng_sum', 'types', 'agency')
+
+    def __init__(self):
+        self.count = 0
+        self.lat_sum = 0.0
+        self.lng_sum = 0.0
+        self.types = {}
+        self.agency = None
+
+    def add(self, agency, latitude, longitude):
+        self.count += 1
+        self.lat_sum += latitude
+        self.lng_sum += longitude
+        agency_type = agency.get('type') or 'other'
+        self.types[agency_type] = self.types.get(agency_type, 0) + 1
+        self.agency = agency if self.count == 1 else None
+
+    def as_dict(self):
+        cluster = {
+            'latitude': round(self.lat_sum / self.count, 6),
+            'longitude': round(self.lng_sum / self.count, 6),
+            'count': self.count,
+            'types': self.types,
+        }
+        if self.agency is not None:
+            # A lone agency is sent as a marker the client can open directly
+            cluster['agency'] = {
+                'id': self.agency.get('id'),
+                'name': self.agency.get('name'),
+                'type': self.agency.get('type'),
+                'phone': self.agency.get('phone'),
+            }
+        return cluster
+
+
+class ZoomClusters:
+    """Clusters of every non-empty tile at one zoom level."""
+
+    def __init__(self, agencies, zoom, agency_type=None):
+        self.zoom = zoom
+        scale = 2**zoom * CLUSTER_GRID
+        cells = {}
+        for agency in agencies:
+            if agency_type and agency.get('type') != agency_type:
+                continue
+            try:
+                latitude = float(agency['latitude'])
+                longitude = float(agency['longitude'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            px, py = project(latitude, longitude)
+            cell = (int(px * scale), int(py * scale))
+            cluster = cells.get(cell)
+            if cluster is None:
+                cluster = cells[cell] = _Cluster()
+            cluster.add(agency, latitude, longitude)
+
+        # (x, y) -> list of cluster dicts, biggest first
+        self.tiles = {}
+        for (cx, cy), cluster in cells.items():
+            self.tiles.setdefault((cx // CLUSTER_GRID, cy // CLUSTER_GRID), []).append(
+                cluster.as_dict()
+            )
+        for clusters in self.tiles.values():
+            clusters.sort(key=lambda cluster: -cluster['count'])
+
+    def tile(self, x, y):
+        """Return the clusters of tile (x, y); empty for tiles without agencies."""
+        return self.tiles.get((x, y), [])
+
+
+def get_zoom_clusters(snapshot, zoom, agency_type=None):
+    """Return the ``ZoomClusters`` for ``zoom`` built once per snapshot."""
+    return snapshot.derived(
+        f'tiles:{zoom}:{agency_type or ""}',
+        lambda current: ZoomClusters(current.agencies, zoom, agency_type),
+    )
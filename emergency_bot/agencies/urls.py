@@ -7,8 +7,10 @@ urlpatterns = [
     # API endpoints for agencies
     path('all/', views.all_agencies, name='api_all_agencies'),
     path('nearby/', views.nearby_agencies, name='api_nearby_agencies'),
+    path('nearest/', views.nearest_agencies, name='api_nearest_agencies'),
     path('detail/<str:agency_id>/', views.agency_detail, name='api_agency_detail'),
     path('search/', views.search_agencies, name='api_search_agencies'),
+    path('tiles/<int:z>/<int:x>/<int:y>/', views.agency_tile, name='api_agency_tile'),
     path('locations/regions/', views.get_regions, name='api_get_regions'),
     path('locations/zones/', views.get_zones, name='api_get_zones'),
     path('locations/woredas/', views.get_woredas, name='api_get_woredas'),
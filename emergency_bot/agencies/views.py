@@ -2,20 +2,33 @@
 Views for the agencies app.
 """
 
+import base64
 import json
 import logging
 import math
-import requests
+import uuid
+from bisect import bisect_right
 from django.shortcuts import render
-from django.http import JsonResponse
-from django.views.decorators.http import require_GET
-from django.db.models import F, ExpressionWrapper, FloatField
+from django.http import JsonResponse, StreamingHttpResponse
+from django.db.models import Q
+from functools import wraps
+from django.views.decorators.http import condition, require_GET
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.contrib.auth.decorators import login_required
 from django.core.cache import cache
 from django.conf import settings
 
 from emergency_bot.accounts.middleware import telegram_auth_required
+from .distance import haversine_km
+from .feed import get_external_agencies
+from .grid import get_nearest_grid
+from .hierarchy import matches as location_matches
+from .lookup import agency_cache, agency_keys, build_key_map
 from .models import Agency
+from .payloads import get_payload
+from .search import linear_search
+from .snapshot import get_agency_snapshot, peek_agency_snapshot, refresh_agency_snapshot_async
+from .tiles import MAX_ZOOM, get_zoom_clusters, tile_bounds
 
 logger = logging.getLogger(__name__)
 
@@ -410,21 +423,40 @@ FALLBACK_AGENCIES = [
     }
 ]
 
+# Hard-coded fallback agencies keyed by id and slug
+FALLBACK_AGENCY_MAP = build_key_map(FALLBACK_AGENCIES)
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """
     Calculate the Haversine distance between two points in kilometers.
     """
-    # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
-    
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
-    r = 6371  # Radius of Earth in kilometers
-    
-    return c * r
+    return haversine_km(float(lat1), float(lon1), float(lat2), float(lon2))
+
+def serialize_agency(agency):
+    """
+    Convert an Agency instance to the dict format used by the API.
+    """
+    return {
+        'id': str(agency.id),
+        'slug': agency.slug,
+        'name': agency.name,
+        'type': agency.type,
+        'description': agency.description,
+        'region': agency.region,
+        'zone': agency.zone,
+        'woreda': agency.woreda,
+        'kebele': agency.kebele,
+        'phone': agency.phone,
+        'alt_phone': agency.alt_phone,
+        'email': agency.email,
+        'address': agency.address,
+        'latitude': float(agency.latitude),
+        'longitude': float(agency.longitude),
+        'hours_of_operation': agency.hours_of_operation,
+        'services': agency.services,
+        'verified': agency.verified,
+        'active': agency.active
+    }
 
 def get_agencies_from_database():
     """
@@ -432,30 +464,9 @@ def get_agencies_from_database():
     Returns tuple: (agencies_list, source)
     """
     try:
-        agencies = Agency.objects.filter(active=True)
-        if agencies.exists():
-            result = []
-            for agency in agencies:
-                result.append({
-                    'id': str(agency.id),
-                    'name': agency.name,
-                    'type': agency.type,
-                    'description': agency.description,
-                    'region': agency.region,
-                    'zone': agency.zone,
-                    'woreda': agency.woreda,
-                    'kebele': agency.kebele,
-                    'phone': agency.phone,
-                    'alt_phone': agency.alt_phone,
-                    'email': agency.email,
-                    'address': agency.address,
-                    'latitude': float(agency.latitude),
-                    'longitude': float(agency.longitude),
-                    'hours_of_operation': agency.hours_of_operation,
-                    'services': agency.services,
-                    'verified': agency.verified,
-                    'active': agency.active
-                })
+        agencies = list(Agency.objects.filter(active=True))
+        if agencies:
+            result = [serialize_agency(agency) for agency in agencies]
             logger.info(f"Loaded {len(result)} agencies from database")
             return result, 'database'
         else:
@@ -465,37 +476,43 @@ def get_agencies_from_database():
         logger.error(f"Database error: {e}")
         return [], 'database_error'
 
+def get_nearby_from_database(latitude, longitude, max_distance, agency_type=None):
+    """
+    Find agencies within max_distance straight from the database, using the
+    bounding-box prefilter on the (latitude, longitude) index.
+    Returns a list of (distance, agency_dict) pairs, or None if the database
+    has no agencies or is unavailable.
+    """
+    try:
+        active = Agency.objects.filter(active=True)
+        queryset = active.within_radius(latitude, longitude, max_distance)
+        if agency_type:
+            queryset = queryset.filter(type=agency_type)
+        result = [(agency.distance, serialize_agency(agency)) for agency in queryset]
+        if not result and not active.exists():
+            return None
+        return result
+    except Exception as e:
+        logger.error(f"Database error in nearby lookup: {e}")
+        return None
+
 def get_agencies_from_internet():
     """
-    Fetch agencies from external API with caching.
+    Get agencies from the external API using stale-while-revalidate caching.
+    Never waits on the network: the last good copy is served while a single
+    background refresh fetches a new one.
     Returns tuple: (agencies_list, source)
     """
     try:
-        # Check cache first
-        cached_agencies = cache.get('external_agencies')
-        if cached_agencies:
-            logger.info(f"Loaded {len(cached_agencies)} agencies from cache")
-            return cached_agencies, 'internet_cached'
-        
-        # Try to fetch from external API (placeholder URL)
         external_api_url = getattr(settings, 'EXTERNAL_AGENCIES_API_URL', None)
-        if external_api_url:
-            response = requests.get(external_api_url, timeout=10)
-            if response.status_code == 200:
-                agencies_data = response.json()
-                # Cache for 1 hour
-                cache.set('external_agencies', agencies_data, 3600)
-                logger.info(f"Loaded {len(agencies_data)} agencies from external API")
-                return agencies_data, 'internet'
-            else:
-                logger.warning(f"External API returned status {response.status_code}")
-        else:
+        if not external_api_url:
             logger.info("No external API URL configured")
+            return [], 'internet_unavailable'
         
-        return [], 'internet_unavailable'
-    except requests.RequestException as e:
-        logger.warning(f"Internet request failed: {e}")
-        return [], 'internet_error'
+        agencies, source = get_external_agencies(external_api_url)
+        if agencies:
+            logger.info(f"Loaded {len(agencies)} agencies from {source}")
+        return agencies, source
     except Exception as e:
         logger.error(f"Unexpected error fetching from internet: {e}")
         return [], 'internet_error'
@@ -525,6 +542,47 @@ def get_agencies_with_fallback():
     # Step 3: Use hard-coded fallback
     return FALLBACK_AGENCIES, 'fallback'
 
+def get_agencies_snapshot():
+    """
+    Return the process-wide snapshot of agencies loaded with the fallback strategy.
+    The snapshot is only reloaded when the underlying data changes.
+    """
+    return get_agency_snapshot(get_agencies_with_fallback)
+
+def _agencies_etag(request, *args, **kwargs):
+    # Weak: gzip, br and identity bodies of one version share the tag, which
+    # RFC 9110 only allows for weak validators
+    return f'W/"{get_agencies_snapshot().version}"'
+
+def _agencies_last_modified(request, *args, **kwargs):
+    return get_agencies_snapshot().last_modified
+
+def agencies_conditional(view_func):
+    """
+    Decorator adding ETag/Last-Modified support to views whose output depends
+    only on the agency dataset and the request URL.
+    
+    Unchanged data is answered with 304 Not Modified before the view runs,
+    and responses are marked no-cache so clients always revalidate. The
+    ETag is weak because it does not change with the content coding.
+    """
+    conditional_view = condition(
+        etag_func=_agencies_etag,
+        last_modified_func=_agencies_last_modified,
+    )(view_func)
+    
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        if response.status_code == 304:
+            # A 304 carries the Vary of the response it stands in for, which
+            # may have been a compressed payload
+            patch_vary_headers(response, ('Accept-Encoding',))
+        patch_cache_control(response, no_cache=True)
+        return response
+    
+    return wrapped_view
+
 @telegram_auth_required
 @require_GET
 def nearby_agencies(request):
@@ -548,32 +606,32 @@ def nearby_agencies(request):
         lng = float(longitude)
         max_dist = float(max_distance)
         
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        matches = None
+        snapshot = peek_agency_snapshot()
+        if snapshot is None:
+            # Snapshot is cold or invalidated: answer from the indexed database
+            # query while the snapshot is rebuilt in the background
+            matches = get_nearby_from_database(lat, lng, max_dist, agency_type)
+            source = 'database'
+            if matches is not None:
+                refresh_agency_snapshot_async(get_agencies_with_fallback)
+        
+        if matches is None:
+            # No database agencies: build the snapshot here (once) and use it
+            snapshot = get_agencies_snapshot()
+            source = snapshot.source
+            matches = _nearby_from_grid(snapshot, lat, lng, max_dist, agency_type)
+        
+        if matches is None:
+            # Only agencies in spatial index cells overlapping the radius are
+            # measured; results come back filtered by type, closest first
+            matches = snapshot.spatial_index.within_radius(lat, lng, max_dist, agency_type)
         
-        # Calculate distance for each agency
         result = []
-        for agency in agencies:
-            try:
-                agency_lat = float(agency['latitude'])
-                agency_lng = float(agency['longitude'])
-                distance = calculate_distance(lat, lng, agency_lat, agency_lng)
-                
-                # Apply distance filter
-                if distance <= max_dist:
-                    # Apply type filter if specified
-                    if agency_type and agency.get('type') != agency_type:
-                        continue
-                    
-                    agency_data = agency.copy()
-                    agency_data['distance'] = round(distance, 2)
-                    result.append(agency_data)
-            except (ValueError, KeyError) as e:
-                logger.warning(f"Skipping agency due to invalid coordinates: {e}")
-                continue
-        
-        # Sort by distance (closest first)
-        result.sort(key=lambda x: x.get('distance', float('inf')))
+        for distance, agency in matches:
+            agency_data = agency.copy()
+            agency_data['distance'] = round(distance, 2)
+            result.append(agency_data)
         
         # Add metadata about data source and filters
         response_data = {
@@ -596,52 +654,181 @@ def nearby_agencies(request):
         return JsonResponse({'error': str(e)}, status=500)
 
 
+def _nearby_from_grid(snapshot, latitude, longitude, max_distance, agency_type):
+    """
+    Read a typed radius query from the precomputed grid when it is built for
+    this snapshot and can prove the answer complete; otherwise None.
+    """
+    if not agency_type:
+        # The grid only covers the model's agency types
+        return None
+    grid = get_nearest_grid(snapshot)
+    if grid is None:
+        return None
+    matches = grid.within_radius(latitude, longitude, max_distance, agency_type)
+    if matches is None:
+        return None
+    key_map = snapshot.key_map
+    return [(distance, key_map[agency_id]) for distance, agency_id in matches]
+
+NEAREST_FIELDS = ('id', 'name', 'type', 'phone', 'address', 'latitude', 'longitude')
+MAX_NEAREST_PER_TYPE = 10
+
+# Upper bound on ranked results returned for a text query
+MAX_SEARCH_RESULTS = 50
+
+# Keyset page sizes for all_agencies
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+def find_nearest_by_type(latitude, longitude, types=None, k=3, max_distance=None):
+    """
+    Return the ``k`` closest agencies of each type, e.g. the nearest police
+    station, hospital and shelter. Types the precomputed grid can answer are
+    read from it; the rest are computed in one pass over the spatial index.
+    Returns tuple: ({type: [agency_with_distance, ...]}, source)
+    """
+    snapshot = get_agencies_snapshot()
+    if not types:
+        types = [agency_type for agency_type, _ in Agency.AGENCY_TYPES]
+    
+    nearest = {}
+    grid = get_nearest_grid(snapshot)
+    if grid is not None:
+        key_map = snapshot.key_map
+        for agency_type in types:
+            matches = grid.nearest(latitude, longitude, agency_type, k)
+            if matches is not None:
+                nearest[agency_type] = [
+                    (distance, key_map[agency_id]) for distance, agency_id in matches
+                    if max_distance is None or distance <= max_distance
+                ]
+    
+    remaining = [agency_type for agency_type in types if agency_type not in nearest]
+    if remaining:
+        nearest.update(snapshot.spatial_index.nearest_by_type(latitude, longitude, remaining, k, max_distance))
+    result = {}
+    for agency_type, matches in nearest.items():
+        result[agency_type] = []
+        for distance, agency in matches:
+            agency_data = {field: agency.get(field) for field in NEAREST_FIELDS}
+            agency_data['distance'] = round(distance, 2)
+            result[agency_type].append(agency_data)
+    return result, snapshot.source
+
+@telegram_auth_required
 @require_GET
-def agency_detail(request, agency_id):
+def nearest_agencies(request):
     """
-    Get detailed information for a specific agency by ID.
-    Fetches from database with fallback strategy.
+    API endpoint returning the top-k nearest agencies for each requested type.
+    Query parameters: lat, lng, types (comma separated, default all), k, max_distance.
     """
     try:
-        # Try to get from database first
-        try:
-            agency = Agency.objects.get(id=agency_id, active=True)
-            agency_data = {
-                'id': agency.id,
-                'name': agency.name,
-                'type': agency.type,
-                'description': agency.description,
-                'region': agency.region,
-                'zone': agency.zone,
-                'woreda': agency.woreda,
-                'kebele': agency.kebele,
-                'phone': agency.phone,
-                'alt_phone': agency.alt_phone,
-                'email': agency.email,
-                'address': agency.address,
-                'latitude': float(agency.latitude),
-                'longitude': float(agency.longitude),
-                'hours_of_operation': agency.hours_of_operation,
-                'services': agency.services,
-                'verified': agency.verified,
-                'active': agency.active
+        latitude = request.GET.get('lat')
+        longitude = request.GET.get('lng')
+        
+        if not latitude or not longitude:
+            return JsonResponse({'error': 'Missing latitude or longitude'}, status=400)
+        
+        lat = float(latitude)
+        lng = float(longitude)
+        k = min(max(int(request.GET.get('k', '3')), 1), MAX_NEAREST_PER_TYPE)
+        max_distance = request.GET.get('max_distance')
+        max_dist = float(max_distance) if max_distance else None
+        
+        valid_types = {agency_type for agency_type, _ in Agency.AGENCY_TYPES}
+        types = [t.strip() for t in request.GET.get('types', '').split(',') if t.strip()]
+        invalid = [t for t in types if t not in valid_types]
+        if invalid:
+            return JsonResponse({'error': f"Unknown agency type: {', '.join(invalid)}"}, status=400)
+        
+        nearest, source = find_nearest_by_type(lat, lng, types, k, max_dist)
+        
+        response_data = {
+            'nearest': nearest,
+            'source': source,
+            'filters': {
+                'latitude': lat,
+                'longitude': lng,
+                'types': list(nearest),
+                'k': k,
+                'max_distance': max_dist
             }
-            logger.info(f"Retrieved agency detail from database: {agency.name}")
-            return JsonResponse(agency_data)
-        
-        except Agency.DoesNotExist:
-            # Agency not found in database, check fallback data
-            logger.warning(f"Agency ID {agency_id} not found in database, checking fallback")
-            
-            # Check fallback agencies
-            for agency in FALLBACK_AGENCIES:
-                if str(agency['id']) == str(agency_id):
-                    logger.info(f"Retrieved agency detail from fallback: {agency['name']}")
-                    return JsonResponse(agency)
-            
+        }
+        
+        logger.info(f"Returned nearest {k} agencies for {len(nearest)} types from {source}")
+        return JsonResponse(response_data)
+    
+    except ValueError as e:
+        return JsonResponse({'error': f'Invalid parameter: {e}'}, status=400)
+    except Exception as e:
+        logger.error(f"Error finding nearest agencies: {e}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+def _get_agency_from_database(key):
+    """
+    Fetch one active agency by UUID or slug.
+    Returns the agency dict or None.
+    """
+    try:
+        lookup = {'id': uuid.UUID(str(key))}
+    except ValueError:
+        lookup = {'slug': key}
+    try:
+        return serialize_agency(Agency.objects.get(active=True, **lookup))
+    except Agency.DoesNotExist:
+        return None
+
+def find_agency(key):
+    """
+    Resolve an agency by id or slug, avoiding a query on repeat lookups.
+    Checks the current snapshot, the LRU cache of database agencies, the
+    database and finally the hard-coded fallback list.
+    Returns tuple: (agency_dict or None, source)
+    """
+    key = str(key)
+    snapshot = peek_agency_snapshot()
+    if snapshot is not None:
+        agency_cache.bind_version(snapshot.version)
+        agency = snapshot.key_map.get(key)
+        if agency is not None:
+            return agency, snapshot.source
+    
+    cached = agency_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    agency = _get_agency_from_database(key)
+    if agency is not None:
+        for agency_key in agency_keys(agency):
+            agency_cache.set(agency_key, (agency, 'database'))
+        return agency, 'database'
+    
+    agency = FALLBACK_AGENCY_MAP.get(key)
+    if agency is not None:
+        # Cache the fallback agency under this key so repeat lookups skip the database query
+        agency_cache.set(key, (agency, 'fallback'))
+        return agency, 'fallback'
+    
+    return None, None
+
+@require_GET
+def agency_detail(request, agency_id):
+    """
+    Get detailed information for a specific agency by ID or slug.
+    Resolved through keyed lookups with the fallback strategy.
+    """
+    try:
+        agency, source = find_agency(agency_id)
+        
+        if agency is None:
             # Agency not found anywhere
             logger.warning(f"Agency ID {agency_id} not found in database or fallback")
             return JsonResponse({'error': 'Agency not found'}, status=404)
+        
+        logger.info(f"Retrieved agency detail from {source}: {agency['name']}")
+        return JsonResponse(agency)
     
     except Exception as e:
         logger.error(f"Error retrieving agency detail: {e}")
@@ -649,9 +836,12 @@ def agency_detail(request, agency_id):
 
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def search_agencies(request):
     """
-    API endpoint to search agencies by region, zone, woreda, kebele.
+    API endpoint to search agencies by region, zone, woreda, kebele and,
+    with ``q``, by ranked full-text/fuzzy matching on name, services,
+    address and description.
     Uses database-first approach with fallback.
     """
     try:
@@ -660,21 +850,34 @@ def search_agencies(request):
         zone = request.GET.get('zone')
         woreda = request.GET.get('woreda')
         kebele = request.GET.get('kebele')
+        query = request.GET.get('q', '').strip()
         
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        try:
+            limit = min(max(int(request.GET.get('limit', MAX_SEARCH_RESULTS)), 1), MAX_SEARCH_RESULTS)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid limit parameter'}, status=400)
         
-        # Apply filters if provided
-        filtered_agencies = agencies
+        # Get agencies from the shared snapshot
+        snapshot = get_agencies_snapshot()
+        source = snapshot.source
         
-        if region:
-            filtered_agencies = [a for a in filtered_agencies if a.get('region', '').lower() == region.lower()]
-        if zone:
-            filtered_agencies = [a for a in filtered_agencies if a.get('zone', '').lower() == zone.lower()]
-        if woreda:
-            filtered_agencies = [a for a in filtered_agencies if a.get('woreda', '') == woreda]
-        if kebele:
-            filtered_agencies = [a for a in filtered_agencies if a.get('kebele', '') == kebele]
+        # Apply filters through the hierarchy index, which works on snapshot
+        # positions because not every source gives agencies a (unique) id
+        location = {'region': region, 'zone': zone, 'woreda': woreda, 'kebele': kebele}
+        provisional = False
+        if query:
+            # Rank the filtered agencies against the text query
+            index = snapshot.ready_search_index()
+            if index is not None:
+                positions = None
+                if any(location.values()):
+                    positions = set(snapshot.hierarchy.filter_positions(**location))
+                filtered_agencies = index.search(query, limit=limit, positions=positions)
+            else:
+                filtered_agencies = _provisional_search(snapshot, query, limit, location)
+                provisional = True
+        else:
+            filtered_agencies = snapshot.hierarchy.filter(**location)
         
         # Add metadata about data source
         response_data = {
@@ -685,19 +888,39 @@ def search_agencies(request):
                 'region': region,
                 'zone': zone,
                 'woreda': woreda,
-                'kebele': kebele
+                'kebele': kebele,
+                'q': query or None
             }
         }
         
         logger.info(f"Returned {len(filtered_agencies)} filtered agencies from {source}")
-        return JsonResponse(response_data, safe=False)
+        response = JsonResponse(response_data, safe=False)
+        if provisional:
+            # Not the final ranking for this version's ETag; do not let anyone keep it
+            patch_cache_control(response, no_store=True)
+        return response
     
     except Exception as e:
         logger.error(f"Error searching agencies: {e}")
         return JsonResponse({'error': str(e)}, status=500)
 
+def _provisional_search(snapshot, query, limit, location):
+    """
+    Answer a text query while the snapshot's search index is being built:
+    from the previous snapshot's index when there is one, otherwise with a
+    linear scan of the location-filtered agencies.
+    """
+    previous = snapshot.previous_search_index
+    if previous is not None:
+        results = previous.search(query)
+        if any(location.values()):
+            results = [agency for agency in results if location_matches(agency, **location)]
+        return results[:limit]
+    return linear_search(snapshot.hierarchy.filter(**location), query, limit)
+
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def get_zones(request):
     """
     API endpoint to get zones for a given region.
@@ -709,15 +932,12 @@ def get_zones(request):
         if not region:
             return JsonResponse({'error': 'Missing region parameter'}, status=400)
         
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        # Get agencies from the shared snapshot
+        snapshot = get_agencies_snapshot()
+        source = snapshot.source
         
-        # Extract unique zones for the given region
-        zones = list(set(
-            agency.get('zone', '') for agency in agencies 
-            if agency.get('region', '').lower() == region.lower() and agency.get('zone')
-        ))
-        zones.sort()
+        # Look up the pre-sorted zones for the given region
+        zones = snapshot.hierarchy.children(region)
         
         response_data = {
             'zones': zones,
@@ -734,6 +954,7 @@ def get_zones(request):
 
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def get_woredas(request):
     """
     API endpoint to get woredas for a given region and zone.
@@ -746,17 +967,12 @@ def get_woredas(request):
         if not region or not zone:
             return JsonResponse({'error': 'Missing region or zone parameter'}, status=400)
         
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        # Get agencies from the shared snapshot
+        snapshot = get_agencies_snapshot()
+        source = snapshot.source
         
-        # Extract unique woredas for the given region and zone
-        woredas = list(set(
-            agency.get('woreda', '') for agency in agencies 
-            if (agency.get('region', '').lower() == region.lower() and 
-                agency.get('zone', '').lower() == zone.lower() and 
-                agency.get('woreda'))
-        ))
-        woredas.sort()
+        # Look up the pre-sorted woredas for the given region and zone
+        woredas = snapshot.hierarchy.children(region, zone)
         
         response_data = {
             'woredas': woredas,
@@ -774,6 +990,7 @@ def get_woredas(request):
 
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def get_kebeles(request):
     """
     API endpoint to get kebeles for a given region, zone, and woreda.
@@ -787,18 +1004,12 @@ def get_kebeles(request):
         if not region or not zone or not woreda:
             return JsonResponse({'error': 'Missing region, zone, or woreda parameter'}, status=400)
         
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        # Get agencies from the shared snapshot
+        snapshot = get_agencies_snapshot()
+        source = snapshot.source
         
-        # Extract unique kebeles for the given region, zone, and woreda
-        kebeles = list(set(
-            agency.get('kebele', '') for agency in agencies 
-            if (agency.get('region', '').lower() == region.lower() and 
-                agency.get('zone', '').lower() == zone.lower() and 
-                agency.get('woreda', '') == woreda and 
-                agency.get('kebele'))
-        ))
-        kebeles.sort()
+        # Look up the pre-sorted kebeles for the given region, zone, and woreda
+        kebeles = snapshot.hierarchy.children(region, zone, woreda)
         
         response_data = {
             'kebeles': kebeles,
@@ -817,57 +1028,203 @@ def get_kebeles(request):
 
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def all_agencies(request):
     """
     API endpoint to get all agencies with metadata about the data source.
+    
+    Without parameters the whole directory is served from a payload encoded
+    and compressed once per dataset version. ``limit`` (and the ``cursor``
+    returned as ``next_cursor``) pages through agencies ordered by
+    (name, id), and ``format=ndjson`` streams one agency per line; both
+    keep per-request memory flat however many agencies there are.
     """
     try:
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
+        snapshot = get_agencies_snapshot()
+        stream = request.GET.get('format') == 'ndjson'
+        paged = 'limit' in request.GET or 'cursor' in request.GET
+        
+        if not stream and not paged:
+            payload = get_payload(snapshot, 'all_agencies', _build_all_agencies_payload)
+            logger.info(f"Returned {len(snapshot)} total agencies from {snapshot.source}")
+            return payload.response(request)
         
+        try:
+            after = _decode_cursor(request.GET.get('cursor'))
+            if after and snapshot.source == 'database':
+                # Checked here, before a stream has started, rather than when it is read
+                uuid.UUID(after[1])
+        except ValueError:
+            return JsonResponse({'error': 'Invalid cursor parameter'}, status=400)
+        
+        if stream:
+            response = StreamingHttpResponse(
+                _stream_agencies(snapshot, after),
+                content_type='application/x-ndjson',
+            )
+            response['X-Data-Source'] = snapshot.source
+            return response
+        
+        try:
+            limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid limit parameter'}, status=400)
+        limit = min(max(limit, 1), MAX_PAGE_SIZE)
+        
+        agencies, next_key = _agencies_page(snapshot, after, limit)
         response_data = {
             'agencies': agencies,
-            'source': source,
+            'source': snapshot.source,
             'count': len(agencies),
-            'timestamp': cache.get('agencies_last_updated', 'unknown')
+            'next_cursor': _encode_cursor(next_key) if next_key else None,
+            'timestamp': snapshot.last_modified.isoformat() if snapshot.last_modified else 'unknown'
         }
-        
-        logger.info(f"Returned {len(agencies)} total agencies from {source}")
-        return JsonResponse(response_data, safe=False)
+        logger.info(f"Returned page of {len(agencies)} agencies from {snapshot.source}")
+        return JsonResponse(response_data)
     
     except Exception as e:
         logger.error(f"Error getting all agencies: {e}")
         return JsonResponse({'error': str(e)}, status=500)
 
+def _encode_cursor(key):
+    """Encode a (name, id) keyset position as an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    """Decode a cursor from ``_encode_cursor``; None means the first page."""
+    if not cursor:
+        return None
+    try:
+        name, agency_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(name, str) or not isinstance(agency_id, str):
+        raise ValueError('Invalid cursor')
+    return name, agency_id
+
+def _agency_sort_key(agency):
+    return agency.get('name') or '', str(agency.get('id'))
+
+def _name_order(snapshot):
+    """(name, id) keys and positions of the snapshot agencies, in keyset order."""
+    def build(current):
+        order = sorted(range(len(current.agencies)), key=lambda i: _agency_sort_key(current.agencies[i]))
+        return [_agency_sort_key(current.agencies[i]) for i in order], order
+    return snapshot.derived('name_order', build)
+
+def _database_keyset(after):
+    """
+    Active agencies after the (name, id) keyset position, in keyset order.
+    Raises ValueError when the id in ``after`` is not a database id.
+    """
+    queryset = Agency.objects.filter(active=True).order_by('name', 'id')
+    if after:
+        name, agency_id = after
+        agency_id = uuid.UUID(agency_id)
+        queryset = queryset.filter(Q(name__gt=name) | Q(name=name, id__gt=agency_id))
+    return queryset
+
+def _agencies_page(snapshot, after, limit):
+    """
+    Return ``(agencies, next_key)`` for one keyset page of ``limit`` agencies.
+    Database-backed snapshots are paged in SQL; other sources from memory.
+    """
+    if snapshot.source == 'database':
+        rows = list(_database_keyset(after)[:limit + 1])
+        agencies = [serialize_agency(agency) for agency in rows[:limit]]
+    else:
+        keys, order = _name_order(snapshot)
+        start = bisect_right(keys, after) if after else 0
+        rows = [snapshot.agencies[i] for i in order[start:start + limit + 1]]
+        agencies = rows[:limit]
+    next_key = _agency_sort_key(agencies[-1]) if len(rows) > limit else None
+    return agencies, next_key
+
+def _stream_agencies(snapshot, after):
+    """Yield agencies as NDJSON lines, reading the database in chunks."""
+    if snapshot.source == 'database':
+        chunk_size = getattr(settings, 'AGENCY_STREAM_CHUNK_SIZE', 500)
+        for agency in _database_keyset(after).iterator(chunk_size=chunk_size):
+            yield json.dumps(serialize_agency(agency)).encode() + b'\n'
+    else:
+        keys, order = _name_order(snapshot)
+        start = bisect_right(keys, after) if after else 0
+        for i in order[start:]:
+            yield json.dumps(snapshot.agencies[i]).encode() + b'\n'
+
+@telegram_auth_required
+@require_GET
+@agencies_conditional
+def agency_tile(request, z, x, y):
+    """
+    API endpoint returning pre-aggregated agency clusters for map tile z/x/y.
+    Each cluster has a count, centroid and per-type counts; clusters of a
+    single agency also carry its id, name, type and phone. Tiles are built
+    once per dataset version. Optional ``type`` limits the agency type.
+    """
+    try:
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return JsonResponse({'error': 'Invalid tile coordinates'}, status=400)
+        
+        agency_type = request.GET.get('type') or None
+        if agency_type and agency_type not in dict(Agency.AGENCY_TYPES):
+            return JsonResponse({'error': 'Invalid type parameter'}, status=400)
+        
+        snapshot = get_agencies_snapshot()
+        clusters = get_zoom_clusters(snapshot, z, agency_type).tile(x, y)
+        if not clusters:
+            # Empty tiles are cheap to build and not worth caching per coordinate
+            return JsonResponse(_tile_data(snapshot, z, x, y, clusters))
+        
+        payload = get_payload(
+            snapshot, f'tile:{z}/{x}/{y}:{agency_type or ""}',
+            lambda current: json.dumps(_tile_data(current, z, x, y, clusters)).encode(),
+        )
+        return payload.response(request)
+    
+    except Exception as e:
+        logger.error(f"Error building agency tile {z}/{x}/{y}: {e}")
+        return JsonResponse({'error': str(e)}, status=500)
+
+def _tile_data(snapshot, z, x, y, clusters):
+    south, west, north, east = tile_bounds(z, x, y)
+    return {
+        'z': z,
+        'x': x,
+        'y': y,
+        'bounds': {'south': south, 'west': west, 'north': north, 'east': east},
+        'clusters': clusters,
+        'count': sum(cluster['count'] for cluster in clusters),
+        'source': snapshot.source,
+    }
+
+def _build_all_agencies_payload(snapshot):
+    """Encode the all_agencies body, splicing in the snapshot's cached JSON."""
+    metadata = json.dumps({
+        'source': snapshot.source,
+        'count': len(snapshot),
+        'timestamp': snapshot.last_modified.isoformat() if snapshot.last_modified else 'unknown'
+    }).encode()
+    return b'{"agencies": ' + snapshot.agencies_json + b', ' + metadata[1:]
+
 @telegram_auth_required
 @require_GET
+@agencies_conditional
 def get_regions(request):
     """
     API endpoint to get all regions with agency counts.
     Uses database-first approach with fallback.
     """
     try:
-        # Get agencies with fallback strategy
-        agencies, source = get_agencies_with_fallback()
-        
-        # Count agencies by region
-        region_counts = {}
-        for agency in agencies:
-            region = agency.get('region', 'Unknown')
-            if region not in region_counts:
-                region_counts[region] = 0
-            region_counts[region] += 1
-        
-        # Convert to list of dictionaries
-        regions = []
-        for region, count in region_counts.items():
-            regions.append({
-                'name': region,
-                'count': count
-            })
-        
-        # Sort by name
-        regions.sort(key=lambda x: x['name'])
+        # Get agencies from the shared snapshot
+        snapshot = get_agencies_snapshot()
+        source = snapshot.source
+        
+        # Regions with agency counts, already sorted by name
+        regions = [
+            {'name': region, 'count': count}
+            for region, count in snapshot.hierarchy.regions()
+        ]
         
         response_data = {
             'regions': regions,
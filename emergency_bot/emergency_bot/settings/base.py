@@ -175,6 +175,8 @@ TELEGRAM_WEBHOOK_URL = env("TELEGRAM_WEBHOOK_URL", default="")
 
 # Encryption key for sensitive data
 ENCRYPTION_KEY = env("ENCRYPTION_KEY", default="")
+# Optional keys for rotation: the new primary key first, then old keys still accepted for reading
+ENCRYPTION_KEYS = env.list("ENCRYPTION_KEYS", default=[])
 
 # Celery settings
 CELERY_BROKER_URL = env("REDIS_URL", default="redis://localhost:6379/0")
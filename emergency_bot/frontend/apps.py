@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+
+class FrontendConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'emergency_bot.frontend'
+    label = 'frontend'
+    verbose_name = 'Frontend'
+
+    def ready(self):
+        """
+        Register the system check that the idempotency cache is shared
+        between worker processes.
+        """
+        from . import idempotency  # noqa: F401
@@ -0,0 +1,201 @@
+"""
+Idempotency keys for the Mini App's submission endpoints.
+
+Clients on flaky connections resend a request when the response is lost,
+which used to create a second report (or a second copy of a voice note)
+for the same tap. A client can send an ``Idempotency-Key`` header (or an
+``idempotency_key`` query parameter) that stays the same across its
+retries: the first successful response is kept in the cache for
+``IDEMPOTENCY_TTL`` seconds and replayed for every repeat of the key,
+without running the view again.
+
+While the first request is still being handled a repeat gets a 409, so a
+slow upload is not stored twice. Failed requests are not remembered and
+can be retried with the same key.
+
+The keys live in the ``IDEMPOTENCY_CACHE`` cache (``default`` unless set),
+which must be shared by every worker process: with a per-process cache a
+retry that lands on another worker runs the view again. The system checks
+warn when that cache is local memory (or the dummy cache), and
+``check --deploy`` fails.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.checks import Error, Tags, Warning, register
+from django.http import JsonResponse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 24 * 60 * 60
+# How long a key stays claimed by a request that has not finished (e.g. a crashed
+# worker)
+DEFAULT_LOCK_TIMEOUT = 5 * 60
+MAX_KEY_LENGTH = 255
+IN_PROGRESS = 'in-progress'
+
+# Cache backends that do not share keys between processes
+PER_PROCESS_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def cache_alias():
+    return getattr(settings, 'IDEMPOTENCY_CACHE', 'default')
+
+
+def _per_process_cache():
+    """
+    Return ``(alias, backend)`` when the idempotency cache is not shared between
+    processes.
+    """
+    alias = cache_alias()
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    return (alias, backend) if backend in PER_PROCESS_BACKENDS else None
+
+
+def _cache_message(alias, backend):
+    return (
+        f"Idempotency keys are stored in the '{alias}' cache, which is not shared "
+        f"between processes ({backend})."
+    )
+
+
+CACHE_HINT = (
+    'Point IDEMPOTENCY_CACHE (or the default cache) at a shared backend such as Redis.'
+)
+
+
+@register(Tags.caches)
+def check_idempotency_cache(app_configs, **kwargs):
+    """Warn when idempotency keys would be kept in a per-process cache."""
+    problem = _per_process_cache()
+    if problem is None:
+        return []
+    return [Warning(_cache_message(*problem), hint=CACHE_HINT, id='frontend.W001')]
+
+
+@register(Tags.caches, deploy=True)
+def check_idempotency_cache_deploy(app_configs, **kwargs):
+    """Fail ``check --deploy`` when idempotency keys would be kept per process."""
+    problem = _per_process_cache()
+    if problem is None:
+        return []
+    return [Error(_cache_message(*problem), hint=CACHE_HINT, id='frontend.E001')]
+
+
+def get_idempotency_key(request):
+    """Return the idempotency key sent with ``request``, or None."""
+    # Read from the headers or query string: touching request.POST would parse an
+    # upload early
+    return (
+        request.META.get('HTTP_IDEMPOTENCY_KEY')
+        or request.GET.get('idempotency_key')
+        or None
+    )
+
+
+def _cache_key(scope, key):
+    # Hashed, so any client-chosen key is a valid cache key of fixed length
+    return f'idempotency:{scope}:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def _fingerprint(request):
+    """Identify the request body, when it is cheap to hash (JSON, not uploads)."""
+    if request.content_type == 'application/json':
+        return hashlib.sha256(request.body).hexdigest()
+    return None
+
+
+def idempotent(scope):
+    """
+    Decorate a view returning ``JsonResponse`` so that requests repeating an
+    idempotency key get the first successful response again. ``scope``
+    keeps the keys of different endpoints apart.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = get_idempotency_key(request)
+            if request.method != 'POST' or key is None:
+                return view(request, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return JsonResponse(
+                    {'status': 'error', 'message': 'Idempotency key is too long'},
+                    status=400,
+                )
+
+            cache = caches[cache_alias()]
+            cache_key = _cache_key(scope, key)
+            fingerprint = _fingerprint(request)
+            lock_timeout = getattr(
+                settings, 'IDEMPOTENCY_LOCK_TIMEOUT', DEFAULT_LOCK_TIMEOUT
+            )
+            if not cache.add(cache_key, IN_PROGRESS, lock_timeout):
+                stored = cache.get(cache_key)
+                if stored == IN_PROGRESS:
+                    return JsonResponse(
+                        {
+                            'status': 'error',
+                            'message': (
+                                'A request with this idempotency key is still '
+                                'being processed'
+                            ),
+                        },
+                        status=409,
+                    )
+                if stored is not None:
+                    if (
+                        fingerprint
+                        and stored['fingerprint']
+                        and stored['fingerprint'] != fingerprint
+                    ):
+                        return JsonResponse(
+                            {
+                                'status': 'error',
+                                'message': (
+                                    'Idempotency key was already used for a '
+                                    'different request'
+                                ),
+                            },
+                            status=422,
+                        )
+                    logger.info(f"Replaying response for idempotency key in {scope}")
+                    response = JsonResponse(
+                        stored['body'], status=stored['status_code']
+                    )
+                    response['Idempotent-Replayed'] = 'true'
+                    return response
+                # Expired between add() and get(); claim it again
+                cache.add(cache_key, IN_PROGRESS, lock_timeout)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                cache.delete(cache_key)
+                raise
+            if 200 <= response.status_code < 300:
+                cache.set(
+                    cache_key,
+                    {
+                        'status_code': response.status_code,
+                        'body': json.loads(response.content),
+                        'fingerprint': fingerprint,
+                    },
+                    getattr(settings, 'IDEMPOTENCY_TTL', DEFAULT_TTL),
+                )
+            else:
+                # Only successes are replayed; anything else may be retried
+                cache.delete(cache_key)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,219 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core import checks
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from emergency_bot.reports import journal as report_journal
+
+from .idempotency import IN_PROGRESS, _cache_key
+
+
+class TempDirMixin:
+    def make_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return directory
+
+
+class SubmitReportTests(TempDirMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        journal_settings = override_settings(
+            REPORT_JOURNAL_PATH=os.path.join(self.make_dir(), 'journal.sqlite3'),
+        )
+        journal_settings.enable()
+        self.addCleanup(journal_settings.disable)
+        patcher = mock.patch.object(report_journal, 'schedule_drain')
+        self.schedule_drain = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = reverse('submit_report')
+
+    def submit(self, key=None, **fields):
+        data = {
+            'incident_type': 'assault',
+            'latitude': 9.0,
+            'longitude': 38.7,
+            'telegram_id': '300',
+        }
+        data.update(fields)
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post(
+            self.url, json.dumps(data), content_type='application/json', **headers
+        )
+
+    def test_report_is_pending_until_the_journal_drains(self):
+        response = self.submit()
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['state'], 'pending')
+        self.schedule_drain.assert_called_once_with()
+
+        status = self.client.get(data['status_url']).json()
+        self.assertEqual(status['state'], 'pending')
+        report_journal.drain()
+        status = self.client.get(data['status_url']).json()
+        self.assertEqual(status['state'], 'stored')
+
+    def test_unknown_report_status_is_not_found(self):
+        url = reverse('report_status', args=['00000000-0000-0000-0000-000000000000'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_repeated_key_replays_the_first_response(self):
+        first = self.submit(key='tap-1')
+        second = self.submit(key='tap-1')
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.json()['report_id'], first.json()['report_id'])
+        self.assertEqual(report_journal.pending_count(), 1)
+
+    def test_different_keys_create_different_reports(self):
+        self.submit(key='tap-1')
+        self.submit(key='tap-2')
+        self.assertEqual(report_journal.pending_count(), 2)
+
+    def test_key_reused_for_another_body_is_rejected(self):
+        self.submit(key='tap-1')
+        response = self.submit(key='tap-1', incident_type='harassment')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(report_journal.pending_count(), 1)
+
+    def test_key_in_progress_is_a_conflict(self):
+        cache.add(_cache_key('submit_report', 'tap-1'), IN_PROGRESS)
+        response = self.submit(key='tap-1')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(report_journal.pending_count(), 0)
+
+    def test_failed_request_can_be_retried_with_its_key(self):
+        self.assertEqual(self.submit(key='tap-1', incident_type='').status_code, 400)
+        response = self.submit(key='tap-1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(report_journal.pending_count(), 1)
+
+
+class VoiceNoteUploadTests(TempDirMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        media_settings = override_settings(MEDIA_ROOT=self.make_dir())
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.url = reverse('upload_voice_note')
+
+    def upload(self, key):
+        note = SimpleUploadedFile('note.ogg', b'OggS' + b'0' * 60, 'audio/ogg')
+        return self.client.post(
+            self.url, {'voice_note': note}, HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    @mock.patch('emergency_bot.frontend.views.start_sweeper')
+    @mock.patch('emergency_bot.frontend.views.enqueue_transcode')
+    def test_retried_upload_is_stored_once(self, enqueue_transcode, start_sweeper):
+        first = self.upload('rec-1')
+        second = self.upload('rec-1')
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(
+            second.json()['voice_note_url'], first.json()['voice_note_url']
+        )
+        enqueue_transcode.assert_called_once()
+
+        third = self.upload('rec-2')
+        self.assertNotEqual(
+            third.json()['voice_note_url'], first.json()['voice_note_url']
+        )
+
+
+class IdempotencyCacheCheckTests(TestCase):
+    def run_checks(self, deploy=False):
+        errors = checks.run_checks(
+            tags=[checks.Tags.caches], include_deployment_checks=deploy
+        )
+        return sorted(error.id for error in errors if error.id.startswith('frontend.'))
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    )
+    def test_per_process_cache_warns_and_fails_the_deploy_check(self):
+        self.assertEqual(self.run_checks(), ['frontend.W001'])
+        self.assertEqual(
+            self.run_checks(deploy=True), ['frontend.E001', 'frontend.W001']
+        )
+
+    @override_settings(
+        CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'},
+        },
+        IDEMPOTENCY_CACHE='shared',
+    )
+    def test_shared_cache_passes(self):
+        self.assertEqual(self.run_checks(deploy=True), [])
+
+
+class ChunkedUploadTests(TempDirMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.upload_dir = self.make_dir()
+        upload_settings = override_settings(
+            VOICE_NOTE_UPLOAD_DIR=self.upload_dir, MEDIA_ROOT=self.make_dir()
+        )
+        upload_settings.enable()
+        self.addCleanup(upload_settings.disable)
+        self.url = reverse('upload_voice_note_chunk')
+
+    def send(self, data, offset, upload_id=None, **fields):
+        fields['chunk'] = SimpleUploadedFile('chunk', data, 'audio/ogg')
+        fields['offset'] = offset
+        if upload_id:
+            fields['upload_id'] = upload_id
+        return self.client.post(self.url, fields)
+
+    def received(self, upload_id):
+        return self.client.get(self.url, {'upload_id': upload_id}).json()['offset']
+
+    def test_chunks_are_appended_at_the_received_offset(self):
+        first = self.send(b'OggS0123', 0).json()
+        self.assertEqual(first['offset'], 8)
+        second = self.send(b'4567', 8, first['upload_id']).json()
+        self.assertEqual(second['offset'], 12)
+        self.assertEqual(self.received(first['upload_id']), 12)
+
+    def test_resent_chunk_is_refused_without_losing_data(self):
+        upload_id = self.send(b'OggS0123', 0).json()['upload_id']
+        self.send(b'4567', 8, upload_id)
+
+        response = self.send(b'0123', 4, upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 12)
+        self.assertEqual(self.received(upload_id), 12)
+
+    def test_chunk_past_the_received_bytes_is_refused(self):
+        upload_id = self.send(b'OggS0123', 0).json()['upload_id']
+        response = self.send(b'89', 10, upload_id)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 8)
+
+    def test_unknown_or_malformed_upload_id(self):
+        response = self.client.get(self.url, {'upload_id': '0' * 32})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(self.url, {'upload_id': '../../etc/passwd'})
+        self.assertEqual(response.status_code, 400)
+
+    @mock.patch('emergency_bot.frontend.views.start_sweeper')
+    @mock.patch('emergency_bot.frontend.views.enqueue_transcode')
+    def test_completed_upload_is_stored(self, enqueue_transcode, start_sweeper):
+        upload_id = self.send(b'OggS0123', 0).json()['upload_id']
+        response = self.send(b'4567', 8, upload_id, complete='1')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['voice_note_url'])
+        enqueue_transcode.assert_called_once()
+        # The partial file has been moved out of the upload directory
+        self.assertEqual(os.listdir(self.upload_dir), [])
+        response = self.client.get(self.url, {'upload_id': upload_id})
+        self.assertEqual(response.status_code, 404)
@@ -16,9 +16,12 @@ urlpatterns = [
     path('report.html', views.report, name='report_html'),
     path('profile/', views.profile, name='profile'),
     path('profile.html', views.profile, name='profile_html'),
+    path('api/agencies-data/', views.index_agencies_data, name='index_agencies_data'),
     path('api/submit-report/', views.submit_report, name='submit_report'),
     path('submit-report/', views.submit_report, name='submit_report_direct'),
+    path('api/reports/<uuid:report_id>/status/', views.report_status, name='report_status'),
     path('api/upload-voice-note/', views.upload_voice_note, name='upload_voice_note'),
+    path('api/upload-voice-note/chunk/', views.upload_voice_note_chunk, name='upload_voice_note_chunk'),
     path('api/frontend/get-user-language/', views.get_user_language, name='get_user_language'),
     path('api/frontend/update-language/', views.update_language, name='update_language'),
     path('api/frontend/check-language-sync/', views.check_language_sync, name='check_language_sync'),
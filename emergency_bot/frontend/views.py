@@ -4,25 +4,30 @@ Views for the frontend app (Telegram Mini App).
 
 import json
 import logging
-import os
 import uuid
-import time
-from datetime import datetime
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import JsonResponse, HttpResponseBadRequest
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 from django.contrib.auth.decorators import login_required
-from django.conf import settings
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from emergency_bot.accounts.models import UserProfile
 from emergency_bot.reports.models import IncidentReport
+from emergency_bot.reports import journal as report_journal
+from emergency_bot.reports.voice_note_cleanup import start_sweeper
+from emergency_bot.reports.transcoding import enqueue_transcode, storage_name
 from emergency_bot.agencies.models import Agency
+from emergency_bot.agencies.payloads import get_payload
+from emergency_bot.agencies.views import get_agencies_snapshot
+from .idempotency import idempotent
+from .voice_notes import (
+    ChunkedUpload, VoiceNoteQuotaHandler, VoiceNoteTooLarge, content_too_large, store_voice_note,
+)
 
 from emergency_bot.accounts.middleware import telegram_auth_required
 from django.utils import translation
 from django.http import HttpResponseRedirect
+from django.utils.cache import patch_cache_control
 from django.utils import timezone
 
 logger = logging.getLogger(__name__)
@@ -93,52 +98,62 @@ def activate_user_language(request, user_profile=None):
     return active_language
 
 
+INDEX_AGENCY_FIELDS = (
+    'id', 'name', 'type', 'description', 'phone', 'address', 'latitude', 'longitude', 'services',
+)
+
+
+def build_index_agencies_payload(snapshot):
+    """Encode the agency fields the Mini App home page needs."""
+    return json.dumps([
+        {field: agency.get(field) for field in INDEX_AGENCY_FIELDS}
+        for agency in snapshot.agencies
+    ]).encode()
+
+
 def index(request):
     """
     Main entry point for the Telegram Mini App.
+    
+    The page is a shell: agency data is fetched separately from
+    ``index_agencies_data`` using a URL stamped with the dataset version.
     """
-    import sys
-    print("======= DEBUG: DJANGO INDEX VIEW CALLED =======", file=sys.stderr)
-    print(f"Request path: {request.path}", file=sys.stderr)
-    print(f"Request method: {request.method}", file=sys.stderr)
+    logger.debug(f"Index view called: {request.method} {request.path}")
     
     # Get user profile and activate their preferred language
     user_profile = get_user_profile(request)
-    active_language = activate_user_language(request, user_profile)
-    
-    # Load agencies from database
-    agencies = Agency.objects.filter(active=True)
-    print(f"DEBUG: Found {agencies.count()} agencies in database", file=sys.stderr)
-    
-    # Serialize agencies for JavaScript
-    agencies_data = []
-    for agency in agencies:
-        agencies_data.append({
-            'id': str(agency.id),
-            'name': agency.name,
-            'type': agency.type,
-            'description': agency.description,
-            'phone': agency.phone,
-            'address': agency.address,
-            'latitude': float(agency.latitude),
-            'longitude': float(agency.longitude),
-            'services': agency.services,
-        })
+    activate_user_language(request, user_profile)
     
-    print(f"DEBUG: Serialized {len(agencies_data)} agencies", file=sys.stderr)
-    agencies_json = json.dumps(agencies_data)
-    print(f"DEBUG: JSON length: {len(agencies_json)} characters", file=sys.stderr)
-    print("======= END DEBUG =======", file=sys.stderr)
+    snapshot = get_agencies_snapshot()
+    # The data is the same in every language, so the URL (and the cached copy) is too
+    agencies_data_url = f"{reverse('index_agencies_data')}?v={snapshot.version}"
+    logger.debug(f"Index rendered with agency snapshot {snapshot.version} ({len(snapshot)} agencies)")
     
     context = {
-        'agencies_json': agencies_json,
-        'debug_marker': 'DJANGO_VIEW_RENDERED',
-        'unique_timestamp': f'VIEW_CALLED_AT_{int(time.time())}'
+        'agencies_data_url': agencies_data_url,
     }
     
     return render(request, 'index.html', context)
 
 
+@require_GET
+def index_agencies_data(request):
+    """
+    Agency data for the Mini App home page, cached per dataset version.
+    
+    A request for the current version (``?v=``) may be cached by the client
+    indefinitely, since a data change produces a new URL.
+    """
+    snapshot = get_agencies_snapshot()
+    payload = get_payload(snapshot, 'index_agencies', build_index_agencies_payload)
+    response = payload.response(request)
+    if request.GET.get('v') == snapshot.version:
+        patch_cache_control(response, public=True, max_age=60 * 60 * 24 * 365, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
 @telegram_auth_required
 def welcome(request):
     """
@@ -401,9 +416,17 @@ def report(request):
 
 
 @csrf_exempt
+@idempotent('submit_report')
 def submit_report(request):
     """
     API endpoint for submitting incident reports.
+    Send an Idempotency-Key header to make retries return the first report.
+
+    The report is acknowledged once it is in the report journal and written
+    to the database by a background drain shortly after, so for a moment
+    its id is not found by the report views and API. The response carries
+    the report's ``state`` and a ``status_url`` to poll until it is
+    'stored'.
     """
     if request.method == 'POST':
         try:
@@ -428,42 +451,49 @@ def submit_report(request):
             if not telegram_id:
                 return JsonResponse({'status': 'error', 'message': 'User ID is required'}, status=400)
             
-            # Get or create user profile
             try:
-                user_profile, created = UserProfile.objects.get_or_create(
-                    telegram_id=telegram_id
-                )
-            except Exception as e:
-                logger.error(f"Error getting/creating user profile: {e}")
-                return JsonResponse({'status': 'error', 'message': 'Invalid user ID'}, status=400)
+                latitude = float(latitude)
+                longitude = float(longitude)
+            except (TypeError, ValueError):
+                return JsonResponse({'status': 'error', 'message': 'Invalid location'}, status=400)
             
-            # Create and save the incident report
-            try:
-                # Skip encryption to avoid Fernet key error
-                report = IncidentReport(
-                    user=user_profile,
-                    type=incident_type,
-                    description=description,  # Store as plaintext for now
-                    voice_note_url=voice_note_url,
-                    location=f"GPS: {latitude}, {longitude}",
-                    latitude=latitude,
-                    longitude=longitude
-                )
-                
-                # Skip the automatic encryption in save() method
-                report.save()
-                
-                logger.info(f"New incident report created: {report.id} by user {telegram_id}")
-                
-                return JsonResponse({
-                    'status': 'success', 
-                    'message': 'Report submitted successfully',
-                    'report_id': str(report.id)  # Convert UUID to string
-                })
+            payload = {
+                'report_id': str(uuid.uuid4()),
+                'telegram_id': str(telegram_id),
+                'type': incident_type,
+                'description': description,
+                'voice_note_url': voice_note_url,
+                'location': f"GPS: {latitude}, {longitude}",
+                'latitude': latitude,
+                'longitude': longitude,
+                'submitted_at': timezone.now().isoformat(),
+            }
             
+            # Acknowledge once the report is safely in the journal; the database
+            # write happens in the background and cannot lose it to lock contention
+            try:
+                report_id = report_journal.append(payload)
+                report_journal.schedule_drain()
+                state = 'pending'
             except Exception as e:
-                logger.error(f"Error creating incident report: {e}")
-                return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+                logger.error(f"Error journaling incident report, writing it directly: {e}")
+                try:
+                    report_journal.apply_entries([payload])
+                    report_id = payload['report_id']
+                    state = 'stored'
+                except Exception as e:
+                    logger.error(f"Error creating incident report: {e}")
+                    return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+            
+            logger.info(f"New incident report accepted: {report_id} by user {telegram_id}")
+            
+            return JsonResponse({
+                'status': 'success', 
+                'message': 'Report submitted successfully',
+                'report_id': report_id,
+                'state': state,
+                'status_url': reverse('report_status', args=[report_id]),
+            })
                 
         except json.JSONDecodeError:
             return JsonResponse({'status': 'error', 'message': 'Invalid JSON data'}, status=400)
@@ -474,33 +504,54 @@ def submit_report(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=400)
 
 
+@require_GET
+def report_status(request, report_id):
+    """
+    API endpoint telling whether a submitted report has reached the database.
+    ``state`` is 'stored' once it has, 'pending' while it waits in the
+    report journal and 'failed' if the journal set it aside.
+    """
+    if IncidentReport.objects.filter(id=report_id).exists():
+        state = 'stored'
+    else:
+        entry = report_journal.entry_status(report_id)
+        if entry is None:
+            return JsonResponse({'status': 'error', 'message': 'Report not found'}, status=404)
+        # 'applied' but not found means it was written after the lookup above
+        state = 'stored' if entry['state'] == 'applied' else entry['state']
+    return JsonResponse({'status': 'success', 'report_id': str(report_id), 'state': state})
+
+
 @csrf_exempt
+@idempotent('upload_voice_note')
 def upload_voice_note(request):
     """
     API endpoint for uploading voice notes.
+    The recording is streamed to storage in chunks, never read into memory,
+    and rejected once it passes VOICE_NOTE_MAX_SIZE. Send an Idempotency-Key
+    header to make retries return the first upload's URL.
     """
     if request.method == 'POST':
+        if content_too_large(request):
+            return JsonResponse({'status': 'error', 'message': 'Voice note is too large'}, status=413)
+        
+        # Must be installed before request.FILES is parsed
+        quota = VoiceNoteQuotaHandler(request)
+        request.upload_handlers.insert(0, quota)
+        
         try:
+            files = request.FILES
+            if quota.exceeded:
+                return JsonResponse({'status': 'error', 'message': 'Voice note is too large'}, status=413)
+            
             # Check if the voice note is in the request
-            if 'voice_note' not in request.FILES:
+            if 'voice_note' not in files:
                 return JsonResponse({'status': 'error', 'message': 'No voice note provided'}, status=400)
             
-            voice_note = request.FILES['voice_note']
-            
-            # Generate a unique filename with UUID to prevent collisions
-            unique_id = str(uuid.uuid4())
-            date_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f'voice_notes/{unique_id}/{date_str}.wav'
-            
-            # Ensure directory exists
-            directory = os.path.dirname(os.path.join(settings.MEDIA_ROOT, filename))
-            os.makedirs(directory, exist_ok=True)
-            
-            # Save the file to media storage
-            path = default_storage.save(filename, ContentFile(voice_note.read()))
-            
-            # Generate the URL for the saved file
-            voice_note_url = settings.MEDIA_URL + path
+            # Saved under voice_notes/<uuid>/ with the extension of the actual codec
+            voice_note_url = store_voice_note(files['voice_note'])
+            enqueue_transcode(storage_name(voice_note_url))
+            start_sweeper()
             
             # Return the URL of the saved file
             return JsonResponse({
@@ -509,6 +560,8 @@ def upload_voice_note(request):
                 'voice_note_url': voice_note_url
             })
             
+        except VoiceNoteTooLarge as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=413)
         except Exception as e:
             logger.error(f"Error uploading voice note: {e}")
             return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
@@ -516,6 +569,92 @@ def upload_voice_note(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=400)
 
 
+@csrf_exempt
+@idempotent('upload_voice_note_chunk')
+def upload_voice_note_chunk(request):
+    """
+    API endpoint for resumable voice note uploads sent in pieces.
+    
+    POST a ``chunk`` file with the ``offset`` it starts at; the first chunk
+    is sent without ``upload_id`` and the response carries the id to use
+    for the rest. Send ``complete=1`` with the last chunk to store the
+    voice note. After a dropped connection, GET with ``upload_id`` returns
+    the offset to resume from.
+    """
+    upload_id = request.GET.get('upload_id') if request.method == 'GET' else None
+    
+    if request.method == 'GET':
+        try:
+            upload = ChunkedUpload(upload_id)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        if not upload.exists:
+            return JsonResponse({'status': 'error', 'message': 'Upload not found'}, status=404)
+        return JsonResponse({'status': 'success', 'upload_id': upload.upload_id, 'offset': upload.offset})
+    
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=400)
+    
+    if content_too_large(request):
+        return JsonResponse({'status': 'error', 'message': 'Voice note is too large'}, status=413)
+    quota = VoiceNoteQuotaHandler(request)
+    request.upload_handlers.insert(0, quota)
+    
+    try:
+        files = request.FILES
+        if quota.exceeded:
+            return JsonResponse({'status': 'error', 'message': 'Voice note is too large'}, status=413)
+        
+        try:
+            offset = int(request.POST.get('offset', 0))
+        except ValueError:
+            return JsonResponse({'status': 'error', 'message': 'Invalid offset'}, status=400)
+        complete = request.POST.get('complete', '').lower() in ('1', 'true', 'yes')
+        chunk = files.get('chunk')
+        
+        if request.POST.get('upload_id'):
+            try:
+                upload = ChunkedUpload(request.POST['upload_id'])
+            except ValueError as e:
+                return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+            if not upload.exists:
+                return JsonResponse({'status': 'error', 'message': 'Upload not found'}, status=404)
+        elif chunk is None:
+            return JsonResponse({'status': 'error', 'message': 'No chunk provided'}, status=400)
+        else:
+            upload = ChunkedUpload.start()
+        
+        if chunk is not None:
+            try:
+                upload.write(chunk, offset)
+            except ValueError as e:
+                # The client lost track of what arrived; tell it where to resume
+                return JsonResponse({
+                    'status': 'error',
+                    'message': str(e),
+                    'upload_id': upload.upload_id,
+                    'offset': upload.offset
+                }, status=409)
+            except VoiceNoteTooLarge as e:
+                upload.discard()
+                return JsonResponse({'status': 'error', 'message': str(e)}, status=413)
+        
+        response = {'status': 'success', 'upload_id': upload.upload_id, 'offset': upload.offset}
+        if complete:
+            if not upload.offset:
+                return JsonResponse({'status': 'error', 'message': 'No voice note provided'}, status=400)
+            content_type = request.POST.get('content_type') or (chunk.content_type if chunk else None)
+            response['voice_note_url'] = upload.complete(content_type)
+            enqueue_transcode(storage_name(response['voice_note_url']))
+            start_sweeper()
+            response['message'] = 'Voice note uploaded successfully'
+        return JsonResponse(response)
+        
+    except Exception as e:
+        logger.error(f"Error uploading voice note chunk: {e}")
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+
+
 def profile(request):
     """
     View for user profile management.
@@ -0,0 +1,270 @@
+"""
+Streaming storage for uploaded voice notes.
+
+Uploads are never read into memory as a whole: Django's upload handlers
+spool the request body in chunks, ``VoiceNoteQuotaHandler`` aborts the
+upload as soon as it passes ``VOICE_NOTE_MAX_SIZE``, and the stored file is
+written from the upload's chunks (or moved, when Django already spooled it
+to a temporary file). When voice notes are encrypted at rest, the chunks
+are encrypted on their way to storage instead.
+
+Long recordings on poor connections can also be sent in pieces: each
+chunk that starts at the current offset is appended to a partial file
+keyed by an upload id, the current offset can be queried to resume after
+a dropped connection, and the finished file is copied into media storage.
+"""
+
+import logging
+import os
+import re
+import time
+import uuid
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from emergency_bot.reports.media_encryption import encrypt_chunks, encryption_enabled
+from emergency_bot.reports.transcoding import voice_note_url
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024
+# Partial uploads untouched for this long are removed
+UPLOAD_EXPIRY = 24 * 60 * 60
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Content type -> extension, for containers that cannot be recognised by their header
+CONTENT_TYPE_EXTENSIONS = {
+    'audio/wav': 'wav',
+    'audio/wave': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/webm': 'webm',
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/mp4': 'm4a',
+    'audio/x-m4a': 'm4a',
+    'audio/aac': 'aac',
+}
+
+_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+
+def max_size():
+    return getattr(settings, 'VOICE_NOTE_MAX_SIZE', DEFAULT_MAX_SIZE)
+
+
+def content_too_large(request):
+    """Return True when the request announces a body too large for the limit."""
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    # Leave room for the multipart headers and the other form fields
+    return content_length > max_size() + COPY_CHUNK_SIZE
+
+
+def upload_dir():
+    default = os.path.join(settings.BASE_DIR, 'tmp', 'voice_note_uploads')
+    return getattr(settings, 'VOICE_NOTE_UPLOAD_DIR', default)
+
+
+class VoiceNoteTooLarge(Exception):
+    pass
+
+
+class VoiceNoteQuotaHandler(FileUploadHandler):
+    """
+    Upload handler that stops storing the request once the uploaded files
+    pass ``limit`` bytes. Install it first, before ``request.FILES`` is read.
+    """
+
+    def __init__(self, request=None, limit=None):
+        super().__init__(request)
+        self.limit = limit or max_size()
+        self.received = 0
+        self.exceeded = False
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.limit:
+            self.exceeded = True
+            # The rest of the body is drained, so the client still gets a 413
+            raise StopUpload()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def sniff_extension(header, content_type=None):
+    """
+    Return the file extension for audio starting with ``header``.
+    The container is recognised from its magic bytes, because browsers
+    often label recordings with a type (or file name) they are not; the
+    declared ``content_type`` is only used when the header is unknown.
+    """
+    if header[:4] == b'RIFF' and header[8:12] == b'WAVE':
+        return 'wav'
+    if header[:4] == b'OggS':
+        return 'ogg'
+    if header[:4] == b'\x1a\x45\xdf\xa3':
+        return 'webm'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if header[:3] == b'ID3':
+        return 'mp3'
+    if len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0:
+        # MPEG audio and ADTS AAC share the sync word; AAC has layer bits 00
+        return 'aac' if header[1] & 0x06 == 0 else 'mp3'
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    return CONTENT_TYPE_EXTENSIONS.get(content_type, 'bin')
+
+
+def _read_header(fileobj):
+    fileobj.seek(0)
+    header = fileobj.read(16)
+    fileobj.seek(0)
+    return header
+
+
+def voice_note_name(extension):
+    """Return a new storage name ``voice_notes/<uuid>/<timestamp>.<extension>``."""
+    date_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f'voice_notes/{uuid.uuid4()}/{date_str}.{extension}'
+
+
+def save_voice_note(name, content):
+    """
+    Write ``content`` (a Django ``File``) to storage under ``name`` and
+    return the URL it is served from. With encryption enabled the file is
+    encrypted chunk by chunk on the way in, so no plaintext reaches
+    ``MEDIA_ROOT``.
+    """
+    if not encryption_enabled():
+        # Storage writes the file from its chunks, or moves Django's temporary file
+        return voice_note_url(default_storage.save(name, content))
+    name = default_storage.get_available_name(name)
+    path = default_storage.path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    content.seek(0)
+    try:
+        with open(path, 'xb') as out:
+            encrypt_chunks(content.chunks(COPY_CHUNK_SIZE), out)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return voice_note_url(name)
+
+
+def store_voice_note(uploaded_file):
+    """
+    Save an uploaded voice note to media storage without reading it into
+    memory and return its URL.
+    Raises VoiceNoteTooLarge when the file is over ``VOICE_NOTE_MAX_SIZE``.
+    """
+    if uploaded_file.size is not None and uploaded_file.size > max_size():
+        raise VoiceNoteTooLarge(f"Voice note is larger than {max_size()} bytes")
+    extension = sniff_extension(_read_header(uploaded_file), uploaded_file.content_type)
+    return save_voice_note(voice_note_name(extension), uploaded_file)
+
+
+class ChunkedUpload:
+    """
+    A voice note being uploaded in pieces, stored as ``<upload_id>.part``.
+    Each chunk must start at the number of bytes received so far; a chunk
+    sent again after a lost response is refused with that offset, so the
+    client resumes from it and received bytes are never cut off.
+    """
+
+    def __init__(self, upload_id):
+        if not _UPLOAD_ID.match(upload_id or ''):
+            raise ValueError("Invalid upload id")
+        self.upload_id = upload_id
+        self.path = os.path.join(upload_dir(), f'{upload_id}.part')
+
+    @classmethod
+    def start(cls):
+        os.makedirs(upload_dir(), exist_ok=True)
+        remove_expired_uploads()
+        upload = cls(uuid.uuid4().hex)
+        open(upload.path, 'xb').close()
+        return upload
+
+    @property
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @property
+    def offset(self):
+        """Number of bytes received so far."""
+        return os.path.getsize(self.path)
+
+    def write(self, chunk, offset):
+        """
+        Append the uploaded ``chunk`` and return the new offset.
+        Raises ValueError when ``offset`` is not the number of bytes received
+        and VoiceNoteTooLarge when the file would exceed the size limit.
+        """
+        with open(self.path, 'ab') as f:
+            if fcntl is not None:
+                # Held until the file is closed, so a retry racing the original cannot
+                # append twice
+                fcntl.flock(f, fcntl.LOCK_EX)
+            received = os.fstat(f.fileno()).st_size
+            if offset != received:
+                raise ValueError(
+                    f"Offset {offset} does not match the {received} bytes received"
+                )
+            if offset + chunk.size > max_size():
+                raise VoiceNoteTooLarge(f"Voice note is larger than {max_size()} bytes")
+            for data in chunk.chunks(COPY_CHUNK_SIZE):
+                f.write(data)
+            return f.tell()
+
+    def complete(self, content_type=None):
+        """
+        Copy the finished upload into media storage, remove the partial file and
+        return the URL.
+        """
+        with open(self.path, 'rb') as f:
+            extension = sniff_extension(_read_header(f), content_type)
+            url = save_voice_note(voice_note_name(extension), File(f))
+        self.discard()
+        return url
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def remove_expired_uploads(expiry=UPLOAD_EXPIRY):
+    """Remove partial uploads that have not received a chunk for ``expiry`` seconds."""
+    cutoff = time.time() - expiry
+    removed = 0
+    try:
+        entries = list(os.scandir(upload_dir()))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    if removed:
+        logger.info(f"Removed {removed} expired partial voice note uploads")
+    return removed
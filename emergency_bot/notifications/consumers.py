@@ -373,7 +373,7 @@ class ReportUpdateConsumer(AsyncWebsocketConsumer):
                 "id": str(report.id),
                 "type": report.type,
                 "status": report.status,
-                "description": report.description,
+                "description": report.get_decrypted_description(),
                 "location": report.location,
                 "submitted_at": report.submitted_at.isoformat(),
                 "last_updated": report.last_updated.isoformat(),
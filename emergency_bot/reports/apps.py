@@ -0,0 +1,29 @@
+import sys
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class ReportsConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'emergency_bot.reports'
+    label = 'reports'
+    verbose_name = 'Reports'
+
+    def ready(self):
+        """
+        Drain report submissions left in the journal by a previous process
+        once this one starts serving requests.
+
+        Not under ``manage.py test``: the test database would receive the
+        entries and they would be marked applied in the real journal.
+        """
+        from django.core.signals import request_started
+
+        from .journal import drain_after_restart
+
+        default = sys.argv[1:2] != ['test']
+        if getattr(settings, 'REPORT_JOURNAL_DRAIN_ON_START', default):
+            request_started.connect(
+                drain_after_restart, dispatch_uid='report-journal-startup'
+            )
@@ -0,0 +1,401 @@
+"""
+Write-ahead journal for incident report submissions.
+
+A submitted report is first appended to a small SQLite journal of its own
+(WAL mode, ``synchronous=FULL``, so a commit is on disk before it
+returns) and the user is answered right away. A single background thread
+then drains the journal into the main database in batches. Losing the
+race for the main database's write lock ("database is locked") only delays
+a report; it is retried with backoff and never dropped.
+
+Until the drain has written it (normally well under a second, longer
+while the main database is busy), an acknowledged report is not in
+``IncidentReport``: detail lookups answer 404 and lists leave it out.
+``entry_status`` tells clients polling a report id that it is still
+pending rather than unknown.
+
+Every entry carries the report id it will be created with, so applying an
+entry twice is harmless: ids already in the database are skipped. That
+makes it safe to crash between writing a batch and marking it applied.
+Entries that keep failing for other reasons are set aside after
+``MAX_ATTEMPTS`` and reported by ``manage.py drain_report_journal``.
+
+Entries left over when a drain fails are retried by the worker with
+backoff, without waiting for another submission. Entries left by a
+previous process are picked up on the first request after a restart.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from emergency_bot.accounts.models import UserProfile
+
+from .models import IncidentReport, decrypt_text, encrypt_text
+from .transcoding import resolve_voice_note
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+MAX_ATTEMPTS = 10
+# Seconds the worker waits before retrying after a failed batch, doubling up to the
+# maximum
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+# Applied entries are kept this long (seconds) before they are compacted away
+RETENTION = 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    report_id TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    applied_at REAL,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS entries_pending ON entries (failed, applied_at, id);
+"""
+
+
+def journal_path():
+    default = os.path.join(settings.BASE_DIR, 'tmp', 'report_journal.sqlite3')
+    return getattr(settings, 'REPORT_JOURNAL_PATH', default)
+
+
+_local = threading.local()
+
+
+def _connect():
+    """Return this thread's journal connection, creating the journal on first use."""
+    path = journal_path()
+    connection = getattr(_local, 'connection', None)
+    if connection is not None and _local.path == path:
+        return connection
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.execute('PRAGMA journal_mode=WAL')
+    # FULL syncs the WAL on every commit, so an acknowledged report survives a power cut
+    connection.execute('PRAGMA synchronous=FULL')
+    connection.executescript(_SCHEMA)
+    _local.connection = connection
+    _local.path = path
+    return connection
+
+
+def append(payload):
+    """
+    Durably append one report submission and return its report id.
+    ``payload`` holds the ``IncidentReport`` fields plus ``telegram_id``; a
+    ``report_id`` is assigned when it has none.
+    """
+    payload = dict(payload)
+    payload.setdefault('report_id', str(uuid.uuid4()))
+    payload.setdefault('submitted_at', timezone.now().isoformat())
+    if payload.get('description'):
+        # The journal holds no plaintext descriptions
+        encrypted = encrypt_text(payload['description'])
+        if encrypted != payload['description']:
+            payload['description_encrypted'] = encrypted
+            del payload['description']
+    _connect().execute(
+        'INSERT INTO entries (report_id, payload, created_at) VALUES (?, ?, ?)',
+        (payload['report_id'], json.dumps(payload), time.time()),
+    )
+    return payload['report_id']
+
+
+def pending_count():
+    row = (
+        _connect()
+        .execute('SELECT COUNT(*) FROM entries WHERE applied_at IS NULL AND failed = 0')
+        .fetchone()
+    )
+    return row[0]
+
+
+def retry_failed():
+    """Put entries that were set aside back in the queue. Returns how many."""
+    return (
+        _connect()
+        .execute('UPDATE entries SET failed = 0, attempts = 0 WHERE failed = 1')
+        .rowcount
+    )
+
+
+def failed_entries():
+    """Return ``(report_id, attempts, last_error)`` for entries that were set aside."""
+    return (
+        _connect()
+        .execute(
+            'SELECT report_id, attempts, last_error FROM entries WHERE failed = 1 '
+            'ORDER BY id'
+        )
+        .fetchall()
+    )
+
+
+def entry_status(report_id):
+    """
+    Return ``{'state': ..., 'telegram_id': ...}`` for the journal entry of
+    ``report_id``, where the state is 'pending', 'failed' (set aside) or
+    'applied'. Returns None when the journal has no such entry: it was
+    never submitted, or was applied and compacted away.
+    """
+    row = (
+        _connect()
+        .execute(
+            'SELECT payload, applied_at, failed FROM entries WHERE report_id = ?',
+            (str(report_id),),
+        )
+        .fetchone()
+    )
+    if row is None:
+        return None
+    payload, applied_at, failed = row
+    state = 'applied' if applied_at is not None else 'failed' if failed else 'pending'
+    return {'state': state, 'telegram_id': str(json.loads(payload).get('telegram_id'))}
+
+
+def pending_voice_note_urls():
+    """
+    Return the voice note URLs of entries not yet in the database, including
+    set-aside ones.
+    """
+    rows = (
+        _connect()
+        .execute('SELECT payload FROM entries WHERE applied_at IS NULL')
+        .fetchall()
+    )
+    return {json.loads(payload).get('voice_note_url') for payload, in rows} - {None, ''}
+
+
+def _build_report(payload, profiles):
+    description = payload.get('description')
+    description_encrypted = payload.get('description_encrypted')
+    if description_encrypted:
+        description = decrypt_text(description_encrypted)
+    elif description:
+        # bulk_create skips IncidentReport.save(), which would encrypt it
+        encrypted = encrypt_text(description)
+        description_encrypted = encrypted if encrypted != description else None
+    # Transcoding may have finished while the entry waited
+    voice_note_url = payload.get('voice_note_url') or ''
+    duration = waveform = None
+    if voice_note_url:
+        voice_note_url, duration, waveform = resolve_voice_note(voice_note_url)
+    return IncidentReport(
+        id=uuid.UUID(payload['report_id']),
+        user=profiles[str(payload['telegram_id'])],
+        type=payload['type'],
+        description=description,
+        description_encrypted=description_encrypted,
+        voice_note_url=voice_note_url,
+        voice_note_duration=duration,
+        voice_note_waveform=waveform,
+        location=payload['location'],
+        latitude=float(payload['latitude']),
+        longitude=float(payload['longitude']),
+        submitted_at=parse_datetime(payload['submitted_at']),
+        ip_address=payload.get('ip_address'),
+        device_info=payload.get('device_info'),
+    )
+
+
+def apply_entries(payloads):
+    """
+    Create the reports for ``payloads`` in one transaction, skipping report
+    ids that already exist. Returns the number of reports created.
+    """
+    ids = [uuid.UUID(payload['report_id']) for payload in payloads]
+    telegram_ids = {str(payload['telegram_id']) for payload in payloads}
+    with transaction.atomic():
+        existing = set(
+            IncidentReport.objects.filter(pk__in=ids).values_list('pk', flat=True)
+        )
+        profiles = {
+            profile.telegram_id: profile
+            for profile in UserProfile.objects.filter(telegram_id__in=telegram_ids)
+        }
+        for telegram_id in telegram_ids - set(profiles):
+            profiles[telegram_id], _ = UserProfile.objects.get_or_create(
+                telegram_id=telegram_id
+            )
+        reports = [
+            _build_report(payload, profiles)
+            for payload in payloads
+            if uuid.UUID(payload['report_id']) not in existing
+        ]
+        IncidentReport.objects.bulk_create(reports)
+    return len(reports)
+
+
+def drain(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Apply pending journal entries to the database, one batch per
+    transaction, until none are left. Returns ``(applied, failed, leftover)``
+    counts, where ``leftover`` entries are still pending because they could
+    not be written yet and need a later drain.
+
+    A batch that cannot be written is retried entry by entry, so one bad
+    entry does not hold back the others. Raises the database error when
+    even a single entry cannot be written because the database is locked,
+    leaving the entries pending for a later retry.
+    """
+    journal = _connect()
+    applied = failed = 0
+    while True:
+        rows = journal.execute(
+            'SELECT id, payload FROM entries WHERE applied_at IS NULL AND failed = 0 '
+            'ORDER BY id LIMIT ?',
+            (batch_size,),
+        ).fetchall()
+        if not rows:
+            break
+        try:
+            created = apply_entries([json.loads(payload) for _, payload in rows])
+        except Exception as e:
+            logger.warning(
+                f"Report journal batch of {len(rows)} failed, "
+                f"retrying entries one by one: {e}"
+            )
+            created, batch_failed, retry_later = _apply_one_by_one(journal, rows)
+            applied += created
+            failed += batch_failed
+            if retry_later:
+                # Entries that failed stay pending; retry them on the next drain, not
+                # right away
+                break
+            continue
+        journal.execute(
+            "UPDATE entries SET applied_at = ? "
+            f"WHERE id IN ({','.join('?' * len(rows))})",
+            [time.time()] + [row_id for row_id, _ in rows],
+        )
+        applied += created
+        if len(rows) < batch_size:
+            break
+
+    journal.execute(
+        'DELETE FROM entries WHERE applied_at IS NOT NULL AND applied_at < ?',
+        (time.time() - RETENTION,),
+    )
+    leftover = pending_count()
+    if applied or failed:
+        logger.info(
+            f"Drained report journal: {applied} reports created, "
+            f"{failed} entries set aside, {leftover} still pending"
+        )
+    return applied, failed, leftover
+
+
+def _apply_one_by_one(journal, rows):
+    """
+    Apply ``rows`` one at a time. Returns ``(created, set_aside, still_pending)``
+    counts.
+    """
+    created = failed = pending = 0
+    for row_id, payload in rows:
+        try:
+            created += apply_entries([json.loads(payload)])
+        except Exception as e:
+            if _is_locked(e):
+                raise
+            journal.execute(
+                'UPDATE entries SET attempts = attempts + 1, last_error = ? '
+                'WHERE id = ?',
+                (str(e), row_id),
+            )
+            attempts = journal.execute(
+                'SELECT attempts FROM entries WHERE id = ?', (row_id,)
+            ).fetchone()[0]
+            if attempts >= MAX_ATTEMPTS:
+                journal.execute('UPDATE entries SET failed = 1 WHERE id = ?', (row_id,))
+                logger.error(
+                    f"Report journal entry {row_id} set aside after "
+                    f"{attempts} attempts: {e}"
+                )
+                failed += 1
+            else:
+                pending += 1
+            continue
+        journal.execute(
+            'UPDATE entries SET applied_at = ? WHERE id = ?', (time.time(), row_id)
+        )
+    return created, failed, pending
+
+
+def _is_locked(error):
+    return 'locked' in str(error).lower() or 'busy' in str(error).lower()
+
+
+_wakeup = threading.Event()
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _work():
+    delay = RETRY_DELAY
+    retry_in = None
+    while True:
+        # A new submission wakes the worker early; otherwise it sleeps until
+        # the retry of leftover entries is due, or for good when none are left
+        _wakeup.wait(retry_in)
+        _wakeup.clear()
+        try:
+            leftover = drain()[2]
+        except Exception as e:
+            logger.warning(
+                f"Report journal drain failed, retrying in {delay:.0f}s: {e}"
+            )
+            leftover = None
+        finally:
+            # Do not keep a database connection open in an idle thread
+            connections.close_all()
+        if leftover == 0:
+            delay = RETRY_DELAY
+            retry_in = None
+            continue
+        if leftover:
+            logger.info(
+                f"{leftover} report journal entries pending, retrying in {delay:.0f}s"
+            )
+        retry_in = delay
+        delay = min(delay * 2, MAX_RETRY_DELAY)
+
+
+def schedule_drain():
+    """Wake the background worker that drains the journal, starting it if needed."""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(
+                target=_work, name='report-journal-drain', daemon=True
+            )
+            _worker.start()
+    _wakeup.set()
+
+
+def drain_after_restart(**kwargs):
+    """
+    ``request_started`` receiver that runs once per process and schedules a
+    drain when a previous process left entries in the journal.
+    """
+    request_started.disconnect(dispatch_uid='report-journal-startup')
+    try:
+        if pending_count():
+            schedule_drain()
+    except Exception as e:
+        logger.warning(f"Could not check the report journal for pending entries: {e}")
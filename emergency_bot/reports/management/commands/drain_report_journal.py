@@ -0,0 +1,53 @@
+"""
+Management command to write journaled report submissions into the database.
+Usage: python manage.py drain_report_journal [--batch-size N] [--retry-failed]
+
+The web process drains the journal in the background after every
+submission; run this from cron (or after a restart) to apply anything the
+background worker did not get to, and to see entries that were set aside.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.reports import journal
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply pending report submissions from the write-ahead journal to the database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=journal.DEFAULT_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Queue entries that were set aside again',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        if options['retry_failed']:
+            self.stdout.write(f'Re-queued {journal.retry_failed()} entries')
+
+        try:
+            applied, failed, leftover = journal.drain(batch_size=options['batch_size'])
+        except Exception as e:
+            raise CommandError(f'Drain failed, entries stay queued: {e}')
+
+        for report_id, attempts, last_error in journal.failed_entries():
+            self.stdout.write(
+                self.style.WARNING(
+                    f'Set aside {report_id} after {attempts} attempts: {last_error}'
+                )
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Created {applied} reports, {failed} entries set aside, '
+                f'{leftover} still pending'
+            )
+        )
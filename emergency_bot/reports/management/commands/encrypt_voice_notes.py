@@ -0,0 +1,64 @@
+"""
+Management command to encrypt voice notes that were stored before encryption at rest.
+Usage: python manage.py encrypt_voice_notes
+
+Every plaintext file under voice_notes/ is encrypted in place, and reports
+still linking to its public media URL are switched to the serving view,
+which decrypts on the fly. Already encrypted files are skipped, so the
+command can be run again safely.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.reports.media_encryption import (
+    encrypt_file,
+    encryption_enabled,
+    is_encrypted,
+)
+from emergency_bot.reports.models import IncidentReport
+from emergency_bot.reports.transcoding import META_NAME, VOICE_NOTES_DIR, voice_note_url
+
+
+class Command(BaseCommand):
+    help = (
+        'Encrypt plaintext voice notes in place and point their reports at the '
+        'decrypting view'
+    )
+
+    def handle(self, *args, **options):
+        if not encryption_enabled():
+            raise CommandError(
+                'Voice note encryption is disabled or no usable ENCRYPTION_KEY is '
+                'configured'
+            )
+
+        encrypted = skipped = switched = 0
+        root = default_storage.path(VOICE_NOTES_DIR)
+        for directory, _, filenames in os.walk(root):
+            if directory == root:
+                continue
+            for filename in sorted(filenames):
+                if filename == META_NAME or filename.endswith(('.part', '.tmp')):
+                    continue
+                path = os.path.join(directory, filename)
+                name = f'{VOICE_NOTES_DIR}/{os.path.basename(directory)}/{filename}'
+                if not is_encrypted(path):
+                    encrypt_file(path, path)
+                    encrypted += 1
+                else:
+                    skipped += 1
+                # The old media URL would now serve ciphertext
+                switched += IncidentReport.objects.filter(
+                    voice_note_url=settings.MEDIA_URL + name
+                ).update(voice_note_url=voice_note_url(name))
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Encrypted {encrypted} voice notes ({skipped} already encrypted), '
+                f'switched {switched} reports'
+            )
+        )
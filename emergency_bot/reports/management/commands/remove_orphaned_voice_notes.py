@@ -0,0 +1,44 @@
+"""
+Management command to remove voice notes that no report links to.
+Usage: python manage.py remove_orphaned_voice_notes [--grace SECONDS] [--dry-run]
+
+The web process sweeps these periodically; run this to clean up on
+demand, e.g. on a deployment where uploads are rare.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.reports.voice_note_cleanup import (
+    orphan_grace,
+    remove_orphaned_voice_notes,
+)
+
+
+class Command(BaseCommand):
+    help = 'Remove voice note directories that no report or pending submission links to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace',
+            type=int,
+            default=None,
+            help='Seconds a directory must be unchanged before it is removed',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='List the directories without removing them',
+        )
+
+    def handle(self, *args, **options):
+        grace = orphan_grace() if options['grace'] is None else options['grace']
+        if grace < 0:
+            raise CommandError('--grace must not be negative')
+
+        orphans = remove_orphaned_voice_notes(grace=grace, dry_run=options['dry_run'])
+        for path in orphans:
+            self.stdout.write(path)
+        verb = 'Would remove' if options['dry_run'] else 'Removed'
+        self.stdout.write(
+            self.style.SUCCESS(f'{verb} {len(orphans)} orphaned voice note directories')
+        )
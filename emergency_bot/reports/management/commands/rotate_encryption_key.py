@@ -0,0 +1,73 @@
+"""
+Management command to re-encrypt report descriptions with the primary encryption key.
+Usage: python manage.py rotate_encryption_key [--batch-size N] [--pause SECONDS]
+                                              [--restart]
+
+Put the new key first in ENCRYPTION_KEYS, followed by the old ones, deploy,
+then run this command. It can be interrupted and run again at any time; it
+continues after the last finished batch.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.reports.rotation import (
+    DEFAULT_BATCH_SIZE,
+    checkpoint_path,
+    rotate_reports,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypt incident report descriptions under the primary key of '
+        'ENCRYPTION_KEYS'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=0.1, help='Seconds to sleep between batches'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Checkpoint file (defaults to REPORT_KEY_ROTATION_CHECKPOINT)',
+        )
+        parser.add_argument(
+            '--restart',
+            action='store_true',
+            help='Ignore the checkpoint and start from the first report',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['pause'] < 0:
+            raise CommandError('--pause cannot be negative')
+
+        verbosity = options['verbosity']
+
+        def progress(stats):
+            if verbosity > 1:
+                self.stdout.write(
+                    f"Batch {stats.batches} (up to {stats.last_id}): {stats.summary()}"
+                )
+
+        try:
+            stats = rotate_reports(
+                batch_size=options['batch_size'],
+                pause=options['pause'],
+                restart=options['restart'],
+                path=options['checkpoint'] or checkpoint_path(),
+                progress=progress,
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if stats.failed:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'{stats.failed} descriptions could not be decrypted with any '
+                    'configured key'
+                )
+            )
+        self.stdout.write(self.style.SUCCESS(f'Rotated {stats.summary()}'))
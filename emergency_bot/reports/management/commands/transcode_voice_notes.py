@@ -0,0 +1,94 @@
+"""
+Management command to transcode voice notes the background worker has not handled.
+Usage: python manage.py transcode_voice_notes [--retry-failed] [--delete-originals]
+                                              [--grace SECONDS]
+
+Uploads are normally transcoded by the worker thread in the web process;
+this catches up on anything it lost (e.g. on a restart), points reports
+that still use an original upload at its compressed copy, and optionally
+removes originals that nothing refers to any more.
+"""
+
+import time
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from emergency_bot.reports.models import IncidentReport
+from emergency_bot.reports.transcoding import (
+    ffmpeg_binary,
+    iter_voice_notes,
+    process_voice_note,
+    read_meta,
+    switch_reports,
+    voice_note_urls,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Transcode pending voice notes to Opus and switch reports to the '
+        'compressed files'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Try again on voice notes that failed before',
+        )
+        parser.add_argument(
+            '--delete-originals',
+            action='store_true',
+            help='Remove originals with a compressed copy',
+        )
+        parser.add_argument(
+            '--grace',
+            type=int,
+            default=3600,
+            help='Seconds after transcoding before an original may be removed',
+        )
+
+    def handle(self, *args, **options):
+        if ffmpeg_binary() is None:
+            raise CommandError(
+                'ffmpeg is not installed (set FFMPEG_BINARY to its path)'
+            )
+
+        transcoded = failed = switched = deleted = 0
+        cutoff = time.time() - options['grace']
+        for name in iter_voice_notes():
+            meta = read_meta(name)
+            if meta is None or (meta['status'] == 'failed' and options['retry_failed']):
+                meta = process_voice_note(name)
+                if meta['status'] == 'failed':
+                    failed += 1
+                    self.stdout.write(
+                        self.style.WARNING(f"Failed {name}: {meta['error']}")
+                    )
+                    continue
+                transcoded += 1
+            elif meta['status'] == 'done':
+                # Reports submitted while the worker was still running
+                switched += switch_reports(meta)
+            else:
+                continue
+
+            if (
+                options['delete_originals']
+                and meta['compressed']
+                and meta['transcoded_at'] < cutoff
+                and not IncidentReport.objects.filter(
+                    voice_note_url__in=voice_note_urls(name)
+                ).exists()
+            ):
+                default_storage.delete(name)
+                deleted += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Transcoded {transcoded} voice notes ({failed} failed), '
+                f'switched {switched} reports, '
+                f'removed {deleted} originals'
+            )
+        )
@@ -0,0 +1,212 @@
+"""
+Chunked authenticated encryption for voice notes at rest.
+
+A file is a 24-byte header followed by independently sealed AES-256-GCM
+chunks of ``CHUNK_SIZE`` plaintext bytes each:
+
+    b'GVN1' | key id (8) | nonce prefix (8) | chunk size (4, big-endian)
+
+Chunk ``i`` uses the nonce ``prefix + i`` and the header plus a last-chunk
+flag as associated data, so chunks cannot be reordered, moved between
+files or cut off at a chunk boundary without failing authentication.
+Because every chunk stands alone, a file is encrypted and decrypted one
+chunk at a time in constant memory, and any byte range can be served by
+decrypting only the chunks it touches.
+
+The keys are derived from the configured ``ENCRYPTION_KEYS`` (primary
+first), and the key id in the header picks the right one, so files stay
+readable after a key rotation.
+"""
+
+import base64
+import functools
+import hashlib
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+
+from .models import get_encryption_keys
+
+MAGIC = b'GVN1'
+HEADER = struct.Struct('>4s8s8sI')
+CHUNK_SIZE = 64 * 1024
+TAG_SIZE = 16
+HKDF_INFO = b'gaddisa voice notes'
+
+
+class MediaDecryptionError(Exception):
+    pass
+
+
+@functools.lru_cache(maxsize=4)
+def _media_keys(keys):
+    """
+    Return ``((key_id, AESGCM), ...)`` derived from the configured keys,
+    primary first. Like descriptions, nothing is encrypted when the primary
+    key is unusable, and unusable old keys are skipped.
+    """
+    derived = []
+    for position, key in enumerate(keys):
+        try:
+            raw = base64.urlsafe_b64decode(key)
+        except ValueError:
+            raw = b''
+        if len(raw) != 32:
+            if position == 0:
+                return ()
+            continue
+        secret = HKDF(
+            algorithm=hashes.SHA256(), length=32, salt=None, info=HKDF_INFO
+        ).derive(raw)
+        derived.append((hashlib.sha256(secret).digest()[:8], AESGCM(secret)))
+    return tuple(derived)
+
+
+def media_keys():
+    keys = get_encryption_keys()
+    return _media_keys(keys) if keys else ()
+
+
+def encryption_enabled():
+    """
+    Voice notes are encrypted when VOICE_NOTE_ENCRYPTION is on and a usable key
+    is configured.
+    """
+    return getattr(settings, 'VOICE_NOTE_ENCRYPTION', True) and bool(media_keys())
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+
+def _aad(header, last):
+    return header + (b'\x01' if last else b'\x00')
+
+
+def encrypt_chunks(chunks, out):
+    """
+    Encrypt the plaintext byte strings from ``chunks`` into the binary file
+    ``out`` with the primary key. Returns the plaintext size.
+    """
+    keys = media_keys()
+    if not keys:
+        raise ValueError("No usable encryption key is configured")
+    key_id, aead = keys[0]
+    header = HEADER.pack(MAGIC, key_id, os.urandom(8), CHUNK_SIZE)
+    prefix = header[12:20]
+    out.write(header)
+
+    index = 0
+    size = 0
+    buffer = b''
+    for data in chunks:
+        buffer += data
+        size += len(data)
+        # Hold back the last full chunk: only the end of input tells whether it is
+        # the final one
+        while len(buffer) > CHUNK_SIZE:
+            out.write(
+                aead.encrypt(
+                    _nonce(prefix, index), buffer[:CHUNK_SIZE], _aad(header, False)
+                )
+            )
+            buffer = buffer[CHUNK_SIZE:]
+            index += 1
+    out.write(aead.encrypt(_nonce(prefix, index), buffer, _aad(header, True)))
+    return size
+
+
+def _file_chunks(fileobj, size=CHUNK_SIZE):
+    while True:
+        data = fileobj.read(size)
+        if not data:
+            return
+        yield data
+
+
+def encrypt_file(source, target):
+    """
+    Encrypt the plaintext file ``source`` into ``target`` (which may be the
+    same path). The result is written to a temporary file and moved into
+    place, so ``target`` is never left half-written.
+    """
+    tmp_path = f'{target}.enc.tmp'
+    try:
+        with open(source, 'rb') as f, open(tmp_path, 'wb') as out:
+            encrypt_chunks(_file_chunks(f), out)
+        os.replace(tmp_path, target)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_encrypted(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class EncryptedFile:
+    """
+    Read access to an encrypted voice note. ``size`` is the plaintext size
+    and ``iter_range`` yields the plaintext of a byte range chunk by chunk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header = f.read(HEADER.size)
+        if len(self.header) != HEADER.size:
+            raise MediaDecryptionError("File is too short")
+        magic, key_id, self.prefix, self.chunk_size = HEADER.unpack(self.header)
+        if magic != MAGIC or not self.chunk_size:
+            raise MediaDecryptionError("File is not an encrypted voice note")
+        for candidate_id, aead in media_keys():
+            if candidate_id == key_id:
+                self.aead = aead
+                break
+        else:
+            raise MediaDecryptionError(
+                "File was encrypted with a key that is no longer configured"
+            )
+
+        sealed = os.path.getsize(path) - HEADER.size
+        stride = self.chunk_size + TAG_SIZE
+        # Every file ends with a (possibly empty) final chunk
+        self.chunks = max(1, -(-sealed // stride))
+        self.size = sealed - self.chunks * TAG_SIZE
+        if self.size < 0:
+            raise MediaDecryptionError("File is truncated")
+
+    def _read_chunk(self, f, index):
+        stride = self.chunk_size + TAG_SIZE
+        f.seek(HEADER.size + index * stride)
+        sealed = f.read(stride)
+        last = index == self.chunks - 1
+        try:
+            return self.aead.decrypt(
+                _nonce(self.prefix, index), sealed, _aad(self.header, last)
+            )
+        except InvalidTag:
+            raise MediaDecryptionError(f"Chunk {index} failed authentication")
+
+    def iter_range(self, start=0, end=None):
+        """
+        Yield the plaintext bytes ``start``..``end`` (inclusive), decrypting one
+        chunk at a time.
+        """
+        end = self.size - 1 if end is None else min(end, self.size - 1)
+        if start > end:
+            return
+        with open(self.path, 'rb') as f:
+            for index in range(start // self.chunk_size, end // self.chunk_size + 1):
+                plaintext = self._read_chunk(f, index)
+                offset = index * self.chunk_size
+                yield plaintext[max(start - offset, 0) : end - offset + 1]
+
+    def __iter__(self):
+        return self.iter_range()
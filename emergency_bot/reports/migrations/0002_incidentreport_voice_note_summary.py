@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 00:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='incidentreport',
+            name='voice_note_duration',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='incidentreport',
+            name='voice_note_waveform',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -2,52 +2,130 @@ from django.db import models
 from django.utils import timezone
 from django.conf import settings
 import uuid
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet
 import base64
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
 
 # For encryption of sensitive data
-def get_encryption_key():
-    from django.conf import settings
-    key = getattr(settings, 'ENCRYPTION_KEY', None)
-    if key:
+def get_encryption_keys():
+    """
+    Return the configured encryption keys, primary first.
+    ``ENCRYPTION_KEYS`` lists the primary key followed by older keys that are
+    still accepted for reading; without it the single ``ENCRYPTION_KEY`` is used.
+    """
+    keys = getattr(settings, 'ENCRYPTION_KEYS', None) or []
+    if isinstance(keys, str):
+        keys = keys.split(',')
+    keys = [key.strip() for key in keys if key and key.strip()]
+    if not keys and getattr(settings, 'ENCRYPTION_KEY', None):
+        keys = [settings.ENCRYPTION_KEY]
+    return tuple(keys)
+
+@functools.lru_cache(maxsize=4)
+def _fernets_for_keys(keys):
+    """
+    Build one Fernet per configured key, once per set of key values.
+    Problems with the keys are logged here, once, instead of on every call.
+    Returns an empty tuple when the primary key is unusable.
+    """
+    fernets = []
+    for position, key in enumerate(keys):
         try:
             # Make sure the key is valid
             decoded_key = base64.urlsafe_b64decode(key)
-            if len(decoded_key) == 32:
-                return decoded_key
-            else:
-                # Log warning but don't crash
-                import logging
-                logging.warning("ENCRYPTION_KEY is not 32 bytes long. Encryption disabled.")
+            if len(decoded_key) != 32:
+                raise ValueError("key is not 32 bytes long")
+            fernets.append(Fernet(key))
         except Exception as e:
-            # Log error but don't crash
-            import logging
-            logging.error(f"Invalid ENCRYPTION_KEY: {e}. Encryption disabled.")
-    return None
+            if position == 0:
+                logger.error(f"Invalid ENCRYPTION_KEY: {e}. Encryption disabled.")
+                return ()
+            logger.warning(f"Ignoring invalid old encryption key #{position}: {e}")
+    return tuple(fernets)
+
+@functools.lru_cache(maxsize=4)
+def _cipher_for_keys(keys):
+    fernets = _fernets_for_keys(keys)
+    return MultiFernet(fernets) if fernets else None
+
+def get_cipher():
+    """
+    Return the cached ``MultiFernet`` for the configured keys, or None.
+    It encrypts with the primary key and decrypts with any of them.
+    """
+    keys = get_encryption_keys()
+    if not keys:
+        return None
+    return _cipher_for_keys(keys)
+
+def get_primary_cipher():
+    """Return the cached ``Fernet`` for the primary key only, or None."""
+    keys = get_encryption_keys()
+    if not keys:
+        return None
+    fernets = _fernets_for_keys(keys)
+    return fernets[0] if fernets else None
+
+def get_encryption_key():
+    """Return the decoded 32-byte primary encryption key, or None if it is missing or invalid."""
+    if get_primary_cipher() is None:
+        return None
+    return base64.urlsafe_b64decode(get_encryption_keys()[0])
 
 def encrypt_text(text):
-    key = get_encryption_key()
-    if key and text:
-        try:
-            f = Fernet(key)
-            return f.encrypt(text.encode()).decode()
-        except Exception as e:
-            # Log error but don't crash
-            import logging
-            logging.error(f"Encryption error: {e}. Storing text unencrypted.")
-    return text
+    return encrypt_many([text])[0]
 
 def decrypt_text(encrypted_text):
-    key = get_encryption_key()
-    if key and encrypted_text:
-        try:
-            f = Fernet(key)
-            return f.decrypt(encrypted_text.encode()).decode()
-        except Exception as e:
-            # Log error but don't crash
-            import logging
-            logging.error(f"Decryption error: {e}. Returning original text.")
-    return encrypted_text
+    return decrypt_many([encrypted_text])[0]
+
+def encrypt_many(texts):
+    """
+    Encrypt a batch of texts with one cipher lookup.
+    Empty values, and every value when encryption is disabled, are returned unchanged.
+    """
+    cipher = get_cipher()
+    if cipher is None:
+        return list(texts)
+    results = []
+    for text in texts:
+        if text:
+            try:
+                text = cipher.encrypt(text.encode()).decode()
+            except Exception as e:
+                # Log error but don't crash
+                logger.error(f"Encryption error: {e}. Storing text unencrypted.")
+        results.append(text)
+    return results
+
+# Every Fernet token starts with the version byte 0x80, base64-encoded
+FERNET_TOKEN_PREFIX = 'gA'
+
+def decrypt_many(encrypted_texts):
+    """
+    Decrypt a batch of tokens with one cipher lookup.
+    Values that cannot be decrypted are returned unchanged; values that are
+    not tokens at all (plain text stored while encryption never worked) are
+    returned without being counted as failures.
+    """
+    cipher = get_cipher()
+    if cipher is None:
+        return list(encrypted_texts)
+    results = []
+    failures = 0
+    for encrypted_text in encrypted_texts:
+        if encrypted_text and encrypted_text.startswith(FERNET_TOKEN_PREFIX):
+            try:
+                encrypted_text = cipher.decrypt(encrypted_text.encode()).decode()
+            except Exception:
+                failures += 1
+        results.append(encrypted_text)
+    if failures:
+        # Log error but don't crash
+        logger.error(f"Decryption failed for {failures} of {len(results)} values. Returning original text.")
+    return results
 
 
 class IncidentReport(models.Model):
@@ -72,6 +150,9 @@ class IncidentReport(models.Model):
     description = models.TextField(null=True, blank=True)
     description_encrypted = models.TextField(null=True, blank=True)
     voice_note_url = models.URLField(max_length=255, null=True, blank=True)
+    # Filled in once the voice note has been transcoded
+    voice_note_duration = models.FloatField(null=True, blank=True)
+    voice_note_waveform = models.JSONField(null=True, blank=True)
     location = models.CharField(max_length=255)
     latitude = models.FloatField()
     longitude = models.FloatField()
@@ -98,8 +179,10 @@ class IncidentReport(models.Model):
         return f"{self.get_type_display()} - {self.submitted_at}"
     
     def save(self, *args, **kwargs):
-        # Encrypt description if provided
-        if self.description and not self.description_encrypted:
+        # Encrypt description if provided, again when it was edited after encryption
+        if self.description and (
+            not self.description_encrypted or decrypt_text(self.description_encrypted) != self.description
+        ):
             try:
                 encrypted = encrypt_text(self.description)
                 # Only set encrypted text if encryption actually worked
@@ -115,9 +198,22 @@ class IncidentReport(models.Model):
         super().save(*args, **kwargs)
     
     def get_decrypted_description(self):
+        if hasattr(self, '_decrypted_description'):
+            return self._decrypted_description
         if self.description_encrypted:
             return decrypt_text(self.description_encrypted)
         return self.description
+    
+    @staticmethod
+    def decrypt_descriptions(reports):
+        """
+        Decrypt the descriptions of a page of reports in one batch, so that
+        ``get_decrypted_description`` on each of them does no further work.
+        """
+        reports = [report for report in reports if report.description_encrypted]
+        decrypted = decrypt_many([report.description_encrypted for report in reports])
+        for report, description in zip(reports, decrypted):
+            report._decrypted_description = description
         
     @property
     def time_since_submission(self):
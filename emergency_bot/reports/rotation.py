@@ -0,0 +1,209 @@
+"""
+Re-encryption of report descriptions after an encryption key rotation.
+
+New writes always use the primary (first) key of ``ENCRYPTION_KEYS`` and
+reads try every configured key, so rotating only has to move existing rows
+onto the primary key, and it can happen while the site is live. Reports
+are walked in primary key order with keyset pagination and rewritten one
+short transaction per batch, so no long table locks are held. Progress is
+checkpointed to a file after every batch and an interrupted run resumes
+after the last finished batch.
+
+Keep the old keys in ``ENCRYPTION_KEYS`` until a run reports nothing left
+to rotate: a report saved from a copy loaded before its batch was rewritten
+still carries a token under an old key.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import IncidentReport, get_cipher, get_encryption_keys, get_primary_cipher
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 200
+
+
+def checkpoint_path():
+    default = os.path.join(settings.BASE_DIR, 'tmp', 'report_key_rotation.json')
+    return getattr(settings, 'REPORT_KEY_ROTATION_CHECKPOINT', default)
+
+
+def key_fingerprint(key):
+    """Return a short fingerprint identifying ``key`` without revealing it."""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def load_checkpoint(path, fingerprint):
+    """
+    Return the id of the last rotated report recorded at ``path``, or None.
+    Checkpoints written for a different primary key are ignored.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable rotation checkpoint {path}: {e}")
+        return None
+    if checkpoint.get('fingerprint') != fingerprint:
+        logger.info("Rotation checkpoint belongs to another primary key; starting over")
+        return None
+    return checkpoint.get('last_id')
+
+
+def save_checkpoint(path, fingerprint, stats):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    checkpoint = {
+        'fingerprint': fingerprint,
+        'last_id': stats.last_id,
+        'updated_at': timezone.now().isoformat(),
+        'stats': stats.as_dict(),
+    }
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+class RotationStats:
+    """Counters for one rotation run."""
+
+    def __init__(self, last_id=None):
+        self.scanned = 0
+        self.rotated = 0
+        self.encrypted = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_id = last_id
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def as_dict(self):
+        return {
+            'scanned': self.scanned,
+            'rotated': self.rotated,
+            'encrypted': self.encrypted,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'batches': self.batches,
+        }
+
+    def summary(self):
+        return (
+            f"{self.scanned} reports in {self.elapsed:.2f}s: "
+            f"{self.rotated} re-encrypted, "
+            f"{self.encrypted} encrypted for the first time, "
+            f"{self.unchanged} unchanged, "
+            f"{self.failed} not decryptable"
+        )
+
+
+def rotate_batch(reports, primary, cipher, stats):
+    """
+    Move the descriptions of ``reports`` onto the primary key in place.
+    Returns the reports that changed.
+    """
+    changed = []
+    for report in reports:
+        stats.scanned += 1
+        token = report.description_encrypted
+        if not token:
+            if report.description:
+                # Saved while encryption was disabled or misconfigured
+                report.description_encrypted = primary.encrypt(
+                    report.description.encode()
+                ).decode()
+                stats.encrypted += 1
+                changed.append(report)
+            else:
+                stats.unchanged += 1
+            continue
+        try:
+            primary.decrypt(token.encode())
+        except InvalidToken:
+            pass
+        else:
+            stats.unchanged += 1
+            continue
+        try:
+            report.description_encrypted = cipher.rotate(token.encode()).decode()
+        except InvalidToken:
+            stats.failed += 1
+            continue
+        stats.rotated += 1
+        changed.append(report)
+    return changed
+
+
+def rotate_reports(
+    batch_size=DEFAULT_BATCH_SIZE, pause=0.0, restart=False, path=None, progress=None
+):
+    """
+    Re-encrypt every report description that is not under the primary key.
+
+    Batches of ``batch_size`` reports are read in primary key order and
+    written back in one transaction each, sleeping ``pause`` seconds between
+    batches. The run resumes from the checkpoint at ``path`` unless
+    ``restart`` is set, and the checkpoint is removed once every report has
+    been visited. ``progress`` is called with the ``RotationStats`` after
+    every batch. Raises ValueError when encryption is not configured.
+    """
+    primary = get_primary_cipher()
+    cipher = get_cipher()
+    if primary is None or cipher is None:
+        raise ValueError("No usable encryption key is configured")
+
+    path = path or checkpoint_path()
+    fingerprint = key_fingerprint(get_encryption_keys()[0])
+    last_id = None if restart else load_checkpoint(path, fingerprint)
+    stats = RotationStats(last_id)
+    if last_id:
+        logger.info(f"Resuming key rotation after report {last_id}")
+
+    while True:
+        queryset = IncidentReport.objects.order_by('pk').only(
+            'id', 'description', 'description_encrypted'
+        )
+        if stats.last_id:
+            queryset = queryset.filter(pk__gt=stats.last_id)
+        reports = list(queryset[:batch_size])
+        if not reports:
+            break
+
+        changed = rotate_batch(reports, primary, cipher, stats)
+        if changed:
+            # bulk_update leaves last_updated alone: rotating is not an edit of the
+            # report
+            with transaction.atomic():
+                IncidentReport.objects.bulk_update(changed, ['description_encrypted'])
+
+        stats.last_id = str(reports[-1].pk)
+        stats.batches += 1
+        save_checkpoint(path, fingerprint, stats)
+        if progress:
+            progress(stats)
+        if len(reports) < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    logger.info(f"Key rotation finished: {stats.summary()}")
+    return stats
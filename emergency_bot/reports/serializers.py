@@ -4,9 +4,20 @@ Serializers for the reports app.
 
 from rest_framework import serializers
 from .models import IncidentReport
+from .transcoding import resolve_voice_note
 from emergency_bot.agencies.models import Agency
 
 
+class IncidentReportListSerializer(serializers.ListSerializer):
+    """
+    List serializer that decrypts the descriptions of a whole page at once.
+    """
+    def to_representation(self, data):
+        reports = list(data.all() if hasattr(data, 'all') else data)
+        IncidentReport.decrypt_descriptions(reports)
+        return super().to_representation(reports)
+
+
 class IncidentReportSerializer(serializers.ModelSerializer):
     """
     Serializer for IncidentReport model.
@@ -15,10 +26,17 @@ class IncidentReportSerializer(serializers.ModelSerializer):
         model = IncidentReport
         fields = [
             'id', 'type', 'description', 'voice_note_url',
+            'voice_note_duration', 'voice_note_waveform',
             'location', 'latitude', 'longitude', 'status',
             'submitted_at', 'last_updated'
         ]
-        read_only_fields = ['id', 'submitted_at', 'last_updated']
+        read_only_fields = ['id', 'voice_note_duration', 'voice_note_waveform', 'submitted_at', 'last_updated']
+        list_serializer_class = IncidentReportListSerializer
+    
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        data['description'] = instance.get_decrypted_description()
+        return data
     
     def create(self, validated_data):
         request = self.context.get('request')
@@ -41,6 +59,11 @@ class IncidentReportSerializer(serializers.ModelSerializer):
             validated_data['ip_address'] = self.get_client_ip(request)
             validated_data['device_info'] = request.META.get('HTTP_USER_AGENT', '')
         
+        # Link the compressed voice note if it has already been transcoded
+        if validated_data.get('voice_note_url'):
+            url, duration, waveform = resolve_voice_note(validated_data['voice_note_url'])
+            validated_data.update(voice_note_url=url, voice_note_duration=duration, voice_note_waveform=waveform)
+        
         # Create and return the report
         return super().create(validated_data)
     
@@ -67,17 +90,17 @@ class IncidentReportDetailSerializer(IncidentReportSerializer):
         """Get nearby agencies based on report location"""
         from emergency_bot.agencies.serializers import AgencySerializer
         
-        # Find agencies within 10km of the incident
+        # The five closest agencies within 10km of the incident; the database
+        # computes and orders by the distance, so only those rows are loaded
+        agencies = Agency.objects.filter(active=True).within_radius(
+            obj.latitude, obj.longitude, 10
+        )[:5]
         nearby_agencies = []
-        for agency in Agency.objects.filter(active=True):
-            distance = agency.calculate_distance(obj.latitude, obj.longitude)
-            if distance <= 10:  # 10km radius
-                agency_data = AgencySerializer(agency).data
-                agency_data['distance_km'] = round(distance, 2)
-                nearby_agencies.append(agency_data)
-        
-        # Sort by distance
-        return sorted(nearby_agencies, key=lambda x: x['distance_km'])[:5]
+        for agency in agencies:
+            agency_data = AgencySerializer(agency).data
+            agency_data['distance_km'] = round(agency.distance, 2)
+            nearby_agencies.append(agency_data)
+        return nearby_agencies
 
 
 class ReportStatusUpdateSerializer(serializers.Serializer):
@@ -0,0 +1,480 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from io import BytesIO, StringIO
+from unittest import mock
+
+from cryptography.fernet import Fernet
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from emergency_bot.accounts.models import UserProfile
+from emergency_bot.agencies.models import Agency
+
+from . import journal
+from .media_encryption import (
+    CHUNK_SIZE,
+    HEADER,
+    TAG_SIZE,
+    EncryptedFile,
+    MediaDecryptionError,
+    encrypt_chunks,
+)
+from .models import IncidentReport, decrypt_many, encrypt_many, get_cipher
+from .rotation import rotate_reports
+from .serializers import IncidentReportDetailSerializer
+from .transcoding import VOICE_NOTES_DIR
+from .voice_note_cleanup import find_orphaned_voice_notes
+
+OLD_KEY = Fernet.generate_key().decode()
+NEW_KEY = Fernet.generate_key().decode()
+
+
+@override_settings(ENCRYPTION_KEYS=[OLD_KEY])
+class ReportEncryptionTests(TestCase):
+    def test_cipher_is_built_once_per_key_set(self):
+        cipher = get_cipher()
+        self.assertIs(get_cipher(), cipher)
+        with override_settings(ENCRYPTION_KEYS=[NEW_KEY, OLD_KEY]):
+            self.assertIsNot(get_cipher(), cipher)
+
+    def test_batch_round_trip_keeps_empty_values(self):
+        encrypted = encrypt_many(['first', '', None, 'second'])
+        self.assertEqual(encrypted[1:3], ['', None])
+        self.assertNotEqual(encrypted[0], 'first')
+        self.assertEqual(decrypt_many(encrypted), ['first', '', None, 'second'])
+
+    def test_plain_text_is_returned_unchanged(self):
+        self.assertEqual(decrypt_many(['never encrypted']), ['never encrypted'])
+
+    @override_settings(ENCRYPTION_KEYS=['not-a-key'])
+    def test_invalid_key_disables_encryption(self):
+        self.assertIsNone(get_cipher())
+        self.assertEqual(encrypt_many(['text']), ['text'])
+
+    def test_page_of_reports_is_decrypted_in_one_batch(self):
+        user = UserProfile.objects.create(telegram_id='101')
+        for number in range(3):
+            IncidentReport.objects.create(
+                user=user,
+                type='other',
+                description=f'report {number}',
+                location='GPS: 9.0, 38.7',
+                latitude=9.0,
+                longitude=38.7,
+            )
+        reports = list(IncidentReport.objects.order_by('description'))
+        IncidentReport.decrypt_descriptions(reports)
+        with override_settings(ENCRYPTION_KEYS=[NEW_KEY]):
+            # Already decrypted: no cipher is needed any more
+            self.assertEqual(
+                [report.get_decrypted_description() for report in reports],
+                ['report 0', 'report 1', 'report 2'],
+            )
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt(stats):
+    raise Interrupted()
+
+
+class KeyRotationTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.checkpoint = os.path.join(self.directory, 'rotation.json')
+        self.user = UserProfile.objects.create(telegram_id='100')
+        with override_settings(ENCRYPTION_KEYS=[OLD_KEY]):
+            for number in range(5):
+                IncidentReport.objects.create(
+                    user=self.user,
+                    type='other',
+                    description=f'report {number}',
+                    location='GPS: 9.0, 38.7',
+                    latitude=9.0,
+                    longitude=38.7,
+                )
+
+    def assert_all_under(self, key):
+        fernet = Fernet(key.encode())
+        for report in IncidentReport.objects.all():
+            decrypted = fernet.decrypt(report.description_encrypted.encode())
+            self.assertEqual(decrypted.decode(), report.description)
+
+    @override_settings(ENCRYPTION_KEYS=[NEW_KEY, OLD_KEY])
+    def test_interrupted_rotation_resumes_from_checkpoint(self):
+        def stop_after_two(stats):
+            if stats.batches == 2:
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            rotate_reports(batch_size=1, path=self.checkpoint, progress=stop_after_two)
+        self.assertTrue(os.path.exists(self.checkpoint))
+
+        stats = rotate_reports(batch_size=1, path=self.checkpoint)
+        self.assertEqual(stats.scanned, 3)
+        self.assertEqual(stats.rotated, 3)
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assert_all_under(NEW_KEY)
+
+    @override_settings(ENCRYPTION_KEYS=[NEW_KEY, OLD_KEY])
+    def test_plaintext_rows_are_encrypted(self):
+        IncidentReport.objects.filter(description='report 0').update(
+            description_encrypted=None
+        )
+        stats = rotate_reports(batch_size=2, path=self.checkpoint)
+        self.assertEqual((stats.encrypted, stats.rotated), (1, 4))
+        self.assert_all_under(NEW_KEY)
+
+    @override_settings(ENCRYPTION_KEYS=[NEW_KEY, OLD_KEY])
+    def test_checkpoint_for_another_key_is_ignored(self):
+        with override_settings(ENCRYPTION_KEYS=[OLD_KEY]):
+            with self.assertRaises(Interrupted):
+                rotate_reports(batch_size=1, path=self.checkpoint, progress=interrupt)
+        stats = rotate_reports(batch_size=1, path=self.checkpoint)
+        self.assertEqual(stats.scanned, 5)
+        self.assert_all_under(NEW_KEY)
+
+    def test_reports_under_the_old_key_still_decrypt_after_adding_a_key(self):
+        with override_settings(ENCRYPTION_KEYS=[NEW_KEY, OLD_KEY]):
+            report = IncidentReport.objects.get(description='report 3')
+            self.assertEqual(report.get_decrypted_description(), 'report 3')
+
+
+class JournalMixin:
+    def use_temporary_journal(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'journal.sqlite3')
+        journal_settings = override_settings(REPORT_JOURNAL_PATH=path)
+        journal_settings.enable()
+        self.addCleanup(journal_settings.disable)
+
+    def payload(self, **fields):
+        payload = {
+            'telegram_id': '200',
+            'type': 'harassment',
+            'description': 'followed home',
+            'location': 'GPS: 9.0, 38.7',
+            'latitude': 9.0,
+            'longitude': 38.7,
+        }
+        payload.update(fields)
+        return payload
+
+
+class ReportJournalTests(JournalMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_journal()
+
+    def test_drain_creates_the_report_with_the_acknowledged_id(self):
+        report_id = journal.append(self.payload())
+        self.assertEqual(journal.pending_count(), 1)
+        self.assertEqual(journal.entry_status(report_id)['state'], 'pending')
+        self.assertFalse(IncidentReport.objects.filter(pk=report_id).exists())
+
+        self.assertEqual(journal.drain(), (1, 0, 0))
+        report = IncidentReport.objects.get(pk=report_id)
+        self.assertEqual(report.get_decrypted_description(), 'followed home')
+        self.assertEqual(report.user.telegram_id, '200')
+        self.assertEqual(journal.pending_count(), 0)
+        self.assertEqual(journal.entry_status(report_id)['state'], 'applied')
+
+    def test_applying_an_entry_twice_creates_one_report(self):
+        report_id = str(uuid.uuid4())
+        payload = self.payload(
+            report_id=report_id, submitted_at='2026-01-01T00:00:00+00:00'
+        )
+        journal.apply_entries([payload])
+        journal.append(payload)
+
+        self.assertEqual(journal.drain(), (0, 0, 0))
+        self.assertEqual(IncidentReport.objects.filter(pk=report_id).count(), 1)
+
+    def test_bad_entry_does_not_hold_back_the_batch(self):
+        good_id = journal.append(self.payload())
+        bad_id = journal.append(self.payload(latitude='north'))
+
+        self.assertEqual(journal.drain(), (1, 0, 1))
+        self.assertTrue(IncidentReport.objects.filter(pk=good_id).exists())
+        self.assertEqual(journal.entry_status(bad_id)['state'], 'pending')
+
+    def test_entry_is_set_aside_after_max_attempts(self):
+        bad_id = journal.append(self.payload(latitude='north'))
+        with mock.patch.object(journal, 'MAX_ATTEMPTS', 2):
+            self.assertEqual(journal.drain(), (0, 0, 1))
+            self.assertEqual(journal.drain(), (0, 1, 0))
+        self.assertEqual(journal.entry_status(bad_id)['state'], 'failed')
+
+        out = StringIO()
+        call_command('drain_report_journal', stdout=out)
+        self.assertIn(f'Set aside {bad_id}', out.getvalue())
+        self.assertIn('0 still pending', out.getvalue())
+
+    def test_unknown_report_has_no_status(self):
+        self.assertIsNone(journal.entry_status(uuid.uuid4()))
+
+
+class ReportJournalWorkerTests(JournalMixin, TransactionTestCase):
+    def setUp(self):
+        self.use_temporary_journal()
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+
+    @mock.patch.object(journal, 'RETRY_DELAY', 0.05)
+    def test_pending_entry_is_retried_without_a_new_submission(self):
+        apply_entries = journal.apply_entries
+        calls = []
+
+        def fail_first_attempts(payloads):
+            calls.append(len(payloads))
+            if len(calls) <= 2:
+                # The batch and then the entry on its own
+                raise ValueError('temporarily broken')
+            return apply_entries(payloads)
+
+        report_id = journal.append(self.payload())
+        with mock.patch.object(journal, 'apply_entries', fail_first_attempts):
+            journal.schedule_drain()
+            stored = self.wait_for(
+                lambda: IncidentReport.objects.filter(pk=report_id).exists()
+            )
+        self.assertTrue(stored)
+        self.assertGreaterEqual(len(calls), 3)
+        self.assertEqual(journal.pending_count(), 0)
+
+    def test_first_request_drains_entries_left_by_a_previous_process(self):
+        journal.append(self.payload())
+        request_started.connect(
+            journal.drain_after_restart, dispatch_uid='report-journal-startup'
+        )
+        with mock.patch.object(journal, 'schedule_drain') as schedule_drain:
+            request_started.send(sender=self.__class__)
+            request_started.send(sender=self.__class__)
+        schedule_drain.assert_called_once_with()
+
+
+class OrphanedVoiceNoteTests(JournalMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_journal()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.user = UserProfile.objects.create(telegram_id='400')
+
+    def voice_note_dir(self):
+        name = uuid.uuid4().hex
+        path = os.path.join(self.media_root, VOICE_NOTES_DIR, name)
+        os.makedirs(path)
+        with open(os.path.join(path, 'original.ogg'), 'wb') as f:
+            f.write(b'OggS')
+        return name, path
+
+    def report_with(self, voice_note_url):
+        IncidentReport.objects.create(
+            user=self.user,
+            type='other',
+            location='GPS: 9.0, 38.7',
+            latitude=9.0,
+            longitude=38.7,
+            voice_note_url=voice_note_url,
+        )
+
+    def test_only_unlinked_directories_are_orphans(self):
+        orphan = self.voice_note_dir()[1]
+        name, _ = self.voice_note_dir()
+        self.report_with(f'/media/{VOICE_NOTES_DIR}/{name}/original.ogg')
+        pending, _ = self.voice_note_dir()
+        journal.append(
+            self.payload(voice_note_url=f'/media/{VOICE_NOTES_DIR}/{pending}/a.ogg')
+        )
+        self.assertEqual(find_orphaned_voice_notes(grace=-1), [orphan])
+
+    def test_absolute_or_unrecognised_urls_keep_their_directory(self):
+        absolute, _ = self.voice_note_dir()
+        self.report_with(
+            f'https://bot.example/media/{VOICE_NOTES_DIR}/{absolute}/original.ogg'
+        )
+        unknown, _ = self.voice_note_dir()
+        self.report_with(f'https://cdn.example/audio/{unknown}/note.ogg')
+        self.assertEqual(find_orphaned_voice_notes(grace=-1), [])
+
+    def test_recent_directories_are_kept(self):
+        self.voice_note_dir()
+        self.assertEqual(find_orphaned_voice_notes(grace=3600), [])
+
+
+def pieces(data, size):
+    for start in range(0, len(data), size):
+        yield data[start : start + size]
+
+
+@override_settings(ENCRYPTION_KEYS=[OLD_KEY])
+class VoiceNoteEncryptionTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def encrypt(self, plaintext, piece_size=10000):
+        path = os.path.join(self.directory, f'{uuid.uuid4().hex}.ogg')
+        with open(path, 'wb') as out:
+            encrypt_chunks(pieces(plaintext, piece_size), out)
+        return path
+
+    def test_round_trip_across_chunk_boundaries(self):
+        sizes = (0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE + 5)
+        for size in sizes:
+            plaintext = os.urandom(size)
+            encrypted = EncryptedFile(self.encrypt(plaintext))
+            self.assertEqual(encrypted.size, size)
+            self.assertEqual(b''.join(encrypted), plaintext)
+
+    def test_ranges_decrypt_only_the_requested_bytes(self):
+        plaintext = os.urandom(3 * CHUNK_SIZE + 5)
+        encrypted = EncryptedFile(self.encrypt(plaintext))
+        for start, end in (
+            (0, 0),
+            (CHUNK_SIZE - 1, CHUNK_SIZE),
+            (CHUNK_SIZE - 10, 2 * CHUNK_SIZE + 10),
+            (3 * CHUNK_SIZE, 3 * CHUNK_SIZE + 4),
+            (100, None),
+        ):
+            expected = plaintext[start : None if end is None else end + 1]
+            self.assertEqual(b''.join(encrypted.iter_range(start, end)), expected)
+
+    def test_tampered_chunk_is_rejected(self):
+        plaintext = os.urandom(2 * CHUNK_SIZE + 5)
+        path = self.encrypt(plaintext)
+        with open(path, 'r+b') as f:
+            f.seek(HEADER.size + CHUNK_SIZE + TAG_SIZE + 7)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+
+        encrypted = EncryptedFile(path)
+        # Chunk 0 is untouched and still readable on its own
+        self.assertEqual(b''.join(encrypted.iter_range(0, 99)), plaintext[:100])
+        with self.assertRaises(MediaDecryptionError):
+            b''.join(encrypted.iter_range(CHUNK_SIZE, CHUNK_SIZE + 10))
+
+    def test_reordered_chunks_are_rejected(self):
+        path = self.encrypt(os.urandom(2 * CHUNK_SIZE + 5))
+        stride = CHUNK_SIZE + TAG_SIZE
+        with open(path, 'r+b') as f:
+            f.seek(HEADER.size)
+            first, second = f.read(stride), f.read(stride)
+            f.seek(HEADER.size)
+            f.write(second + first)
+
+        encrypted = EncryptedFile(path)
+        with self.assertRaises(MediaDecryptionError):
+            b''.join(encrypted.iter_range(0, 10))
+        with self.assertRaises(MediaDecryptionError):
+            b''.join(encrypted.iter_range(CHUNK_SIZE, CHUNK_SIZE + 10))
+
+    def test_file_cut_at_a_chunk_boundary_is_rejected(self):
+        path = self.encrypt(os.urandom(2 * CHUNK_SIZE + 5))
+        with open(path, 'r+b') as f:
+            f.truncate(HEADER.size + 2 * (CHUNK_SIZE + TAG_SIZE))
+        with self.assertRaises(MediaDecryptionError):
+            b''.join(EncryptedFile(path))
+
+
+@override_settings(ENCRYPTION_KEYS=[OLD_KEY])
+class ServeVoiceNoteTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        self.plaintext = os.urandom(3 * CHUNK_SIZE + 100)
+        directory = uuid.uuid4()
+        os.makedirs(os.path.join(media_root, VOICE_NOTES_DIR, str(directory)))
+        path = os.path.join(media_root, VOICE_NOTES_DIR, str(directory), 'note.ogg')
+        with open(path, 'wb') as out:
+            encrypt_chunks(pieces(self.plaintext, 5000), out)
+        self.url = reverse('voice_note', args=[directory, 'note.ogg'])
+
+        staff = User.objects.create_user('dispatcher', password='x', is_staff=True)
+        self.client.force_login(staff)
+
+    def test_whole_file_is_decrypted(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.plaintext)))
+        self.assertEqual(b''.join(response.streaming_content), self.plaintext)
+
+    def test_range_starting_and_ending_mid_chunk(self):
+        start, end = CHUNK_SIZE - 300, 2 * CHUNK_SIZE + 700
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={start}-{end}')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(
+            response['Content-Range'], f'bytes {start}-{end}/{len(self.plaintext)}'
+        )
+        self.assertEqual(response['Content-Length'], str(end - start + 1))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body, self.plaintext[start : end + 1])
+
+    def test_unsatisfiable_range(self):
+        size = len(self.plaintext)
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_other_users_cannot_listen(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class NearbyAgenciesSerializerTests(TestCase):
+    def setUp(self):
+        user = UserProfile.objects.create(telegram_id='500')
+        self.report = IncidentReport.objects.create(
+            user=user,
+            type='other',
+            location='GPS: 9.0, 38.75',
+            latitude=9.0,
+            longitude=38.75,
+        )
+
+    def add_agency(self, name, km_north, **fields):
+        # One degree of latitude is about 111 km
+        Agency.objects.create(
+            name=name,
+            type='police',
+            region='Addis Ababa',
+            phone='+251111000000',
+            latitude=9.0 + km_north / 111.2,
+            longitude=38.75,
+            **fields,
+        )
+
+    def test_five_closest_active_agencies_within_10_km(self):
+        for km in (7, 1, 9, 3, 5, 2):
+            self.add_agency(f'{km} km', km)
+        self.add_agency('Closed', 0.5, active=False)
+        self.add_agency('Too far', 12)
+
+        with self.assertNumQueries(1):
+            nearby = IncidentReportDetailSerializer().get_nearby_agencies(self.report)
+        names = [agency['name'] for agency in nearby]
+        self.assertEqual(names, ['1 km', '2 km', '3 km', '5 km', '7 km'])
+        self.assertAlmostEqual(nearby[0]['distance_km'], 1, places=1)
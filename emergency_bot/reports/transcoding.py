@@ -0,0 +1,419 @@
+"""
+Background transcoding of voice notes to Opus.
+
+Browsers upload voice notes as WAV or WebM, often megabytes per minute of
+speech. Once an upload is stored it is queued for a local worker thread
+that runs ffmpeg once per file: one output is a speech-tuned mono Opus/Ogg
+copy, the other an 8 kHz PCM stream read through a pipe to measure the
+duration and a peak waveform without holding the audio in memory. The
+result is written next to the upload as ``voice_note.json`` and reports
+pointing at the original are switched to the compressed file. Encrypted
+uploads are decrypted straight into ffmpeg's input and the compressed copy
+is encrypted as well.
+
+The queue lives in the web process, so uploads it never got to (after a
+restart, say) are picked up by ``manage.py transcode_voice_notes``, which
+also removes originals once nothing refers to them any more.
+"""
+
+import array
+import json
+import logging
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections
+from django.urls import Resolver404, resolve, reverse
+
+from .media_encryption import (
+    EncryptedFile,
+    encrypt_file,
+    encryption_enabled,
+    is_encrypted,
+)
+from .models import IncidentReport
+
+logger = logging.getLogger(__name__)
+
+VOICE_NOTES_DIR = 'voice_notes'
+META_NAME = 'voice_note.json'
+COMPRESSED_SUFFIX = '.opus.ogg'
+
+OPUS_BITRATE = '24k'
+PCM_RATE = 8000
+# Waveform peaks are measured per 100 ms and summarised into this many points
+PEAK_BLOCK_SAMPLES = PCM_RATE // 10
+WAVEFORM_POINTS = 64
+TRANSCODE_TIMEOUT = 600
+
+
+def ffmpeg_binary():
+    return shutil.which(getattr(settings, 'FFMPEG_BINARY', 'ffmpeg'))
+
+
+def storage_name(url):
+    """
+    Return the storage name of a voice note URL, or None for any other URL.
+    Both the serving view's URLs and plain media URLs are accepted, with or
+    without scheme and host.
+    """
+    if not url:
+        return None
+    path = urlsplit(url).path
+    media_path = urlsplit(settings.MEDIA_URL).path
+    if url.startswith(settings.MEDIA_URL):
+        name = url[len(settings.MEDIA_URL) :]
+    elif media_path and path.startswith(media_path):
+        name = path[len(media_path) :]
+    else:
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return None
+        if match.url_name != 'voice_note':
+            return None
+        name = (
+            f"{VOICE_NOTES_DIR}/{match.kwargs['directory']}/{match.kwargs['filename']}"
+        )
+    parts = name.split('/')
+    if len(parts) != 3 or parts[0] != VOICE_NOTES_DIR or '..' in parts:
+        return None
+    return name
+
+
+def voice_note_url(name):
+    """Return the URL voice note ``name`` is served from, decrypted and checked."""
+    _, directory, filename = name.split('/')
+    return reverse('voice_note', kwargs={'directory': directory, 'filename': filename})
+
+
+def voice_note_urls(name):
+    """
+    Every URL a report may refer to voice note ``name`` by, including the old
+    media URL.
+    """
+    return [voice_note_url(name), settings.MEDIA_URL + name]
+
+
+def read_meta(name):
+    """Return the transcoding result recorded for voice note ``name``, or None."""
+    path = os.path.join(os.path.dirname(default_storage.path(name)), META_NAME)
+    try:
+        with open(path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get('source') == name else None
+
+
+def write_meta(name, meta):
+    path = os.path.join(os.path.dirname(default_storage.path(name)), META_NAME)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, path)
+
+
+def resolve_voice_note(url):
+    """
+    Return ``(url, duration, waveform)`` for a voice note URL sent with a
+    report: the compressed file and its summary when transcoding has
+    finished, otherwise the URL as given and no summary.
+    """
+    name = storage_name(url)
+    meta = read_meta(name) if name else None
+    if not meta or meta.get('status') != 'done':
+        return url, None, None
+    return (
+        voice_note_url(meta['compressed'] or name),
+        meta['duration'],
+        meta['waveform'],
+    )
+
+
+def _measure(stream):
+    """
+    Return ``(peaks, samples)``: the peak of every 100 ms of 16-bit PCM read from
+    ``stream``.
+    """
+    block = PEAK_BLOCK_SAMPLES * 2
+    peaks = []
+    samples = 0
+    pending = b''
+    while True:
+        data = stream.read(block * 64)
+        if data:
+            pending += data
+            usable = len(pending) - len(pending) % block
+        else:
+            # Last, partial block
+            usable = len(pending) - len(pending) % 2
+        for start in range(0, usable, block):
+            values = array.array('h', pending[start : min(start + block, usable)])
+            if sys.byteorder == 'big':
+                values.byteswap()
+            peaks.append(max(max(values), -min(values)))
+        samples += usable // 2
+        pending = pending[usable:]
+        if not data:
+            return peaks, samples
+
+
+def summarize_waveform(peaks, points=WAVEFORM_POINTS):
+    """Reduce 100 ms peaks to at most ``points`` values between 0 and 1."""
+    if not peaks:
+        return []
+    points = min(points, len(peaks))
+    waveform = []
+    for i in range(points):
+        bucket = peaks[i * len(peaks) // points : (i + 1) * len(peaks) // points]
+        waveform.append(round(min(max(bucket) / 32767, 1.0), 3))
+    return waveform
+
+
+def _feed(encrypted, stdin, failures):
+    try:
+        for data in encrypted:
+            stdin.write(data)
+    except (BrokenPipeError, OSError):
+        # ffmpeg stopped reading; its exit status tells why
+        pass
+    except Exception as e:
+        failures.append(e)
+    finally:
+        try:
+            stdin.close()
+        except OSError:
+            pass
+
+
+def transcode_voice_note(name):
+    """
+    Transcode the stored voice note ``name`` to Opus, measure it and return
+    the metadata to record. The compressed copy is dropped when it would
+    not be smaller than the original.
+    Raises RuntimeError when ffmpeg is missing or fails.
+    """
+    binary = ffmpeg_binary()
+    if binary is None:
+        raise RuntimeError("ffmpeg is not installed")
+
+    source = default_storage.path(name)
+    compressed_name = os.path.splitext(name)[0] + COMPRESSED_SUFFIX
+    target = default_storage.path(compressed_name)
+    partial = f'{target}.part'
+    # Encrypted uploads are decrypted into ffmpeg's stdin, never onto disk
+    encrypted = EncryptedFile(source) if is_encrypted(source) else None
+    command = [
+        binary,
+        '-nostdin',
+        '-loglevel',
+        'error',
+        '-y',
+        '-i',
+        'pipe:0' if encrypted else source,
+        '-map',
+        '0:a:0',
+        '-ac',
+        '1',
+        '-c:a',
+        'libopus',
+        '-b:a',
+        OPUS_BITRATE,
+        '-application',
+        'voip',
+        '-f',
+        'ogg',
+        partial,
+        '-map',
+        '0:a:0',
+        '-ac',
+        '1',
+        '-ar',
+        str(PCM_RATE),
+        '-f',
+        's16le',
+        'pipe:1',
+    ]
+
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE if encrypted else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=errors,
+        )
+        timer = threading.Timer(TRANSCODE_TIMEOUT, process.kill)
+        timer.start()
+        feeder = None
+        failures = []
+        if encrypted:
+            feeder = threading.Thread(
+                target=_feed, args=(encrypted, process.stdin, failures), daemon=True
+            )
+            feeder.start()
+        try:
+            with process.stdout:
+                peaks, samples = _measure(process.stdout)
+            process.wait()
+            if feeder:
+                feeder.join()
+        finally:
+            timer.cancel()
+        if process.returncode != 0 or failures:
+            try:
+                os.remove(partial)
+            except FileNotFoundError:
+                pass
+            if failures:
+                # ffmpeg saw a cut-off input and may still have exited cleanly
+                raise RuntimeError(f"Could not decrypt voice note: {failures[0]}")
+            errors.seek(0)
+            message = errors.read().decode(errors='replace').strip().splitlines()
+            raise RuntimeError(
+                message[-1] if message else f"ffmpeg exited with {process.returncode}"
+            )
+
+    original_size = encrypted.size if encrypted else os.path.getsize(source)
+    compressed_size = os.path.getsize(partial)
+    if compressed_size >= original_size:
+        os.remove(partial)
+        compressed_name = None
+        compressed_size = original_size
+    elif encrypted or encryption_enabled():
+        encrypt_file(partial, target)
+        os.remove(partial)
+    else:
+        os.replace(partial, target)
+
+    return {
+        'source': name,
+        'status': 'done',
+        'compressed': compressed_name,
+        'duration': round(samples / PCM_RATE, 2),
+        'waveform': summarize_waveform(peaks),
+        'original_size': original_size,
+        'compressed_size': compressed_size,
+        'transcoded_at': time.time(),
+    }
+
+
+def switch_reports(meta):
+    """
+    Point reports that still use the original upload at the compressed one.
+    Returns the count.
+    """
+    return IncidentReport.objects.filter(
+        voice_note_url__in=voice_note_urls(meta['source'])
+    ).update(
+        voice_note_url=voice_note_url(meta['compressed'] or meta['source']),
+        voice_note_duration=meta['duration'],
+        voice_note_waveform=meta['waveform'],
+    )
+
+
+def process_voice_note(name):
+    """
+    Transcode ``name``, record the result and switch its reports. Returns the
+    metadata.
+    """
+    try:
+        meta = transcode_voice_note(name)
+    except Exception as e:
+        logger.error(f"Transcoding voice note {name} failed: {e}")
+        meta = {
+            'source': name,
+            'status': 'failed',
+            'error': str(e),
+            'transcoded_at': time.time(),
+        }
+        write_meta(name, meta)
+        return meta
+
+    write_meta(name, meta)
+    switched = switch_reports(meta)
+    logger.info(
+        f"Transcoded voice note {name}: "
+        f"{meta['original_size']} -> {meta['compressed_size']} bytes, "
+        f"{meta['duration']}s, {switched} reports switched"
+    )
+    return meta
+
+
+def iter_voice_notes():
+    """Yield the storage name of every uploaded (original) voice note."""
+    root = default_storage.path(VOICE_NOTES_DIR)
+    try:
+        directories = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+    for directory in directories:
+        if not directory.is_dir():
+            continue
+        for entry in sorted(os.scandir(directory.path), key=lambda entry: entry.name):
+            if (
+                entry.is_file()
+                and entry.name != META_NAME
+                and not entry.name.endswith((COMPRESSED_SUFFIX, '.part', '.tmp'))
+            ):
+                yield f'{VOICE_NOTES_DIR}/{directory.name}/{entry.name}'
+
+
+_queue = queue.Queue()
+_pending = set()
+_pending_lock = threading.Lock()
+_worker = None
+_warned_missing = False
+
+
+def _work():
+    while True:
+        name = _queue.get()
+        try:
+            process_voice_note(name)
+        except Exception as e:
+            logger.error(f"Voice note worker failed on {name}: {e}")
+        finally:
+            with _pending_lock:
+                _pending.discard(name)
+            # Do not keep a database connection open in an idle thread
+            connections.close_all()
+
+
+def enqueue_transcode(name):
+    """
+    Queue the stored voice note ``name`` for transcoding in the background.
+    Returns False when transcoding is disabled, ffmpeg is missing or the
+    file is already queued.
+    """
+    global _worker, _warned_missing
+    if not name or not getattr(settings, 'VOICE_NOTE_TRANSCODE', True):
+        return False
+    if ffmpeg_binary() is None:
+        if not _warned_missing:
+            logger.warning(
+                "ffmpeg not found; voice notes are stored without transcoding"
+            )
+            _warned_missing = True
+        return False
+    with _pending_lock:
+        if name in _pending:
+            return False
+        _pending.add(name)
+        # One worker, so a burst of uploads cannot start many ffmpeg processes at once
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(
+                target=_work, name='voice-note-transcoder', daemon=True
+            )
+            _worker.start()
+    _queue.put(name)
+    return True
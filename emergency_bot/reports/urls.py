@@ -13,4 +13,5 @@ router.register(r'incident-reports', views.IncidentReportViewSet)
 # The API URLs are determined automatically by the router
 urlpatterns = [
     path('', include(router.urls)),
+    path('voice-notes/<uuid:directory>/<str:filename>', views.serve_voice_note, name='voice_note'),
 ] 
\ No newline at end of file
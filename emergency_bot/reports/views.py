@@ -3,20 +3,28 @@ Views for the reports app.
 """
 
 import logging
+import os
+import re
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from rest_framework import viewsets, generics, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from django.core.files.storage import default_storage
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.db.models import Q
 
+from . import journal
+from .media_encryption import EncryptedFile, MediaDecryptionError, is_encrypted
 from .models import IncidentReport
 from .serializers import (
     IncidentReportSerializer,
     IncidentReportDetailSerializer,
     ReportStatusUpdateSerializer,
 )
+from .transcoding import voice_note_urls
 
 logger = logging.getLogger(__name__)
 
@@ -69,6 +77,21 @@ class IncidentReportViewSet(viewsets.ModelViewSet):
         
         return queryset
     
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Reports are written from the report journal shortly after they are
+        acknowledged; until then their owner gets 202 with the journal state
+        instead of 404.
+        """
+        try:
+            return super().retrieve(request, *args, **kwargs)
+        except Http404:
+            user = getattr(request, 'user_profile', None)
+            entry = journal.entry_status(kwargs.get('pk'))
+            if not user or not entry or entry['state'] == 'applied' or entry['telegram_id'] != str(user.telegram_id):
+                raise
+            return Response({'id': kwargs.get('pk'), 'state': entry['state']}, status=status.HTTP_202_ACCEPTED)
+    
     def get_serializer_class(self):
         """
         Use different serializers for list/detail.
@@ -156,4 +179,103 @@ class IncidentReportViewSet(viewsets.ModelViewSet):
                 "timestamp": timezone.now().isoformat(),
                 "related_report": str(report.id),
             },
-        ) 
\ No newline at end of file
+        ) 
+
+VOICE_NOTE_CONTENT_TYPES = {
+    'ogg': 'audio/ogg',
+    'webm': 'audio/webm',
+    'wav': 'audio/wav',
+    'mp3': 'audio/mpeg',
+    'm4a': 'audio/mp4',
+    'aac': 'audio/aac',
+    'bin': 'application/octet-stream',
+}
+
+_BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_range(header, size):
+    """
+    Return the ``(start, end)`` of a single-range ``Range`` header, or None
+    to send the whole file. Raises ValueError for unsatisfiable ranges.
+    """
+    match = _BYTE_RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        # Multiple or malformed ranges may be ignored (RFC 9110)
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+def _plain_range(path, start, end, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                return
+            remaining -= len(data)
+            yield data
+
+
+def serve_voice_note(request, directory, filename):
+    """
+    Stream a voice note, decrypting it chunk by chunk when it is encrypted at
+    rest. Supports single HTTP Range requests so players can seek. Staff and
+    the owner of a report using the voice note may listen to it.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if filename.startswith('.') or extension not in VOICE_NOTE_CONTENT_TYPES:
+        raise Http404("Voice note not found")
+    name = f'voice_notes/{directory}/{filename}'
+    user = getattr(request, 'user_profile', None)
+    if not (request.user.is_authenticated and request.user.is_staff):
+        if not user or not IncidentReport.objects.filter(
+            user=user, voice_note_url__in=voice_note_urls(name)
+        ).exists():
+            raise Http404("Voice note not found")
+
+    try:
+        path = default_storage.path(name)
+        encrypted = EncryptedFile(path) if is_encrypted(path) else None
+    except FileNotFoundError:
+        raise Http404("Voice note not found")
+    except MediaDecryptionError as e:
+        logger.error(f"Cannot serve voice note {name}: {e}")
+        return HttpResponse(status=500)
+    size = encrypted.size if encrypted else os.path.getsize(path)
+
+    try:
+        byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+    start, end = byte_range or (0, size - 1)
+
+    if encrypted:
+        content = encrypted.iter_range(start, end)
+    else:
+        content = _plain_range(path, start, end)
+    response = StreamingHttpResponse(
+        content,
+        status=206 if byte_range else 200,
+        content_type=VOICE_NOTE_CONTENT_TYPES[extension],
+    )
+    response['Content-Length'] = str(max(end - start + 1, 0))
+    response['Accept-Ranges'] = 'bytes'
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    patch_cache_control(response, private=True, no_store=True)
+    return response
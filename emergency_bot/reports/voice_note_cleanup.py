@@ -0,0 +1,151 @@
+"""
+Removal of voice notes that never became part of a report.
+
+Every upload gets a directory ``voice_notes/<uuid>/`` holding the
+original, its compressed copy and the transcoding metadata. When the user
+records again, abandons the form or retries an upload that had in fact
+arrived, nothing ever links to that directory. A background sweeper
+started by the upload views removes such directories once nothing in them
+has changed for ``VOICE_NOTE_ORPHAN_GRACE`` seconds and neither a report
+nor a submission still waiting in the report journal refers to them.
+``manage.py remove_orphaned_voice_notes`` does the same on demand.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import connections
+
+from . import journal
+from .models import IncidentReport
+from .transcoding import VOICE_NOTES_DIR, storage_name
+
+logger = logging.getLogger(__name__)
+
+# Longer than idempotent replays of an upload are kept, so a replayed URL is never
+# dangling
+DEFAULT_GRACE = 48 * 60 * 60
+DEFAULT_SWEEP_INTERVAL = 60 * 60
+
+
+def orphan_grace():
+    return getattr(settings, 'VOICE_NOTE_ORPHAN_GRACE', DEFAULT_GRACE)
+
+
+def _last_modified(path):
+    """Newest modification time of the directory ``path`` and the files in it."""
+    newest = os.stat(path).st_mtime
+    for entry in os.scandir(path):
+        newest = max(newest, entry.stat(follow_symlinks=False).st_mtime)
+    return newest
+
+
+def _directories(url):
+    """
+    Return the voice note directories ``url`` may link to. A URL that is not
+    recognised keeps every directory named by one of its path segments,
+    so a voice note is never removed because its URL took an unknown form.
+    """
+    name = storage_name(url)
+    if name:
+        return {name.split('/')[1]}
+    return set(urlsplit(url).path.split('/'))
+
+
+def linked_directories():
+    """
+    Return the names of the voice note directories reports (or pending
+    submissions) link to.
+    """
+    urls = (
+        IncidentReport.objects.exclude(voice_note_url__isnull=True)
+        .exclude(voice_note_url='')
+        .values_list(
+            'voice_note_url',
+            flat=True,
+        )
+    )
+    directories = set()
+    for url in urls.iterator():
+        directories.update(_directories(url))
+    for url in journal.pending_voice_note_urls():
+        directories.update(_directories(url))
+    directories.discard('')
+    return directories
+
+
+def find_orphaned_voice_notes(grace=None):
+    """
+    Return the paths of voice note directories unchanged for ``grace`` seconds
+    that nothing links to.
+    """
+    cutoff = time.time() - (orphan_grace() if grace is None else grace)
+    root = default_storage.path(VOICE_NOTES_DIR)
+    candidates = []
+    try:
+        entries = list(os.scandir(root))
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        try:
+            if (
+                entry.is_dir(follow_symlinks=False)
+                and _last_modified(entry.path) < cutoff
+            ):
+                candidates.append(entry)
+        except FileNotFoundError:
+            continue
+    if not candidates:
+        return []
+    # Looked up after the scan, so a report linked while scanning is still seen
+    linked = linked_directories()
+    return [entry.path for entry in candidates if entry.name not in linked]
+
+
+def remove_orphaned_voice_notes(grace=None, dry_run=False):
+    """Remove orphaned voice note directories. Returns their paths."""
+    orphans = find_orphaned_voice_notes(grace)
+    if dry_run:
+        return orphans
+    for path in orphans:
+        shutil.rmtree(path, ignore_errors=True)
+    if orphans:
+        logger.info(f"Removed {len(orphans)} voice note directories no report links to")
+    return orphans
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def _work():
+    while True:
+        try:
+            remove_orphaned_voice_notes()
+        except Exception as e:
+            logger.error(f"Voice note sweep failed: {e}")
+        finally:
+            # Do not keep a database connection open in an idle thread
+            connections.close_all()
+        time.sleep(
+            getattr(settings, 'VOICE_NOTE_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL)
+        )
+
+
+def start_sweeper():
+    """Start the background sweeper in this process unless it is running or disabled."""
+    global _worker
+    if not getattr(settings, 'VOICE_NOTE_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL):
+        return False
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return False
+        _worker = threading.Thread(target=_work, name='voice-note-sweeper', daemon=True)
+        _worker.start()
+    return True
@@ -148,6 +148,8 @@ TELEGRAM_BOT_TOKEN = '7697446317:AAGfXeRSQqbqdmZOg5KqkyzY7ZuSONLPdrU'  # Updated
 
 # Encryption key for sensitive data (generate with: base64.urlsafe_b64encode(os.urandom(32)).decode())
 ENCRYPTION_KEY = os.environ.get('ENCRYPTION_KEY', 'VupN3fmyblg7uKkum-NBK6QmdlyRvj_BxP3HCDVFAgg=')
+# Optional comma separated keys for rotation: the new primary key first, then old keys still accepted for reading
+ENCRYPTION_KEYS = [key for key in os.environ.get('ENCRYPTION_KEYS', '').split(',') if key]
 
 # Security settings for Telegram WebApp
 CSRF_TRUSTED_ORIGINS = [
@@ -23,15 +23,16 @@ urlpatterns = [
     # Telegram webhook
     path('telegram/', include('emergency_bot.telegram_bot.urls')),
     
-    # Frontend routes for the Telegram Mini App
-    path('webapp/', include('emergency_bot.frontend.urls')),
-    
     # Direct access to HTML files at root level
     path('index.html', include('emergency_bot.frontend.urls')),
     path('agencies.html', include('emergency_bot.frontend.urls')),
     path('report.html', include('emergency_bot.frontend.urls')),
     path('profile.html', include('emergency_bot.frontend.urls')),
     
+    # Frontend routes for the Telegram Mini App. Listed after the aliases
+    # above: reverse() and {% url %} use the last include of a name
+    path('webapp/', include('emergency_bot.frontend.urls')),
+    
     # Redirect root URL to webapp
     path('', RedirectView.as_view(url='/webapp/', permanent=False), name='home'),
 ]
@@ -21,7 +21,9 @@ from django.utils import timezone
 from django.db import transaction
 
 from emergency_bot.accounts.models import UserProfile
+from emergency_bot.agencies.loader import load_agencies
 from emergency_bot.agencies.models import Agency
+from emergency_bot.agencies.sync import base_slug
 from emergency_bot.reports.models import IncidentReport
 from emergency_bot.notifications.models import Notification, NotificationChannel
 
@@ -471,10 +473,9 @@ def create_agencies():
         },
     ]
 
-    agencies = []
-    for agency_data in agencies_data:
-        agency = Agency.objects.create(**agency_data)
-        agencies.append(agency)
+    # The loader picks unique slugs and fills in content_hash; rerunning keeps existing agencies
+    load_agencies(agencies_data, update_existing=False)
+    agencies = list(Agency.objects.filter(slug__in=[base_slug(data) for data in agencies_data]))
 
     print(f"✓ Created {len(agencies)} agencies")
     return agencies